@@ -0,0 +1,160 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import charts
+import final_project
+import instrumentation
+
+
+def parse_metrics(spec):
+    ''' turn a --metrics argument into entries of final_project.GRAPHICS
+
+    Parameters
+    ----------
+    spec
+        str: 'all', or comma separated chart numbers (as in graphic_list)
+        and/or Status_history column names
+
+    Returns
+    -------
+    list: (metric, chart title) tuples
+    '''
+    if spec == "all":
+        return list(final_project.GRAPHICS)
+    by_metric = dict(final_project.GRAPHICS)
+    graphics = []
+    for item in spec.split(","):
+        item = item.strip()
+        if item.isnumeric() and 1 <= int(item) <= len(final_project.GRAPHICS):
+            graphics.append(final_project.GRAPHICS[int(item) - 1])
+        elif item in by_metric:
+            graphics.append((item, by_metric[item]))
+        else:
+            raise ValueError("Unknown metric: " + item)
+    return graphics
+
+
+def render_country(country_code, country_name, series, graphics, out_dir,
+                   dashboard=False, webgl=False, max_points=charts.MAX_POINTS, plotlyjs='directory'):
+    ''' write the html charts of a country, one per metric or a single
+    dashboard page; runs in a worker process
+
+    Parameters
+    ----------
+    country_code
+        str: the 2 letter country code
+    country_name
+        str: the name used in the chart titles
+    series
+        dic: the columns returned by final_project.get_series
+    graphics
+        list: (metric, chart title) tuples
+    out_dir
+        str: the output directory
+    dashboard, webgl, max_points, plotlyjs
+        rendering options, see charts.build_dashboard and charts.write_chart
+
+    Returns
+    -------
+    tuple: the paths written and the seconds spent
+    '''
+    start = time.perf_counter()
+    paths = []
+    if dashboard:
+        fig = charts.build_dashboard(series, graphics, "COVID-19 history of " + country_name,
+                                     webgl=webgl, max_points=max_points)
+        path = os.path.join(out_dir, "{}_dashboard.html".format(country_code))
+        charts.write_chart(fig, path, plotlyjs=plotlyjs)
+        paths.append(path)
+    else:
+        for metric, title in graphics:
+            fig = charts.build_figure(series["Time"], series[metric], title + country_name,
+                                      webgl=webgl, max_points=max_points)
+            path = os.path.join(out_dir, "{}_{}.html".format(country_code, metric))
+            charts.write_chart(fig, path, plotlyjs=plotlyjs)
+            paths.append(path)
+    return paths, time.perf_counter() - start
+
+
+def run_batch(codes, graphics, out_dir, workers=None, progress=print, **render_options):
+    ''' render every chart in `graphics` for every country in `codes`
+
+    Each country is ingested and queried once, in this process, and its
+    series are handed to a worker process that renders all of its charts,
+    so loading the next country overlaps with rendering the previous ones.
+
+    Parameters
+    ----------
+    codes
+        list: 2 letter country codes, None for every country in the directory
+    graphics
+        list: (metric, chart title) tuples, see parse_metrics
+    out_dir
+        str: the output directory, created if needed
+    workers
+        int: rendering processes, None for one per CPU
+    progress
+        function: called with one line of text per country and for the summary
+    render_options
+        dashboard, webgl, max_points and plotlyjs, passed to render_country
+
+    Returns
+    -------
+    dic: the files written, failures by country code and seconds per stage
+    '''
+    start = time.perf_counter()
+    os.makedirs(out_dir, exist_ok=True)
+    if render_options.get('plotlyjs', 'directory') == 'directory':
+        charts.ensure_plotlyjs(out_dir)
+    final_project.create_db()
+    directory = final_project.get_country_directory()
+    if codes is None:
+        codes = sorted(directory.by_code)
+    unknown = [code for code in codes if directory.name_for(code) is None]
+    if unknown:
+        raise ValueError("unknown country code " + ", ".join(unknown))
+    metrics = [metric for metric, _ in graphics]
+
+    summary = {'files': [], 'failed': {},
+               'timings': {'ingest': 0.0, 'query': 0.0, 'render': 0.0}}
+    timings = summary['timings']
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for code in codes:
+            name = directory.name_for(code)
+            try:
+                stage = time.perf_counter()
+                final_project.ingest_country(name)
+                timings['ingest'] += time.perf_counter() - stage
+                stage = time.perf_counter()
+                series = final_project.get_series(code, metrics)
+                timings['query'] += time.perf_counter() - stage
+            except Exception as error:
+                summary['failed'][code] = str(error)
+                progress("{} failed: {}".format(code, error))
+                continue
+            futures[pool.submit(render_country, code, name, series, graphics, out_dir,
+                                **render_options)] = code
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                paths, seconds = future.result()
+            except Exception as error:
+                summary['failed'][code] = str(error)
+                progress("{} failed: {}".format(code, error))
+                continue
+            timings['render'] += seconds
+            instrumentation.observe('render', seconds)
+            summary['files'].extend(paths)
+            progress("{} rendered {} files".format(code, len(paths)))
+    timings['total'] = time.perf_counter() - start
+
+    progress("-" * 20)
+    progress("{} files for {} countries, {} failed".format(
+        len(summary['files']), len(codes) - len(summary['failed']), len(summary['failed'])))
+    progress("ingest  {:8.2f}s".format(timings['ingest']))
+    progress("query   {:8.2f}s".format(timings['query']))
+    progress("render  {:8.2f}s (summed over workers)".format(timings['render']))
+    progress("total   {:8.2f}s wall".format(timings['total']))
+    return summary
@@ -0,0 +1,527 @@
+'''Offline benchmark of every stage of the pipeline, replaying fixtures
+instead of hitting worldometers, countrycode.org or RapidAPI.
+
+    python benchmarks/bench_pipeline.py [--repeat 5] [--history-scale 10] [--all-countries] [--json out.json]
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+
+Recorded fixtures from benchmarks/fixtures/ are used when present (see
+fixtures.py), synthetic ones otherwise. Every run works in a temporary
+directory, so the cache and database of the working tree are not touched.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fixtures as fixture_loader  # noqa: E402
+from cache_store import COMPRESS_MIN_BYTES  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+# ingest_everywhere adds the histories of all countries in this many rounds
+INGEST_ROUNDS = 10
+
+# (name, setup) pairs; setup(ctx) does the untimed preparation and returns the
+# function to time and the number of items it handles, or None to skip
+STAGES = []
+
+
+def stage(name):
+    def register(setup):
+        STAGES.append((name, setup))
+        return setup
+    return register
+
+
+class Context:
+    ''' what the stages share: the fixtures, the final_project module running
+    in a scratch directory, and the options of the run '''
+
+    def __init__(self, fixtures, options, workdir):
+        self.fixtures = fixtures
+        self.options = options
+        self.workdir = workdir
+        os.chdir(workdir)
+        import final_project
+        from country_directory import CountryDirectory
+        self.fp = final_project
+        final_project.CACHE_DICT = final_project.load_cache()
+        self.directory = CountryDirectory.from_pages(fixtures.country_code_page, fixtures.letter_pages)
+        final_project.COUNTRY_DIRECTORY = self.directory
+        final_project.create_db()
+        self.records = {code: self.dedup(payload) for code, payload in fixtures.histories.items()}
+        self._files = 0
+        self._everywhere = None
+
+    def scratch(self, suffix):
+        self._files += 1
+        return os.path.join(self.workdir, "scratch{}{}".format(self._files, suffix))
+
+    @staticmethod
+    def chunks(payload):
+        return [payload[i:i + CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE)]
+
+    def dedup(self, payload):
+        from history_stream import iter_payload_records, last_record_per_day
+        return list(last_record_per_day(iter_payload_records(self.chunks(payload))))
+
+    def ingest_setup(self, code):
+        ''' make sure Country_info holds `code`, returning its name '''
+        name = self.directory.name_for(code)
+        self.fp.add_country_info_sqlite(name)
+        return name
+
+    def ingest_everywhere(self):
+        ''' ingest the history of the large reference country for every
+        country of the directory, once, returning their codes. The days
+        are added in rounds across all countries, as daily ingestion does,
+        so the rows of a country are not next to each other in the table '''
+        if self._everywhere is None:
+            template = self.records[self.fixtures.large]
+            self._everywhere = [code for code, country in self.directory.by_code.items()
+                                if country["population"]]
+            names = [self.ingest_setup(code) for code in self._everywhere]
+            step = -(-len(template) // INGEST_ROUNDS)
+            for start in range(0, len(template), step):
+                for name in names:
+                    self.fp.add_history_sqlite(name, records=template[start:start + step])
+        return self._everywhere
+
+
+def _cache_entries(ctx):
+    ''' what the cache holds after a directory build and a few histories:
+    the rows extracted from each page and the deduplicated records '''
+    from country_directory import parse_country_code_page, parse_letter_page
+    entries = {"page_" + letter: parse_letter_page(page) for letter, page in ctx.fixtures.letter_pages.items()}
+    entries["countrycode"] = parse_country_code_page(ctx.fixtures.country_code_page)
+    entries.update({"history_" + code: records for code, records in ctx.records.items()})
+    return entries
+
+
+def _cache_save_stage(compress_min_bytes):
+    def setup(ctx):
+        from cache_store import CacheStore
+        entries = _cache_entries(ctx)
+
+        def run():
+            store = CacheStore(ctx.scratch(".sqlite"), compress_min_bytes=compress_min_bytes)
+            for key, value in entries.items():
+                store[key] = value
+            store.close()
+        return run, len(entries)
+    return setup
+
+
+def _cache_load_stage(compress_min_bytes):
+    def setup(ctx):
+        from cache_store import CacheStore
+        path = ctx.scratch(".sqlite")
+        entries = _cache_entries(ctx)
+        store = CacheStore(path, compress_min_bytes=compress_min_bytes)
+        for key, value in entries.items():
+            store[key] = value
+        store.close()
+
+        def run():
+            store = CacheStore(path)
+            for key in entries:
+                store.get(key)
+            store.close()
+        return run, len(entries)
+    return setup
+
+
+stage("cache_save")(_cache_save_stage(COMPRESS_MIN_BYTES))
+stage("cache_save_uncompressed")(_cache_save_stage(None))
+stage("cache_load")(_cache_load_stage(COMPRESS_MIN_BYTES))
+stage("cache_load_uncompressed")(_cache_load_stage(None))
+
+
+@stage("directory_build")
+def _directory_build(ctx):
+    from country_directory import CountryDirectory
+
+    def run():
+        CountryDirectory.from_pages(ctx.fixtures.country_code_page, ctx.fixtures.letter_pages)
+    return run, len(ctx.fixtures.letter_pages) + 1
+
+
+def _full_tree_rows(html, class_name):
+    ''' the extraction the scrapers used before: a complete html.parser tree
+    of the page, then a search for the table '''
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    table = soup.find(class_=class_name)
+    if table is None or table.find('tbody') is None:
+        return []
+    return [[cell.text for cell in row.find_all("td")] for row in table.find('tbody').find_all('tr')]
+
+
+def _pages(ctx):
+    pages = [(html, "table-responsive", None) for html in ctx.fixtures.letter_pages.values()]
+    pages.append((ctx.fixtures.country_code_page, "main-table", "table"))
+    return pages
+
+
+@stage("extract_full_tree")
+def _extract_full_tree(ctx):
+    pages = _pages(ctx)
+
+    def run():
+        for html, class_name, _ in pages:
+            _full_tree_rows(html, class_name)
+    return run, len(pages)
+
+
+def _extract_targeted(parser):
+    def setup(ctx):
+        import scraping
+        if parser == 'lxml':
+            try:
+                import lxml  # noqa: F401
+            except ImportError:
+                return None
+        pages = _pages(ctx)
+
+        def run():
+            saved = scraping._parser
+            scraping._parser = parser
+            try:
+                for html, class_name, tag in pages:
+                    scraping.table_rows(html, class_name, tag)
+            finally:
+                scraping._parser = saved
+        return run, len(pages)
+    return setup
+
+
+stage("extract_targeted_html_parser")(_extract_targeted('html.parser'))
+stage("extract_targeted_lxml")(_extract_targeted('lxml'))
+
+
+@stage("extract_cached_rows")
+def _extract_cached(ctx):
+    from country_directory import parse_country_code_page, parse_letter_page
+    pages = {"letter_" + letter: (html, parse_letter_page) for letter, html in ctx.fixtures.letter_pages.items()}
+    pages["countrycode"] = (ctx.fixtures.country_code_page, parse_country_code_page)
+    for url, (html, parse) in pages.items():
+        ctx.fp.CACHE_DICT.set(url, html)
+        ctx.fp.get_page_rows(url, parse)
+
+    def run():
+        for url, (_, parse) in pages.items():
+            ctx.fp.get_page_rows(url, parse)
+    return run, len(pages)
+
+
+@stage("get_country_name_list")
+def _name_list(ctx):
+    letters = sorted(ctx.fixtures.letter_pages)
+
+    def run():
+        for letter in letters:
+            ctx.fp.get_country_name_list(letter)
+    return run, len(letters)
+
+
+@stage("get_country_code")
+def _country_code(ctx):
+    names = [country["name"] for country in ctx.directory.countries]
+
+    def run():
+        for name in names:
+            ctx.fp.get_country_code(name)
+    return run, len(names)
+
+
+def _dedup_stage(size):
+    def setup(ctx):
+        code = getattr(ctx.fixtures, size)
+        chunks = ctx.chunks(ctx.fixtures.histories[code])
+
+        def run():
+            from history_stream import iter_payload_records, last_record_per_day
+            list(last_record_per_day(iter_payload_records(chunks)))
+        return run, len(ctx.records[code])
+    return setup
+
+
+def _normalize_loop(records, population):
+    ''' the per-record conversion add_history_sqlite did before
+    normalize.normalize_history, kept as the reference (including its
+    zeroing of total_deaths when total_recovered is empty) '''
+    rows = []
+    for record in records:
+        total_cases = active_cases = total_deaths = total_recovered = 0
+        if str(record.get("total_cases")) != '':
+            total_cases = int(str(record.get("total_cases")).replace(',', ''))
+        if str(record.get("active_cases")) != '':
+            active_cases = int(str(record.get("active_cases")).replace(',', ''))
+        if str(record.get("total_deaths")) != '':
+            total_deaths = int(str(record.get("total_deaths")).replace(',', ''))
+        if str(record.get("total_recovered")) == '':
+            total_deaths = 0
+        elif str(record.get("total_recovered")) == "N/A":
+            total_recovered = total_cases - total_deaths - active_cases
+        else:
+            total_recovered = int(str(record.get("total_recovered")).replace(',', ''))
+        rows.append([record.get("record_date")[0:10], total_cases, total_deaths, active_cases, total_recovered,
+                     (float(total_cases) / population) * 100, (float(total_deaths) / population) * 100,
+                     (float(active_cases) / population) * 100])
+    return rows
+
+
+def _normalize_stage(size, vectorized):
+    def setup(ctx):
+        code = getattr(ctx.fixtures, size)
+        records = ctx.records[code]
+        population = ctx.directory.population(code) or 1
+
+        def run():
+            if vectorized:
+                import normalize
+                normalize.normalize_history(records, population)
+            else:
+                _normalize_loop(records, population)
+        return run, len(records)
+    return setup
+
+
+def _ingest_stage(size):
+    def setup(ctx):
+        code = getattr(ctx.fixtures, size)
+        name = ctx.ingest_setup(code)
+        records = ctx.records[code]
+
+        def run():
+            ctx.fp.add_history_sqlite(name, records=records)
+        return run, len(records)
+    return setup
+
+
+def _derived_stage(size, trailing):
+    ''' recompute the derived metrics of every day, or of the last day only
+    as after a new day is ingested '''
+    def setup(ctx):
+        import derived
+        import storage
+        code = getattr(ctx.fixtures, size)
+        ctx.fp.add_history_sqlite(ctx.ingest_setup(code), records=ctx.records[code])
+        conn = storage.connect(ctx.fp.DB_NAME)
+        times = [row[0] for row in conn.execute(
+            'SELECT Time FROM Status_history WHERE Country_code = ? ORDER BY Time', [code])]
+        since = times[-1] if trailing else times[0]
+
+        def run():
+            derived.refresh(conn, code, since)
+            conn.rollback()
+        return run, 1 if trailing else len(times)
+    return setup
+
+
+def _series_stage(size, metrics, source):
+    ''' get_series from the database ("sqlite"), from the mapped column store
+    file ("columns"), or from the column store with the file mapped afresh
+    every time ("columns_cold", as in a new process) '''
+    def setup(ctx):
+        code = getattr(ctx.fixtures, size)
+        ctx.fp.add_history_sqlite(ctx.ingest_setup(code), records=ctx.records[code])
+
+        def run():
+            ctx.fp.USE_COLUMN_STORE = source != "sqlite"
+            if source == "columns_cold":
+                ctx.fp.get_column_store()._mapped.clear()
+            ctx.fp.get_series(code, metrics)
+        return run, len(ctx.records[code])
+    return setup
+
+
+for _size in ("small", "large"):
+    stage("history_dedup_" + _size)(_dedup_stage(_size))
+    stage("normalize_loop_" + _size)(_normalize_stage(_size, False))
+    stage("normalize_vectorized_" + _size)(_normalize_stage(_size, True))
+    stage("add_history_sqlite_" + _size)(_ingest_stage(_size))
+    stage("derived_full_" + _size)(_derived_stage(_size, False))
+    stage("derived_trailing_" + _size)(_derived_stage(_size, True))
+    for _source, _prefix in (("sqlite", "get_series"), ("columns", "get_series_columns"),
+                             ("columns_cold", "get_series_columns_cold")):
+        stage("{}_one_{}".format(_prefix, _size))(_series_stage(_size, ["Total_cases"], _source))
+        stage("{}_all_{}".format(_prefix, _size))(_series_stage(_size, None, _source))
+
+
+def _figure_stage(dashboard):
+    def setup(ctx):
+        try:
+            import charts
+        except ImportError:
+            return None
+        code = ctx.fixtures.large
+        ctx.fp.add_history_sqlite(ctx.ingest_setup(code), records=ctx.records[code])
+        series = ctx.fp.get_series(code)
+
+        def run():
+            if dashboard:
+                charts.build_dashboard(series, ctx.fp.GRAPHICS, "dashboard")
+            else:
+                charts.build_figure(series["Time"], series["Total_cases"], "chart")
+        return run, len(series["Time"])
+    return setup
+
+
+def _comparison_stage(count, metric):
+    ''' get_comparison of `count` countries, every one ingested with a history
+    as long as the large reference country '''
+    def setup(ctx):
+        codes = ctx.ingest_everywhere()[:count]
+
+        def run():
+            ctx.fp.get_comparison(codes, metric, fill="previous")
+        return run, len(codes) * len(ctx.records[ctx.fixtures.large])
+    return setup
+
+
+for _count in (1, 10, 200):
+    stage("compare_{}".format(_count))(_comparison_stage(_count, "Total_cases"))
+    stage("compare_derived_{}".format(_count))(_comparison_stage(_count, "New_cases_7d"))
+
+
+def _export_stage(fmt):
+    ''' export_history of every country ingested by ingest_everywhere '''
+    def setup(ctx):
+        import export
+        if fmt != "csv":
+            try:
+                import pyarrow # noqa: F401
+            except ImportError:
+                return None
+        codes = ctx.ingest_everywhere()
+        path = ctx.scratch("." + fmt)
+
+        def run():
+            export.export_history(path, fmt)
+        return run, len(codes) * len(ctx.records[ctx.fixtures.large])
+    return setup
+
+
+for _format in ("csv", "parquet", "arrow"):
+    stage("export_" + _format)(_export_stage(_format))
+
+
+stage("figure_build")(_figure_stage(False))
+stage("dashboard_build")(_figure_stage(True))
+
+
+@stage("ingest_all_countries")
+def _ingest_all(ctx):
+    ''' every country of the directory ingested with a history as long as the
+    large reference country, only with --all-countries '''
+    if not ctx.options.all_countries:
+        return None
+    template = ctx.records[ctx.fixtures.large]
+    names = []
+    for code, country in ctx.directory.by_code.items():
+        if country["population"]:
+            names.append(ctx.ingest_setup(code))
+
+    def run():
+        for name in names:
+            ctx.fp.add_history_sqlite(name, records=template)
+    return run, len(names) * len(template)
+
+
+def run_stages(ctx, repeat, selected=None):
+    results = {}
+    for name, setup in STAGES:
+        if selected and name not in selected:
+            continue
+        prepared = setup(ctx)
+        if prepared is None:
+            continue
+        function, items = prepared
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        results[name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "max": max(times),
+            "repeat": repeat,
+            "items": items,
+        }
+        print("{:28} {:10.4f}s median {:10.4f}s min  ({} items)".format(
+            name, results[name]["median"], results[name]["min"], items), file=sys.stderr)
+    return results
+
+
+def compare(before, after, tolerance):
+    ''' print every stage of two runs side by side, returning False when one
+    got slower by more than `tolerance` (a fraction) '''
+    ok = True
+    for setting in ("fixtures", "history_scale", "all_countries"):
+        if before.get(setting) != after.get(setting):
+            print("note: {} differs between the runs ({} vs {})".format(
+                setting, before.get(setting), after.get(setting)))
+    print("{:28} {:>10} {:>10} {:>8}".format("stage", "before", "after", "change"))
+    for name in after["stages"]:
+        if name not in before["stages"]:
+            print("{:28} {:>10} {:10.4f}".format(name, "-", after["stages"][name]["median"]))
+            continue
+        old = before["stages"][name]["median"]
+        new = after["stages"][name]["median"]
+        change = (new - old) / old if old else 0.0
+        regressed = change > tolerance
+        ok = ok and not regressed
+        print("{:28} {:10.4f} {:10.4f} {:+7.0%}{}".format(
+            name, old, new, change, "  REGRESSION" if regressed else ""))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage")
+    parser.add_argument("--history-scale", type=int, default=1, help="multiply every history length")
+    parser.add_argument("--countries", type=int, default=200, help="countries in synthetic fixtures")
+    parser.add_argument("--all-countries", action="store_true", help="also ingest a long history for every country")
+    parser.add_argument("--synthetic", action="store_true", help="ignore recorded fixtures")
+    parser.add_argument("--stages", help="comma separated stage names, default all")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two --json results")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown (fraction) reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            sys.exit(0 if compare(json.load(before), json.load(after), args.tolerance) else 1)
+
+    fixtures = fixture_loader.load(args.history_scale, args.countries, prefer_recorded=not args.synthetic)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            ctx = Context(fixtures, args, workdir)
+            results = run_stages(ctx, args.repeat, args.stages.split(",") if args.stages else None)
+        finally:
+            os.chdir(cwd)
+    report = {
+        "fixtures": fixtures.source,
+        "history_scale": args.history_scale,
+        "all_countries": args.all_countries,
+        "python": platform.python_version(),
+        "stages": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+'''Startup benchmark: how long `import final_project` takes, which heavy
+modules it pulls in, and how long the interactive session takes to show
+its first prompt.
+
+    python benchmarks/bench_startup.py [--runs 10] [--json out.json] [--compare baseline.json]
+
+Every measurement runs in a fresh interpreter inside a temporary directory,
+so no cache or database of the working tree is touched.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["bs4", "requests", "plotly", "numpy"]
+FIRST_PROMPT = b"Enter an initial letter"
+
+IMPORT_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import final_project
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed,
+                  "heavy": [m for m in %r if m in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+def _env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([REPO_DIR] + [p for p in [env.get("PYTHONPATH")] if p])
+    return env
+
+
+def measure_import(workdir):
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=workdir, env=_env(),
+                            check=True, capture_output=True).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure_first_prompt(workdir):
+    ''' seconds from launching the interactive session to its first prompt '''
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "final_project.py")],
+                               cwd=workdir, env=_env(), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    seen = b""
+    while FIRST_PROMPT not in seen:
+        chunk = process.stdout.read1(1024)
+        if not chunk:
+            process.wait()
+            raise RuntimeError("the session exited before its first prompt")
+        seen += chunk
+    elapsed = time.perf_counter() - start
+    process.communicate(b"exit\n", timeout=30)
+    return elapsed
+
+
+def run(runs):
+    imports = []
+    prompts = []
+    heavy = set()
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            result = measure_import(workdir)
+            imports.append(result["seconds"])
+            heavy.update(result["heavy"])
+            prompts.append(measure_first_prompt(workdir))
+    return {
+        "runs": runs,
+        "import_seconds": {"median": statistics.median(imports), "min": min(imports)},
+        "first_prompt_seconds": {"median": statistics.median(prompts), "min": min(prompts)},
+        "heavy_modules_on_import": sorted(heavy),
+    }
+
+
+def compare(result, baseline, tolerance):
+    ''' print the change of every median against a baseline run, returning
+    False when one got slower by more than `tolerance` (a fraction) '''
+    ok = True
+    for key in ("import_seconds", "first_prompt_seconds"):
+        before = baseline[key]["median"]
+        after = result[key]["median"]
+        change = (after - before) / before if before else 0.0
+        regressed = change > tolerance
+        ok = ok and not regressed
+        print("{:22} {:8.4f}s -> {:8.4f}s ({:+.0%}){}".format(
+            key, before, after, change, "  REGRESSION" if regressed else ""))
+    new_heavy = set(result["heavy_modules_on_import"]) - set(baseline["heavy_modules_on_import"])
+    if new_heavy:
+        ok = False
+        print("heavy modules now imported at startup: " + ", ".join(sorted(new_heavy)))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="a previous --json result to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown (fraction) reported as a regression")
+    args = parser.parse_args()
+
+    result = run(args.runs)
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(result, out, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if not compare(result, json.load(baseline_file), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
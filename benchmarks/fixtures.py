@@ -0,0 +1,248 @@
+'''Fixtures for the offline benchmarks: the worldometers letter pages, the
+countrycode.org page and latest/history API payloads.
+
+Recorded fixtures live in benchmarks/fixtures/ and are used when present:
+
+    python benchmarks/fixtures.py record --codes US,LU
+
+fetches the real pages and the payloads of the given countries (the API key
+comes from secrets.py). Without recorded files, synthetic fixtures with the
+same markup and payload layout are generated; they are deterministic, so two
+runs on the same code measure the same work.
+'''
+import argparse
+import json
+import os
+import random
+import string
+import sys
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+
+# history length of the two synthetic reference countries, before scaling
+SMALL_DAYS = 120
+LARGE_DAYS = 1000
+LARGE_RECORDS_PER_DAY = 4
+# markup around the table, to give synthetic pages the weight of real ones
+PAGE_PADDING = 60 * 1024
+
+
+class Fixtures:
+    ''' everything a benchmark run replays
+
+    Attributes
+    ----------
+    letter_pages
+        dic: letter -> worldometers page
+    country_code_page
+        str: the countrycode.org page
+    histories
+        dic: 2 letter code -> raw history payload (bytes)
+    latest
+        dic: 2 letter code -> raw latest status payload (bytes)
+    small, large
+        str: codes of a short and a long history
+    source
+        str: 'recorded' or 'synthetic'
+    '''
+
+    def __init__(self, letter_pages, country_code_page, histories, latest, small, large, source):
+        self.letter_pages = letter_pages
+        self.country_code_page = country_code_page
+        self.histories = histories
+        self.latest = latest
+        self.small = small
+        self.large = large
+        self.source = source
+
+
+def _padding(rng):
+    words = ["<div class='ad-slot'><script>var slot=%d;</script></div>" % rng.randrange(10 ** 6)
+             for _ in range(PAGE_PADDING // 48)]
+    return "\n".join(words)
+
+
+def _synthetic_countries(count, rng):
+    ''' (name, code, population) for `count` made up countries, their names
+    spread over every initial letter '''
+    codes = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase]
+    rng.shuffle(codes)
+    countries = []
+    for i in range(count):
+        letter = string.ascii_uppercase[i % 26]
+        name = letter + "".join(rng.choice("aeioulmnrst") for _ in range(rng.randint(4, 9)))
+        if i % 7 == 0:
+            name += " " + rng.choice(["Islands", "Republic", "Coast"])
+        countries.append((name + " " + str(i), codes[i], rng.randint(10 ** 4, 10 ** 9)))
+    return countries
+
+
+def _letter_page(rows, rng):
+    body = "".join("<tr><td>{}</td><td>{}</td><td>{:,}</td><td>1,000</td></tr>".format(number, name, population)
+                   for number, (name, population) in enumerate(rows, 1))
+    return ("<html><head><title>Countries</title></head><body>{pad}"
+            "<div class=\"table-responsive\"><table class=\"table\"><thead><tr><th>#</th><th>Country</th>"
+            "<th>Population</th><th>Area</th></tr></thead><tbody>{body}</tbody></table></div>"
+            "{pad}</body></html>").format(pad=_padding(rng), body=body)
+
+
+def _country_code_page(countries, rng):
+    body = "".join("<tr><td><a href='/{c}'>{n}</a></td><td>{p}</td><td>{c} / {c}X</td><td>{pop:,}</td></tr>".format(
+        n=name, c=code, p=rng.randint(1, 999), pop=population) for name, code, population in countries)
+    return ("<html><body>{pad}<table class=\"table table-hover table-striped main-table\"><thead><tr>"
+            "<th>Country</th><th>Code</th><th>ISO</th><th>Population</th></tr></thead><tbody>{body}"
+            "</tbody></table>{pad}</body></html>").format(pad=_padding(rng), body=body)
+
+
+def history_payload(code, days, records_per_day, rng):
+    ''' a history_by_alpha_2 style payload, oldest record first '''
+    records = []
+    cases = deaths = 0
+    start = date(2020, 1, 22)
+    for day in range(days):
+        for part in range(records_per_day):
+            cases += rng.randint(0, 500)
+            deaths += rng.randint(0, 10)
+            active = max(0, cases - deaths - cases // 2)
+            recovered = "N/A" if rng.random() < 0.1 else "{:,}".format(cases - deaths - active)
+            records.append({
+                "id": str(len(records)),
+                "country_name": code,
+                "total_cases": "{:,}".format(cases),
+                "new_cases": str(rng.randint(0, 500)),
+                "active_cases": "{:,}".format(active) if rng.random() > 0.02 else "",
+                "total_deaths": "{:,}".format(deaths),
+                "new_deaths": str(rng.randint(0, 10)),
+                "total_recovered": recovered,
+                "serious_critical": str(rng.randint(0, 100)),
+                "region": None,
+                "total_cases_per1m": "{:.1f}".format(cases / 1000.0),
+                "record_date": "{} {:02d}:{:02d}:00.000".format(
+                    (start + timedelta(days=day)).isoformat(), 6 * part, rng.randint(0, 59)),
+            })
+    return json.dumps({"alpha2": code, "stat_by_country": records}).encode()
+
+
+def synthetic(country_count=200, history_scale=1, seed=507):
+    ''' generate a full set of fixtures
+
+    Parameters
+    ----------
+    country_count
+        int: countries in the pages
+    history_scale
+        int: multiplies the history length of every country
+    seed
+        int: the random seed
+
+    Returns
+    -------
+    Fixtures
+    '''
+    rng = random.Random(seed)
+    countries = _synthetic_countries(country_count, rng)
+    by_letter = {}
+    for name, code, population in countries:
+        by_letter.setdefault(name[0].lower(), []).append((name, population))
+    letter_pages = {letter: _letter_page(by_letter.get(letter, []), rng) for letter in string.ascii_lowercase}
+    small, large = countries[0][1], countries[1][1]
+    histories = {
+        small: history_payload(small, SMALL_DAYS * history_scale, 1, rng),
+        large: history_payload(large, LARGE_DAYS * history_scale, LARGE_RECORDS_PER_DAY, rng),
+    }
+    latest = {code: json.dumps({"alpha2": code, "latest_stat_by_country": json.loads(payload)["stat_by_country"][-1:]}).encode()
+              for code, payload in histories.items()}
+    return Fixtures(letter_pages, _country_code_page(countries, rng), histories, latest,
+                    small, large, "synthetic")
+
+
+def recorded(fixture_dir=FIXTURE_DIR):
+    ''' load recorded fixtures, None when there are none '''
+    manifest_path = os.path.join(fixture_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    def read(name, mode="r"):
+        with open(os.path.join(fixture_dir, name), mode) as fixture:
+            return fixture.read()
+
+    letter_pages = {letter: read("letter_{}.html".format(letter)) for letter in string.ascii_lowercase}
+    histories = {code: read("history_{}.json".format(code), "rb") for code in manifest["codes"]}
+    latest = {code: read("latest_{}.json".format(code), "rb") for code in manifest["codes"]}
+    return Fixtures(letter_pages, read("countrycode.html"), histories, latest,
+                    manifest["small"], manifest["large"], "recorded")
+
+
+def scale_history(payload, factor):
+    ''' repeat a recorded history `factor` times, shifting each copy by its
+    length in days, to benchmark longer histories than exist '''
+    if factor == 1:
+        return payload
+    contents = json.loads(payload)
+    key = "stat_by_country"
+    records = contents[key]
+    first = date.fromisoformat(records[0]["record_date"][:10])
+    span = (date.fromisoformat(records[-1]["record_date"][:10]) - first).days + 1
+    scaled = []
+    for copy in range(factor):
+        for record in records:
+            day = date.fromisoformat(record["record_date"][:10]) + timedelta(days=span * copy)
+            scaled.append(dict(record, record_date=day.isoformat() + record["record_date"][10:]))
+    contents[key] = scaled
+    return json.dumps(contents).encode()
+
+
+def load(history_scale=1, country_count=200, prefer_recorded=True):
+    ''' recorded fixtures when there are some, synthetic ones otherwise '''
+    fixtures = recorded() if prefer_recorded else None
+    if fixtures is None:
+        return synthetic(country_count, history_scale)
+    fixtures.histories = {code: scale_history(payload, history_scale)
+                          for code, payload in fixtures.histories.items()}
+    return fixtures
+
+
+def record(codes, small, large, fixture_dir=FIXTURE_DIR):
+    ''' fetch the real pages and payloads into fixture_dir '''
+    sys.path.insert(0, REPO_DIR)
+    import final_project
+    import http_client
+    from country_directory import COUNTRY_CODE_URL, WORLDOMETERS_URL
+
+    os.makedirs(fixture_dir, exist_ok=True)
+
+    def write(name, contents):
+        with open(os.path.join(fixture_dir, name), "wb") as fixture:
+            fixture.write(contents)
+
+    for letter in string.ascii_lowercase:
+        write("letter_{}.html".format(letter), http_client.request(WORLDOMETERS_URL.format(letter=letter)).content)
+    write("countrycode.html", http_client.request(COUNTRY_CODE_URL).content)
+    headers = {'x-rapidapi-host': final_project.API_HOST, 'x-rapidapi-key': final_project.consumer_key}
+    for code in codes:
+        for name, url in (("history", final_project.HISTORY_URL), ("latest", final_project.LATEST_STATUS_URL)):
+            response = http_client.request(url, params={"alpha2": code}, headers=headers)
+            response.raise_for_status()
+            write("{}_{}.json".format(name, code), response.content)
+    with open(os.path.join(fixture_dir, "manifest.json"), "w") as manifest_file:
+        json.dump({"codes": codes, "small": small, "large": large}, manifest_file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record benchmark fixtures from the live sites")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record")
+    record_parser.add_argument("--codes", default="LU,US",
+                               help="comma separated codes, the first is the small country, the last the large one")
+    args = parser.parse_args()
+    codes = args.codes.upper().split(",")
+    record(codes, codes[0], codes[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+'''Load test of the HTTP service (final_project.py serve): many concurrent
+keep-alive clients replaying a mix of requests, reporting throughput and
+latency percentiles.
+
+    python benchmarks/load_test.py --offline [--concurrency 50] [--requests 5000] [--no-cache]
+    python benchmarks/load_test.py --url http://127.0.0.1:8507 --codes US,GB [--charts]
+
+--offline starts the service in a child process on the benchmark fixtures
+(see fixtures.py) in a temporary directory, so nothing is fetched.
+'''
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fixtures as fixture_loader  # noqa: E402
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def default_paths(codes, letters, charts):
+    paths = ["/countries?letter=" + letter for letter in letters]
+    for code in codes:
+        paths += ["/status/" + code, "/series/" + code, "/series/" + code + "?metrics=Total_cases"]
+        if charts:
+            paths += ["/chart/" + code + "/Total_cases"]
+    return paths
+
+
+async def _request(reader, writer, host, path):
+    writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(path, host).encode("latin-1"))
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def _client(host, port, paths, offset, deadline, budget, results):
+    ''' one keep-alive connection sending requests back to back, cycling
+    through the paths from `offset` '''
+    reader, writer = await asyncio.open_connection(host, port)
+    index = offset
+    try:
+        while time.perf_counter() < deadline and budget[0] > 0:
+            budget[0] -= 1
+            path = paths[index % len(paths)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                status = await _request(reader, writer, host, path)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                results.append((path, time.perf_counter() - start, 0))
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            results.append((path, time.perf_counter() - start, status))
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, paths, concurrency, requests, duration):
+    ''' send `requests` requests (or as many as fit in `duration` seconds)
+    over `concurrency` connections
+
+    Returns
+    -------
+    tuple: (path, seconds, status) per request and the elapsed seconds
+    '''
+    results = []
+    budget = [requests if requests else float("inf")]
+    deadline = time.perf_counter() + duration if duration else float("inf")
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, paths, i, deadline, budget, results)
+                           for i in range(concurrency)])
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    latencies = [seconds for _, seconds, _ in results]
+    errors = sum(1 for _, _, status in results if status != 200)
+    report = {
+        "requests": len(results),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p90": percentile(latencies, 0.90) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": max(latencies) * 1000 if latencies else 0.0,
+        },
+        "paths": {},
+    }
+    by_path = {}
+    for path, seconds, status in results:
+        by_path.setdefault(path, []).append((seconds, status))
+    for path, samples in sorted(by_path.items()):
+        report["paths"][path] = {
+            "requests": len(samples),
+            "errors": sum(1 for _, status in samples if status != 200),
+            "p99_ms": percentile([seconds for seconds, _ in samples], 0.99) * 1000,
+        }
+    return report
+
+
+def _serve_fixtures(port_queue, workdir, history_scale, cache_size):
+    ''' the child process of --offline: the service over the fixtures '''
+    from history_stream import iter_payload_records, last_record_per_day
+    fixtures = fixture_loader.load(history_scale)
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w") # keep "Using cache" lines out of the report
+    import final_project
+    import service
+    from country_directory import CountryDirectory
+    final_project.COUNTRY_DIRECTORY = CountryDirectory.from_pages(fixtures.country_code_page, fixtures.letter_pages)
+    for code, payload in fixtures.histories.items():
+        records = list(last_record_per_day(iter_payload_records([payload])))
+        final_project.CACHE_DICT.set(final_project.HISTORY_URL + code, records)
+    service.serve("127.0.0.1", 0, ready=port_queue.put, cache_size=cache_size)
+
+
+def start_offline(workdir, history_scale, cache_size):
+    ''' start the service on the fixtures, returning the process, the port,
+    the fixture country codes and a letter with countries '''
+    fixtures = fixture_loader.load(history_scale)
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_fixtures,
+                                      args=(port_queue, workdir, history_scale, cache_size), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=120)
+    codes = [fixtures.small, fixtures.large]
+    letters = sorted(letter for letter, page in fixtures.letter_pages.items() if "<tbody><tr>" in page)[:3] or ["a"]
+    return process, port, codes, letters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8507", help="a running service")
+    parser.add_argument("--offline", action="store_true", help="start the service on the fixtures instead")
+    parser.add_argument("--codes", default="US,GB", help="country codes requested from a running service")
+    parser.add_argument("--letters", default="a,u", help="initial letters requested from a running service")
+    parser.add_argument("--paths", help="comma separated paths, replacing the default mix")
+    parser.add_argument("--charts", action="store_true", help="add chart requests to the mix")
+    parser.add_argument("--concurrency", type=int, default=50, help="connections sending requests at once")
+    parser.add_argument("--requests", type=int, default=5000, help="requests in total, 0 to run for --duration")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run instead of a request count")
+    parser.add_argument("--warmup", type=int, default=1, help="rounds over every path before measuring")
+    parser.add_argument("--history-scale", type=int, default=1, help="with --offline, multiply history lengths")
+    parser.add_argument("--no-cache", action="store_true", help="with --offline, disable the response cache")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    process = None
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.offline:
+                process, port, codes, letters = start_offline(workdir, args.history_scale,
+                                                              0 if args.no_cache else 1024)
+                host = "127.0.0.1"
+            else:
+                url = urlsplit(args.url)
+                host, port = url.hostname, url.port or 80
+                codes, letters = args.codes.upper().split(","), args.letters.lower().split(",")
+            paths = args.paths.split(",") if args.paths else default_paths(codes, letters, args.charts)
+            if args.warmup:
+                asyncio.run(run_load(host, port, paths, 1, len(paths) * args.warmup, None))
+            results, elapsed = asyncio.run(run_load(host, port, paths, args.concurrency,
+                                                    0 if args.duration else args.requests, args.duration))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+    report = summarize(results, elapsed)
+    report.update({"concurrency": args.concurrency, "offline": args.offline,
+                   "response_cache": not args.no_cache})
+    print("{} requests, {} errors, {:.0f} req/s, p50 {:.1f} ms, p99 {:.1f} ms".format(
+        report["requests"], report["errors"], report["throughput"],
+        report["latency_ms"]["p50"], report["latency_ms"]["p99"]), file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+'''Stress test of the storage layer under several processes: one writer
+keeps ingesting histories (changing the last day every other time),
+rewriting cache entries and saving the country directory while reader
+processes query series, statuses, cache entries and the directory file.
+Readers check that the history and derived metrics they get agree. Every
+error and the read latencies are reported.
+
+    python benchmarks/stress_storage.py [--readers 4] [--duration 10] [--journal-mode delete]
+
+Runs on the benchmark fixtures (see fixtures.py) in a temporary directory.
+Exits with status 1 when any process hit an error.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fixtures as fixture_loader  # noqa: E402
+
+
+def _open(workdir, journal_mode):
+    ''' final_project working in workdir, its storage in journal_mode '''
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")
+    import storage
+    storage.JOURNAL_MODE = journal_mode
+    import final_project
+    from country_directory import CountryDirectory
+    final_project.COUNTRY_DIRECTORY = CountryDirectory.load(final_project.COUNTRY_DIRECTORY_FILE)
+    return final_project
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def _run(role, function, duration, results):
+    ''' call function() until duration is over, timing each call and
+    counting failures instead of stopping at the first one '''
+    latencies = []
+    errors = {}
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            function()
+        except Exception as error:
+            message = "{}: {}".format(type(error).__name__, error)
+            errors[message] = errors.get(message, 0) + 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    results.put({
+        "role": role,
+        "operations": len(latencies),
+        "errors": errors,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    })
+
+
+def writer(workdir, journal_mode, duration, codes, results):
+    final_project = _open(workdir, journal_mode)
+    directory = final_project.COUNTRY_DIRECTORY
+    records = {code: final_project.CACHE_DICT.get(final_project.HISTORY_URL + code) for code in codes}
+    names = {code: directory.name_for(code) for code in codes}
+    # every other ingestion changes the last day, so new versions keep being written
+    changed = {code: records[code][:-1] + [dict(records[code][-1], total_cases=str(
+        final_project.parse_count(records[code][-1]["total_cases"]) + 1))] for code in codes}
+    rounds = [0]
+
+    def ingest():
+        rounds[0] += 1
+        for code in codes:
+            version = changed[code] if rounds[0] % 2 else records[code]
+            final_project.add_history_sqlite(names[code], records=version)
+            final_project.CACHE_DICT.set(final_project.HISTORY_URL + code, version)
+        directory.save(final_project.COUNTRY_DIRECTORY_FILE)
+
+    _run("writer", ingest, duration, results)
+
+
+def reader(workdir, journal_mode, duration, codes, results, number):
+    final_project = _open(workdir, journal_mode)
+    from country_directory import CountryDirectory
+
+    def read():
+        for code in codes:
+            series = final_project.get_series(code)
+            if not len(series["Time"]):
+                raise AssertionError("empty series for " + code)
+            cases = series["Total_cases"]
+            if len(cases) > 1 and series["New_cases"][-1] != cases[-1] - cases[-2]:
+                raise AssertionError("history and derived metrics of different versions for " + code)
+            final_project.status_from_history(code)
+            if final_project.CACHE_DICT.get(final_project.HISTORY_URL + code) is None:
+                raise AssertionError("cache entry missing for " + code)
+        CountryDirectory.load(final_project.COUNTRY_DIRECTORY_FILE)
+
+    _run("reader{}".format(number), read, duration, results)
+
+
+def prepare(workdir, journal_mode, history_scale):
+    ''' the directory file, the cached histories and an ingested database,
+    done in a child process so the parent never holds a connection '''
+    from history_stream import iter_payload_records, last_record_per_day
+    from country_directory import CountryDirectory
+    fixtures = fixture_loader.load(history_scale)
+    os.chdir(workdir)
+    CountryDirectory.from_pages(fixtures.country_code_page, fixtures.letter_pages).save("country_directory.json")
+    final_project = _open(workdir, journal_mode)
+    final_project.create_db()
+    for code, payload in fixtures.histories.items():
+        records = list(last_record_per_day(iter_payload_records([payload])))
+        final_project.CACHE_DICT.set(final_project.HISTORY_URL + code, records)
+        final_project.ingest_country(final_project.COUNTRY_DIRECTORY.name_for(code))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=4, help="reader processes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds every process runs")
+    parser.add_argument("--history-scale", type=int, default=1, help="multiply history lengths")
+    parser.add_argument("--journal-mode", default="wal", help="sqlite journal mode, e.g. delete to compare")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    codes = list(fixture_loader.load(args.history_scale).histories)
+    with tempfile.TemporaryDirectory() as workdir:
+        setup = multiprocessing.Process(target=prepare, args=(workdir, args.journal_mode, args.history_scale))
+        setup.start()
+        setup.join()
+        if setup.exitcode:
+            sys.exit("setup failed")
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer,
+                                             args=(workdir, args.journal_mode, args.duration, codes, results))]
+        processes += [multiprocessing.Process(target=reader,
+                                              args=(workdir, args.journal_mode, args.duration, codes, results, i))
+                      for i in range(args.readers)]
+        for process in processes:
+            process.start()
+        reports = [results.get(timeout=args.duration + 300) for _ in processes]
+        for process in processes:
+            process.join()
+
+    reports.sort(key=lambda report: report["role"])
+    failed = False
+    for report in reports:
+        error_count = sum(report["errors"].values())
+        failed = failed or error_count > 0
+        print("{:10} {:6} ops {:4} errors  p50 {:8.1f} ms  p99 {:8.1f} ms  max {:8.1f} ms".format(
+            report["role"], report["operations"], error_count,
+            report["p50_ms"], report["p99_ms"], report["max_ms"]), file=sys.stderr)
+        for message, count in report["errors"].items():
+            print("    {} x {}".format(count, message), file=sys.stderr)
+    summary = {"journal_mode": args.journal_mode, "readers": args.readers,
+               "duration": args.duration, "processes": reports}
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(summary, out, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+import json
+import os
+import functools
+import threading
+import time
+import zlib
+
+import storage
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# values whose JSON is at least this long are stored compressed
+COMPRESS_MIN_BYTES = 4 * 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# a read only records its access time when the stored one is older than
+# this, so hits on a shared cache are not all writes
+ACCESS_RESOLUTION = 60
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def encode_value(value, min_bytes=COMPRESS_MIN_BYTES):
+    ''' serialize a value for the Value column, compressing it with zstd
+    (when the zstandard package is installed) or zlib once its JSON is at
+    least min_bytes long and compression actually shrinks it
+
+    Returns
+    -------
+    tuple: the stored str or bytes and its encoding, None for plain JSON
+    '''
+    contents = json.dumps(value)
+    if min_bytes is None or len(contents) < min_bytes:
+        return contents, None
+    raw = contents.encode('utf-8')
+    zstandard = _zstd()
+    if zstandard is not None:
+        packed, encoding = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), 'zstd'
+    else:
+        packed, encoding = zlib.compress(raw, ZLIB_LEVEL), 'zlib'
+    if len(packed) >= len(raw):
+        return contents, None
+    return packed, encoding
+
+
+def decode_value(stored, encoding):
+    ''' the value back from a Value column written by encode_value '''
+    if encoding is None:
+        return json.loads(stored)
+    if encoding == 'zlib':
+        return json.loads(zlib.decompress(stored))
+    if encoding == 'zstd':
+        zstandard = _zstd()
+        if zstandard is None:
+            raise ValueError("cache entry is zstd compressed but zstandard is not installed")
+        return json.loads(zstandard.ZstdDecompressor().decompress(stored))
+    raise ValueError("unknown cache entry encoding " + repr(encoding))
+
+
+def _locked(method):
+    ''' run a CacheStore method holding the store lock '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class CacheStore:
+    ''' a key/value cache kept in a SQLite table, one row per entry
+
+    Entries are written one at a time when they are added and read back
+    lazily by key, so neither startup nor a cache miss touches the rest
+    of the cache. Every entry can carry its own time-to-live, and the
+    least recently used entries are evicted once the stored values grow
+    past max_bytes. Expired entries are kept, with the ETag and
+    Last-Modified they were fetched with, until they are evicted, so they
+    can be revalidated instead of downloaded again. Large values, such as
+    API histories, are stored compressed.
+
+    Parameters
+    ----------
+    path
+        str: the sqlite file the cache lives in
+    max_bytes
+        int: size budget for the stored values, None for no limit
+    default_ttl
+        float: seconds an entry stays valid when set() gets no ttl,
+        None for entries that never expire
+    legacy_json
+        str: an old single-file JSON cache, imported when the store is
+        first opened and still empty
+    compress_min_bytes
+        int: values whose JSON is at least this long are stored compressed,
+        None to store everything as plain JSON
+
+    Nothing is opened or read until the first access. One store can be
+    shared by several threads; they take turns on its connection. Several
+    processes can use the same file: it is opened with storage.connect
+    (WAL, busy timeout), and reads only write their access time once per
+    ACCESS_RESOLUTION seconds.
+    '''
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, default_ttl=None, legacy_json=None,
+                 compress_min_bytes=COMPRESS_MIN_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.legacy_json = legacy_json
+        self.compress_min_bytes = compress_min_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @_locked
+    def _connect(self):
+        if self._conn is None:
+            self._conn = storage.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS "Cache_entries" (
+                    "Key" TEXT NOT NULL,
+                    "Value" TEXT NOT NULL,
+                    "Size" INTEGER NOT NULL,
+                    "Stored_at" REAL NOT NULL,
+                    "Expires_at" REAL,
+                    "Last_access" REAL NOT NULL,
+                    PRIMARY KEY("Key")
+                )
+            ''')
+            self._conn.execute('''
+                CREATE INDEX IF NOT EXISTS "Cache_entries_last_access"
+                ON "Cache_entries" ("Last_access")
+            ''')
+            columns = [row[1] for row in self._conn.execute(
+                'PRAGMA table_info("Cache_entries")')]
+            for column in ('Etag', 'Last_modified', 'Encoding'):
+                if column not in columns:
+                    self._conn.execute(
+                        'ALTER TABLE Cache_entries ADD COLUMN "{}" TEXT'.format(column))
+            self._conn.commit()
+            if self.legacy_json and os.path.exists(self.legacy_json) and len(self) == 0:
+                try:
+                    self.import_json(self.legacy_json)
+                except ValueError:
+                    pass
+        return self._conn
+
+    @_locked
+    def get(self, key, default=None):
+        ''' look up one entry, counting a hit or a miss
+
+        Parameters
+        ----------
+        key
+            str: the cache key
+        default
+            value returned when the key is missing or expired
+
+        Returns
+        -------
+        the cached value, or default
+        '''
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            'SELECT Value, Expires_at, Encoding, Last_access FROM Cache_entries WHERE Key = ?',
+            [key]).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        value, expires_at, encoding, last_access = row
+        if expires_at is not None and expires_at <= now:
+            self.misses += 1
+            return default
+        if now - last_access >= ACCESS_RESOLUTION:
+            conn.execute('UPDATE Cache_entries SET Last_access = ? WHERE Key = ?',
+                         [now, key])
+            conn.commit()
+        self.hits += 1
+        return decode_value(value, encoding)
+
+    @_locked
+    def get_entry(self, key):
+        ''' look up one entry with its metadata, expired or not, without
+        counting a hit or a miss
+
+        Returns
+        -------
+        dic: value, stored_at, expires_at, etag and last_modified, None when
+        the key is missing
+        '''
+        row = self._connect().execute('''
+            SELECT Value, Stored_at, Expires_at, Etag, Last_modified, Encoding
+            FROM Cache_entries WHERE Key = ?
+        ''', [key]).fetchone()
+        if row is None:
+            return None
+        return {
+            'value': decode_value(row[0], row[5]),
+            'stored_at': row[1],
+            'expires_at': row[2],
+            'etag': row[3],
+            'last_modified': row[4],
+        }
+
+    @_locked
+    def set(self, key, value, ttl=None, etag=None, last_modified=None):
+        ''' write one entry, then evict if the cache is over budget
+
+        Parameters
+        ----------
+        key
+            str: the cache key
+        value
+            any JSON serializable value
+        ttl
+            float: seconds the entry stays valid, defaults to default_ttl
+        etag
+            str: the ETag the value was served with
+        last_modified
+            str: the Last-Modified the value was served with
+
+        Returns
+        -------
+        None
+        '''
+        conn = self._connect()
+        now = time.time()
+        if ttl is None:
+            ttl = self.default_ttl
+        expires_at = None if ttl is None else now + ttl
+        contents, encoding = encode_value(value, self.compress_min_bytes)
+        conn.execute('''
+            INSERT OR REPLACE INTO Cache_entries
+            (Key, Value, Size, Stored_at, Expires_at, Last_access, Etag, Last_modified, Encoding)
+            VALUES (?,?,?,?,?,?,?,?,?)
+        ''', [key, contents, len(contents), now, expires_at, now, etag, last_modified, encoding])
+        conn.commit()
+        self._evict()
+
+    @_locked
+    def rewrite(self, key, value):
+        ''' replace the value of an entry, keeping when it was stored, when
+        it expires and its validators, e.g. to swap a stored page for the
+        records extracted from it
+
+        Returns
+        -------
+        None
+        '''
+        contents, encoding = encode_value(value, self.compress_min_bytes)
+        conn = self._connect()
+        conn.execute('''
+            UPDATE Cache_entries SET Value = ?, Size = ?, Encoding = ?
+            WHERE Key = ?
+        ''', [contents, len(contents), encoding, key])
+        conn.commit()
+
+    @_locked
+    def revalidated(self, key, ttl=None):
+        ''' give an entry the server confirmed unchanged a new lease; its
+        value and Stored_at stay as they are
+
+        Parameters
+        ----------
+        key
+            str: the cache key
+        ttl
+            float: seconds the entry stays valid, defaults to default_ttl
+
+        Returns
+        -------
+        None
+        '''
+        now = time.time()
+        if ttl is None:
+            ttl = self.default_ttl
+        expires_at = None if ttl is None else now + ttl
+        conn = self._connect()
+        conn.execute('''
+            UPDATE Cache_entries SET Expires_at = ?, Last_access = ?
+            WHERE Key = ?
+        ''', [expires_at, now, key])
+        conn.commit()
+
+    @_locked
+    def stored_at(self, key):
+        ''' when a live entry was written, without loading its value or
+        counting a hit
+
+        Returns
+        -------
+        float: the write time as a unix timestamp, None when the key is
+        missing or expired
+        '''
+        row = self._connect().execute(
+            'SELECT Stored_at, Expires_at FROM Cache_entries WHERE Key = ?',
+            [key]).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    @_locked
+    def stored_times(self, prefix=''):
+        ''' when every entry whose key starts with prefix was written, expired
+        or not, without loading any value
+
+        Returns
+        -------
+        dic: key -> write time as a unix timestamp
+        '''
+        return dict(self._connect().execute(
+            'SELECT Key, Stored_at FROM Cache_entries WHERE Key >= ? AND Key < ?',
+            [prefix, prefix + '\U0010ffff']))
+
+    @_locked
+    def __contains__(self, key):
+        row = self._connect().execute(
+            'SELECT Expires_at FROM Cache_entries WHERE Key = ?',
+            [key]).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    @_locked
+    def __delitem__(self, key):
+        conn = self._connect()
+        conn.execute('DELETE FROM Cache_entries WHERE Key = ?', [key])
+        conn.commit()
+
+    @_locked
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM Cache_entries').fetchone()[0]
+
+    @_locked
+    def keys(self):
+        return [row[0] for row in self._connect().execute(
+            'SELECT Key FROM Cache_entries')]
+
+    def _evict(self):
+        ''' drop expired entries, then least recently used ones until the
+        stored values fit in max_bytes
+        '''
+        if self.max_bytes is None:
+            return
+        conn = self._connect()
+        total = conn.execute(
+            'SELECT COALESCE(SUM(Size), 0) FROM Cache_entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        expired = conn.execute(
+            'DELETE FROM Cache_entries WHERE Expires_at <= ?',
+            [time.time()]).rowcount
+        self.evictions += expired
+        total = conn.execute(
+            'SELECT COALESCE(SUM(Size), 0) FROM Cache_entries').fetchone()[0]
+        victims = []
+        if total > self.max_bytes:
+            for key, size in conn.execute(
+                    'SELECT Key, Size FROM Cache_entries ORDER BY Last_access'):
+                victims.append([key])
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            conn.executemany('DELETE FROM Cache_entries WHERE Key = ?', victims)
+            self.evictions += len(victims)
+        conn.commit()
+
+    @_locked
+    def import_json(self, json_path):
+        ''' copy every entry of an old single-file JSON cache into the store
+
+        Parameters
+        ----------
+        json_path
+            str: path of the JSON cache file
+
+        Returns
+        -------
+        int: the number of entries imported
+        '''
+        with open(json_path, 'r') as cache_file:
+            legacy = json.load(cache_file)
+        # the file does not say when each entry was fetched, its last write
+        # is the newest any of them can be; refreshes then see them as old
+        stored_at = os.path.getmtime(json_path)
+        conn = self._connect()
+        now = time.time()
+        rows = []
+        for key, value in legacy.items():
+            contents, encoding = encode_value(value, self.compress_min_bytes)
+            rows.append([key, contents, len(contents), stored_at, None, now, encoding])
+        conn.executemany('''
+            INSERT OR REPLACE INTO Cache_entries
+            (Key, Value, Size, Stored_at, Expires_at, Last_access, Encoding)
+            VALUES (?,?,?,?,?,?,?)
+        ''', rows)
+        conn.commit()
+        self._evict()
+        return len(rows)
+
+    @_locked
+    def compact(self):
+        ''' compress every entry stored as plain JSON that is long enough,
+        then give the freed pages back to the file system
+
+        Returns
+        -------
+        int: the number of entries compressed
+        '''
+        conn = self._connect()
+        if self.compress_min_bytes is None:
+            return 0
+        keys = [row[0] for row in conn.execute(
+            'SELECT Key FROM Cache_entries WHERE Encoding IS NULL AND Size >= ?',
+            [self.compress_min_bytes])]
+        compressed = 0
+        for key in keys:
+            stored = conn.execute('SELECT Value FROM Cache_entries WHERE Key = ?', [key]).fetchone()[0]
+            contents, encoding = encode_value(json.loads(stored), self.compress_min_bytes)
+            if encoding is not None:
+                conn.execute(
+                    'UPDATE Cache_entries SET Value = ?, Size = ?, Encoding = ? WHERE Key = ?',
+                    [contents, len(contents), encoding, key])
+                compressed += 1
+        conn.commit()
+        conn.execute('VACUUM')
+        return compressed
+
+    @_locked
+    def stats(self):
+        ''' hit, miss and eviction counts plus the current size of the store
+
+        Returns
+        -------
+        dic: hits, misses, evictions, entries, bytes (stored value sizes,
+        after compression), compressed (entries stored compressed) and
+        file_bytes (the sqlite file)
+        '''
+        entries, size, compressed = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(Size), 0), COUNT(Encoding) FROM Cache_entries'
+        ).fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+            'compressed': compressed,
+            'file_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
+
+    @_locked
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+import storage
+
+# series longer than this are downsampled before plotting, None to plot every point
+MAX_POINTS = 2000
+
+
+def lttb_indices(x, y, threshold):
+    ''' pick `threshold` points of a series with Largest-Triangle-Three-Buckets,
+    which keeps the peaks and turns of the line
+
+    Parameters
+    ----------
+    x
+        array: numeric x values, increasing
+    y
+        array: y values
+    threshold
+        int: number of points to keep, at least 3
+
+    Returns
+    -------
+    array: indices of the kept points, increasing, first and last included
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # the first and last points are kept, the rest is split into equal buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    kept = np.empty(threshold, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < threshold - 1:
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        # the third triangle corner is the average of the next bucket
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        areas = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return kept
+
+
+def downsample(xvals, yvals, max_points=MAX_POINTS):
+    ''' shrink a series to max_points with LTTB, dates allowed as x values
+
+    Returns
+    -------
+    tuple: the x and y arrays, unchanged when already short enough
+    '''
+    xvals = np.asarray(xvals)
+    yvals = np.asarray(yvals)
+    if max_points is None or len(xvals) <= max_points:
+        return xvals, yvals
+    numeric_x = xvals.astype('int64') if np.issubdtype(xvals.dtype, np.datetime64) else xvals
+    kept = lttb_indices(numeric_x, yvals, max_points)
+    return xvals[kept], yvals[kept]
+
+
+def _trace(xvals, yvals, webgl, max_points, name=None):
+    xvals, yvals = downsample(xvals, yvals, max_points)
+    scatter = go.Scattergl if webgl else go.Scatter
+    return scatter(x=xvals, y=yvals, mode='lines+markers', name=name)
+
+
+def build_figure(xvals, yvals, title, webgl=False, max_points=MAX_POINTS):
+    ''' the scatter chart of one metric over time
+
+    Parameters
+    ----------
+    xvals
+        array: the dates
+    yvals
+        array: the metric values
+    title
+        str: the chart title
+    webgl
+        bool: draw with Scattergl (WebGL) instead of SVG
+    max_points
+        int: downsample longer series to this many points, None to keep all
+
+    Returns
+    -------
+    plotly Figure
+    '''
+    scatter_data = _trace(xvals, yvals, webgl, max_points)
+    basic_layout = go.Layout(title=title)
+    return go.Figure(data=scatter_data, layout=basic_layout)
+
+
+def build_dashboard(series, graphics, title, webgl=False, max_points=MAX_POINTS):
+    ''' every metric of a country in one page, one chart per row on a shared date axis
+
+    Parameters
+    ----------
+    series
+        dic: the columns returned by final_project.get_series
+    graphics
+        list: (metric, chart title) tuples
+    title
+        str: the page title
+    webgl
+        bool: draw with Scattergl (WebGL) instead of SVG
+    max_points
+        int: downsample longer series to this many points, None to keep all
+
+    Returns
+    -------
+    plotly Figure
+    '''
+    subplot_titles = [chart_title.replace(" history of ", "").strip() for _, chart_title in graphics]
+    fig = make_subplots(rows=len(graphics), cols=1, shared_xaxes=True,
+                        subplot_titles=subplot_titles, vertical_spacing=0.03)
+    for row, (metric, chart_title) in enumerate(graphics, 1):
+        fig.add_trace(_trace(series["Time"], series[metric], webgl, max_points,
+                             name=subplot_titles[row - 1]), row=row, col=1)
+    fig.update_layout(title=title, height=300 * len(graphics), showlegend=False)
+    return fig
+
+
+def build_comparison(comparison, title, names=None, webgl=False, max_points=MAX_POINTS):
+    ''' one metric of several countries on one chart, a line per country
+
+    Parameters
+    ----------
+    comparison
+        dic: the arrays returned by final_project.get_comparison
+    title
+        str: the chart title
+    names
+        dic: country code -> the name shown in the legend, codes by default
+    webgl
+        bool: draw with Scattergl (WebGL) instead of SVG
+    max_points
+        int: downsample longer series to this many points, None to keep all
+
+    Returns
+    -------
+    plotly Figure
+    '''
+    names = names or {}
+    fig = go.Figure(layout=go.Layout(title=title))
+    for code, values in zip(comparison["Country_code"], comparison["Values"]):
+        fig.add_trace(_trace(comparison["Time"], values, webgl, max_points, name=names.get(code, code)))
+    return fig
+
+
+def ensure_plotlyjs(directory):
+    ''' copy plotly.min.js into a directory unless it is already there, so
+    workers writing charts with plotlyjs='directory' never race to copy it,
+    and a concurrent batch run never sees a partial copy
+    '''
+    path = os.path.join(directory, 'plotly.min.js')
+    if not os.path.exists(path):
+        from plotly.offline import get_plotlyjs
+        storage.atomic_write(path, get_plotlyjs())
+
+
+def write_chart(fig, path, auto_open=False, plotlyjs='directory'):
+    ''' write a figure to an html file
+
+    Parameters
+    ----------
+    fig
+        plotly Figure
+    path
+        str: the html file
+    auto_open
+        bool: open the file in a browser
+    plotlyjs
+        str: 'directory' to reference one plotly.min.js copied next to the
+        file (once per directory), 'inline' to embed the bundle in the
+        file, 'cdn' to load it from the plotly CDN
+
+    Returns
+    -------
+    None
+    '''
+    include = True if plotlyjs == 'inline' else plotlyjs
+    fig.write_html(path, auto_open=auto_open, include_plotlyjs=include)
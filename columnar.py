@@ -0,0 +1,134 @@
+import glob
+import io
+import os
+import zlib
+
+import numpy as np
+
+import storage
+
+
+def _open_series(path, layout, names):
+    ''' unpickle a Series: map its file again instead of copying the data '''
+    return Series.open(path, layout, names)
+
+
+class Series(dict):
+    ''' some columns of a country, name -> array, each one a zero copy view
+    of a memory mapped file. Pickling one sends the path rather than the
+    data, so a worker process maps the same file and shares its pages.
+
+    Parameters
+    ----------
+    path
+        str: the file
+    layout
+        dic: column name -> dtype of every row of the file, in order
+    columns
+        dic: column name -> array
+    '''
+
+    def __init__(self, path, layout, columns):
+        super().__init__(columns)
+        self.path = path
+        self.layout = layout
+
+    @classmethod
+    def open(cls, path, layout, names=None):
+        table = np.load(path, mmap_mode='r')
+        rows = {name: row for row, name in enumerate(layout)}
+        # a row of the int64 table seen as the column's own dtype, not copied
+        return cls(path, layout, {name: table[rows[name]].view(layout[name]) for name in names or layout})
+
+    def subset(self, names):
+        ''' the same file, only some of its columns '''
+        return Series(self.path, self.layout, {name: self[name] for name in names})
+
+    def __reduce__(self):
+        return _open_series, (self.path, self.layout, list(self))
+
+
+class ColumnStore:
+    ''' one file per country and version holding a fixed width int64 array,
+    one row per column: the dates as days since 1970-01-01, the integer
+    columns as they are and the float ones as their bits. Files are never
+    changed once written, a new version gets a new file, so a reader that
+    knows the current version can map the file without any locking.
+
+    Parameters
+    ----------
+    directory
+        str: where the files go, created if needed
+    columns
+        dic: column name -> numpy dtype ("i8" or "f8"), in row order; "Time"
+        comes first and is added when missing
+    '''
+
+    def __init__(self, directory, columns):
+        self.directory = directory
+        self.columns = {"Time": "datetime64[D]"}
+        self.columns.update((name, dtype) for name, dtype in columns.items() if name != "Time")
+        # files written with other columns get another name and are never read
+        self.layout = "{:08x}".format(zlib.crc32(",".join(
+            "{}:{}".format(name, dtype) for name, dtype in self.columns.items()).encode()))
+        self._mapped = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, country_code, version):
+        return os.path.join(self.directory, "{}.{}.{}.npy".format(country_code, version, self.layout))
+
+    def read(self, country_code, version):
+        ''' the columns of a country at a version, None when that file has
+        not been written
+
+        Returns
+        -------
+        Series
+        '''
+        mapped = self._mapped.get(country_code)
+        if mapped is not None and mapped[0] == version:
+            return mapped[1]
+        path = self.path(country_code, version)
+        try:
+            series = Series.open(path, self.columns)
+        except FileNotFoundError:
+            return None
+        self._mapped[country_code] = (version, series)
+        return series
+
+    def write(self, country_code, version, series):
+        ''' store the columns of a country at a version, then delete its files
+        older than the previous version (a process still mapping one of
+        those keeps its pages until it lets go)
+
+        Parameters
+        ----------
+        country_code
+            str: the 2 letter country code
+        version
+            int: the version of the data, see final_project.series_version
+        series
+            dic: column name -> array, every column of the store
+
+        Returns
+        -------
+        None
+        '''
+        table = np.empty((len(self.columns), len(series["Time"])), dtype=np.int64)
+        for row, (name, dtype) in enumerate(self.columns.items()):
+            table[row] = np.asarray(series[name], dtype=dtype).view(np.int64)
+        path = self.path(country_code, version)
+        storage.atomic_write(path, _npy_bytes(table), mode='wb')
+        for old in glob.glob(os.path.join(self.directory, "{}.*.npy".format(country_code))):
+            parts = os.path.basename(old).split(".")
+            if parts[2] != self.layout or int(parts[1]) < version - 1:
+                try:
+                    os.remove(old)
+                except OSError: # still open on a system that will not remove it
+                    pass
+
+
+def _npy_bytes(table):
+    buffer = io.BytesIO()
+    np.save(buffer, table)
+    return buffer.getvalue()
@@ -0,0 +1,256 @@
+import json
+import re
+import string
+import unicodedata
+
+import scraping
+import storage
+
+WORLDOMETERS_URL = "https://www.worldometers.info/geography/alphabetical-list-of-countries/countries-that-start-with-{letter}/"
+COUNTRY_CODE_URL = "https://countrycode.org/"
+
+# worldometers and countrycode.org do not always agree on a country's name,
+# every alias here points at the normalized countrycode.org spelling
+ALIASES = {
+    "cote d ivoire": "ivory coast",
+    "dr congo": "democratic republic of the congo",
+    "congo": "republic of the congo",
+    "czechia": "czech republic",
+    "state of palestine": "palestine",
+    "holy see": "vatican",
+    "cabo verde": "cape verde",
+    "eswatini": "swaziland",
+    "north macedonia": "macedonia",
+    "timor leste": "east timor",
+    "st vincent and grenadines": "saint vincent and the grenadines",
+    "saint vincent and grenadines": "saint vincent and the grenadines",
+    "usa": "united states",
+    "us": "united states",
+    "uk": "united kingdom",
+    "great britain": "united kingdom",
+}
+
+
+def normalize_name(name):
+    ''' fold a country name to the form used as a key in the name index
+
+    accents are stripped, '&' becomes 'and', punctuation turns into spaces
+    and a leading 'the' is dropped, so "Côte d'Ivoire" and "cote d ivoire"
+    end up on the same key
+
+    Parameters
+    ----------
+    name
+        str: a country name
+
+    Returns
+    -------
+    str: the normalized name
+    '''
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = name.lower().replace('&', ' and ')
+    name = re.sub(r'[^a-z0-9]+', ' ', name).strip()
+    if name.startswith('the '):
+        name = name[4:]
+    return name
+
+
+def _name_variants(name):
+    ''' the normalized name plus the text inside and outside any parentheses,
+    e.g. "Czech Republic (Czechia)" gives both "czech republic" and "czechia"
+    '''
+    variants = [normalize_name(name)]
+    match = re.match(r'^(.*?)\s*\((.*)\)\s*$', name)
+    if match:
+        variants.append(normalize_name(match.group(1)))
+        variants.append(normalize_name(match.group(2)))
+    return [v for v in variants if v]
+
+
+def parse_country_code_page(html):
+    ''' read the country table of countrycode.org
+
+    Parameters
+    ----------
+    html
+        str: the countrycode.org page
+
+    Returns
+    -------
+    list: (name, 2 letter code) pairs
+    '''
+    rows = []
+    for cells in scraping.table_rows(html, "main-table", "table", source='countrycode'):
+        if len(cells) > 2:
+            rows.append((cells[0].strip(), cells[2].strip()[:2]))
+    return rows
+
+
+def parse_letter_page(html):
+    ''' read the country table of a worldometers letter page
+
+    Parameters
+    ----------
+    html
+        str: the worldometers page
+
+    Returns
+    -------
+    list: (number, name, population) tuples, empty when the page has no table
+    '''
+    rows = []
+    for cells in scraping.table_rows(html, "table-responsive", source='worldometers'):
+        if len(cells) > 2:
+            population = cells[2].strip().replace(',', '')
+            rows.append((cells[0].strip(), cells[1].strip(),
+                         int(population) if population.isdigit() else None))
+    return rows
+
+
+def page_parsers():
+    ''' every page the directory is built from, with the function extracting
+    its rows
+
+    Returns
+    -------
+    dic: url -> parse function
+    '''
+    parsers = {WORLDOMETERS_URL.format(letter=letter): parse_letter_page for letter in string.ascii_lowercase}
+    parsers[COUNTRY_CODE_URL] = parse_country_code_page
+    return parsers
+
+
+class CountryDirectory:
+    ''' every country with its 2 letter code and population, indexed for
+    constant time lookups by code, by normalized name or alias, and by
+    initial letter
+
+    Parameters
+    ----------
+    countries
+        list: dicts with letter, number, name, population and code (code may be None
+        when countrycode.org has no match for a worldometers name)
+    codes
+        dic: normalized name -> 2 letter code, every name countrycode.org knows
+    '''
+
+    def __init__(self, countries, codes):
+        self.countries = countries
+        self.codes_by_name = dict(codes)
+        self.by_code = {}
+        self.by_letter = {}
+        for country in countries:
+            self.by_letter.setdefault(country['letter'], []).append(country)
+            if country['code'] is not None:
+                self.by_code.setdefault(country['code'], country)
+                for variant in _name_variants(country['name']):
+                    self.codes_by_name.setdefault(variant, country['code'])
+
+    @classmethod
+    def from_pages(cls, country_code_html, letter_pages):
+        ''' build the directory from the raw pages
+
+        Parameters
+        ----------
+        country_code_html
+            str: the countrycode.org page
+        letter_pages
+            dic: letter -> the worldometers page for that letter
+
+        Returns
+        -------
+        CountryDirectory
+        '''
+        letter_rows = {letter: parse_letter_page(html) for letter, html in letter_pages.items()}
+        return cls.from_rows(parse_country_code_page(country_code_html), letter_rows)
+
+    @classmethod
+    def from_rows(cls, country_code_rows, letter_rows):
+        ''' build the directory from the rows extracted from the pages
+
+        Parameters
+        ----------
+        country_code_rows
+            list: (name, 2 letter code) pairs, see parse_country_code_page
+        letter_rows
+            dic: letter -> (number, name, population) rows, see parse_letter_page
+
+        Returns
+        -------
+        CountryDirectory
+        '''
+        codes = {}
+        for name, code in country_code_rows:
+            for variant in _name_variants(name):
+                codes.setdefault(variant, code)
+        countries = []
+        for letter in sorted(letter_rows):
+            for number, name, population in letter_rows[letter]:
+                code = None
+                for variant in _name_variants(name):
+                    code = codes.get(variant) or codes.get(ALIASES.get(variant))
+                    if code is not None:
+                        break
+                countries.append({'letter': letter, 'number': number, 'name': name,
+                                  'population': population, 'code': code})
+        return cls(countries, codes)
+
+    @classmethod
+    def build(cls, fetch_rows):
+        ''' build the directory from countrycode.org and the 26 worldometers
+        letter pages
+
+        Parameters
+        ----------
+        fetch_rows
+            function: (url, parse function) -> the rows parsed from that page,
+            letting the caller cache extracted rows instead of reparsing
+
+        Returns
+        -------
+        CountryDirectory
+        '''
+        letter_rows = {}
+        for letter in string.ascii_lowercase:
+            letter_rows[letter] = fetch_rows(WORLDOMETERS_URL.format(letter=letter), parse_letter_page)
+        return cls.from_rows(fetch_rows(COUNTRY_CODE_URL, parse_country_code_page), letter_rows)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as directory_file:
+            contents = json.load(directory_file)
+        return cls(contents['countries'], contents['codes'])
+
+    def save(self, path):
+        ''' write the directory to a JSON file, atomically so a process
+        loading it at the same time never reads half of it '''
+        storage.atomic_write(path, json.dumps({'countries': self.countries, 'codes': self.codes_by_name}))
+
+    def code_for(self, name):
+        ''' the 2 letter code of a country, exact match on the normalized
+        name, its parenthesized variants or a known alias
+
+        Returns
+        -------
+        str: the code, None when the name is unknown
+        '''
+        for variant in _name_variants(name):
+            code = self.codes_by_name.get(variant)
+            if code is None and variant in ALIASES:
+                code = self.codes_by_name.get(ALIASES[variant])
+            if code is not None:
+                return code
+        return None
+
+    def population(self, code):
+        country = self.by_code.get(code)
+        return None if country is None else country['population']
+
+    def name_for(self, code):
+        country = self.by_code.get(code)
+        return None if country is None else country['name']
+
+    def starting_with(self, letter):
+        ''' the worldometers rows for one initial letter, in page order '''
+        return self.by_letter.get(letter.lower(), [])
@@ -0,0 +1,132 @@
+import math
+
+# Derived_metrics columns after Country_code and Time, in table order
+DERIVED_COLUMNS = ["New_cases", "New_deaths", "New_cases_7d", "New_cases_14d",
+                   "New_deaths_7d", "New_deaths_14d", "Growth_rate", "Doubling_time"]
+# rolling means, in days
+WINDOWS = (7, 14)
+# total cases are compared with this many days before for the growth rate
+GROWTH_DAYS = 7
+# stored days before the first recomputed one that the windows reach back to
+CONTEXT_DAYS = max(max(WINDOWS), GROWTH_DAYS)
+
+# WITHOUT ROWID keeps the rows in (Country_code, Time) order, so the days of a
+# country stay together however the refreshes of countries interleave
+CREATE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Derived_metrics" (
+        "Country_code" TEXT NOT NULL,
+        "Time" TEXT NOT NULL,
+        "New_cases" REAL,
+        "New_deaths" REAL,
+        "New_cases_7d" REAL,
+        "New_cases_14d" REAL,
+        "New_deaths_7d" REAL,
+        "New_deaths_14d" REAL,
+        "Growth_rate" REAL,
+        "Doubling_time" REAL,
+        PRIMARY KEY("Country_code","Time")
+        FOREIGN KEY("Country_code")
+            REFERENCES Country_info("Country_code")
+    ) WITHOUT ROWID
+'''
+
+
+def _rolling_mean(np, values, window):
+    ''' mean of the last `window` values at every position, NaN until the
+    window is full of numbers '''
+    out = np.full(len(values), np.nan)
+    if len(values) < window:
+        return out
+    valid = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(valid)))
+    full = (counts[window:] - counts[:-window]) == window
+    means = (sums[window:] - sums[:-window]) / window
+    out[window - 1:] = np.where(full, means, np.nan)
+    return out
+
+
+def compute(total_cases, total_deaths):
+    ''' the derived metrics of consecutive stored days, as arrays
+
+    New cases and deaths are the change from the previous stored day (NaN
+    on the first one). The growth rate is the average daily growth of total
+    cases over GROWTH_DAYS days, and the doubling time ln 2 / ln(1 + growth)
+    in days, NaN when cases did not grow.
+
+    Parameters
+    ----------
+    total_cases, total_deaths
+        arrays: the cumulative counts, oldest day first
+
+    Returns
+    -------
+    dic: column name (see DERIVED_COLUMNS) -> float array
+    '''
+    import numpy as np # only loaded once something is computed
+    cases = np.asarray(total_cases, dtype=float)
+    deaths = np.asarray(total_deaths, dtype=float)
+    columns = {}
+    for name, totals in (("New_cases", cases), ("New_deaths", deaths)):
+        new = np.full(len(totals), np.nan)
+        new[1:] = np.diff(totals)
+        columns[name] = new
+        for window in WINDOWS:
+            columns["{}_{}d".format(name, window)] = _rolling_mean(np, new, window)
+    growth = np.full(len(cases), np.nan)
+    if len(cases) > GROWTH_DAYS:
+        before = cases[:-GROWTH_DAYS]
+        now = cases[GROWTH_DAYS:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            growth[GROWTH_DAYS:] = np.where(before > 0, (now / before) ** (1.0 / GROWTH_DAYS) - 1, np.nan)
+    columns["Growth_rate"] = growth
+    with np.errstate(divide="ignore", invalid="ignore"):
+        columns["Doubling_time"] = np.where(growth > 0, math.log(2) / np.log1p(growth), np.nan)
+    return columns
+
+
+def refresh(conn, country_code, since=None):
+    ''' recompute the Derived_metrics rows of a country from `since` on,
+    reading only the CONTEXT_DAYS stored days before it as well. Days stored
+    in Status_history but never derived (e.g. ingested before this table
+    existed) are recomputed too. The caller commits.
+
+    Parameters
+    ----------
+    conn
+        sqlite3.Connection: the database
+    country_code
+        str: the 2 letter country code
+    since
+        str: the first day (YYYY-MM-DD) whose cases or deaths changed, None
+        when none did
+
+    Returns
+    -------
+    int: the number of days recomputed
+    '''
+    covered = conn.execute('SELECT MAX(Time) FROM Derived_metrics WHERE Country_code = ?',
+                           [country_code]).fetchone()[0]
+    uncovered = conn.execute('SELECT MIN(Time) FROM Status_history WHERE Country_code = ? AND Time > ?',
+                             [country_code, covered or '']).fetchone()[0]
+    starts = [day for day in (since, uncovered) if day is not None]
+    if not starts:
+        return 0
+    start = min(starts)
+    context = conn.execute('''
+        SELECT Time, Total_cases, Total_deaths FROM Status_history
+        WHERE Country_code = ? AND Time < ?
+        ORDER BY Time DESC LIMIT ?
+    ''', [country_code, start, CONTEXT_DAYS]).fetchall()[::-1]
+    recent = conn.execute('''
+        SELECT Time, Total_cases, Total_deaths FROM Status_history
+        WHERE Country_code = ? AND Time >= ?
+        ORDER BY Time
+    ''', [country_code, start]).fetchall()
+    rows = context + recent
+    columns = compute([row[1] for row in rows], [row[2] for row in rows])
+    values = [[None if math.isnan(value) else value for value in columns[name][len(context):].tolist()]
+              for name in DERIVED_COLUMNS]
+    conn.executemany('INSERT OR REPLACE INTO Derived_metrics VALUES (?,?,?,?,?,?,?,?,?,?)',
+                     zip([country_code] * len(recent), [row[0] for row in recent], *values))
+    return len(recent)
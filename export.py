@@ -0,0 +1,241 @@
+import csv
+import itertools
+import os
+import time
+
+import final_project
+import instrumentation
+import storage
+
+# rows read from the database at a time, and the rows of one Arrow record
+# batch or Parquet row group; bounds the memory an export needs
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_FORMATS = ["csv", "parquet", "arrow"]
+# the format of an output file without --format, by its suffix
+FORMAT_SUFFIXES = {".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow"}
+
+# exported columns, in order, with their Arrow types; the percentages are of
+# the population
+EXPORT_COLUMNS = [
+    ("Country_code", "string"),
+    ("Country_name", "string"),
+    ("Population", "int64"),
+    ("Time", "date32"),
+    ("Total_cases", "int64"),
+    ("Total_deaths", "int64"),
+    ("Active_cases", "int64"),
+    ("Total_recovered", "int64"),
+    ("Tot_case_pop_perc", "float64"),
+    ("Tot_death_pop_perc", "float64"),
+    ("Actv_case_pop_perc", "float64"),
+    ("Updated_at", "float64"), # seconds since 1970-01-01 UTC, NULL for rows written before exports
+]
+
+# the newest Updated_at written by the incremental exports to each path
+CREATE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Export_state" (
+        "Name" TEXT NOT NULL,
+        "Watermark" REAL,
+        "Exported_at" REAL NOT NULL,
+        "Rows" INTEGER NOT NULL,
+        PRIMARY KEY("Name")
+    )
+'''
+
+
+def export_format(path, fmt=None):
+    ''' the format to write path in: fmt when given, else the one its suffix names '''
+    if fmt is None:
+        fmt = FORMAT_SUFFIXES.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise ValueError("cannot tell the format of {} from its suffix, one of {} is needed".format(
+                path, ", ".join(EXPORT_FORMATS)))
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("unknown export format {}, one of {} is needed".format(fmt, ", ".join(EXPORT_FORMATS)))
+    return fmt
+
+
+def increment_path(path, exported_at):
+    ''' the file an incremental export to path writes: path with the UTC
+    time of the export before its suffix, e.g. history.20201231T235959Z.csv,
+    so every run gets its own file and none replaces rows not collected yet '''
+    stem, suffix = os.path.splitext(path)
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(exported_at))
+    candidate = "{}.{}{}".format(stem, stamp, suffix)
+    taken = 1
+    while os.path.exists(candidate): # another run in the same second, named to sort after it
+        candidate = "{}.{}_{}{}".format(stem, stamp, taken, suffix)
+        taken += 1
+    return candidate
+
+
+def _query(countries, since, until, watermark):
+    ''' the SELECT of the exported rows and its parameters '''
+    conditions, parameters = [], []
+    if countries:
+        conditions.append("Country_code IN ({})".format(",".join("?" * len(countries))))
+        parameters.extend(countries)
+    if since:
+        conditions.append("Time >= ?")
+        parameters.append(since)
+    if until:
+        conditions.append("Time <= ?")
+        parameters.append(until)
+    if watermark is not None:
+        conditions.append("Updated_at > ?")
+        parameters.append(watermark)
+    sql = '''
+        SELECT {}
+        FROM Status_history JOIN Country_info USING (Country_code)
+        {}
+        ORDER BY Country_code, Time
+    '''.format(", ".join(name for name, _ in EXPORT_COLUMNS),
+               "WHERE " + " AND ".join(conditions) if conditions else "")
+    return sql, parameters
+
+
+def _chunks(cursor, chunk_rows):
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        yield rows
+
+
+def _write_csv(file, chunks):
+    writer = csv.writer(file)
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield rows
+
+
+def _arrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("exporting Parquet or Arrow needs pyarrow (pip install pyarrow), CSV does not") from None
+    return pyarrow
+
+
+def _schema(pa):
+    return pa.schema([(name, getattr(pa, arrow_type)()) for name, arrow_type in EXPORT_COLUMNS])
+
+
+def _record_batch(pa, schema, rows):
+    ''' one chunk of rows as an Arrow record batch, column by column '''
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if field.name == "Time": # stored as YYYY-MM-DD text
+            arrays.append(pa.array(values, pa.string()).cast(pa.timestamp("s")).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write_arrow(file, chunks, fmt):
+    pa = _arrow()
+    schema = _schema(pa)
+    sink = pa.PythonFile(file, mode='w')
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+        write = writer.write_batch # one row group per chunk
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+        write = writer.write_batch
+    try:
+        for rows in chunks:
+            write(_record_batch(pa, schema, rows))
+            yield rows
+    finally:
+        writer.close()
+
+
+def export_history(path, fmt=None, countries=None, since=None, until=None, incremental=False,
+                   chunk_rows=EXPORT_CHUNK_ROWS):
+    ''' write Status_history, joined with the name and population of each
+    country, to a CSV, Parquet or Arrow IPC file, one country after the
+    other in date order.
+
+    The rows are streamed: read chunk_rows at a time and written before the
+    next chunk is read, so the memory needed does not grow with the table.
+    The file is replaced in one step once complete (see
+    storage.atomic_open). An incremental export only writes the rows
+    inserted or changed since the previous incremental export to the same
+    path, the first one every row, each to a file of its own (see
+    increment_path); nothing is written when no row changed. Only
+    Status_history is exported, Derived_metrics can be computed again from
+    it.
+
+    Parameters
+    ----------
+    path
+        str: the output file, the name the files of incremental exports are
+        made from
+    fmt
+        str: one of EXPORT_FORMATS, by default told by the suffix of path
+    countries
+        list: 2 letter codes, None for every country
+    since, until
+        str: the first and last day (YYYY-MM-DD) to export, None for no limit
+    incremental
+        bool: only the rows written since the last incremental export to path,
+        to a new file
+    chunk_rows
+        int: rows read and written at a time
+
+    Returns
+    -------
+    dic: path (None when an incremental export had no rows to write),
+    format, rows and chunks written, the watermark (newest Updated_at
+    exported so far) and the elapsed seconds
+    '''
+    start = time.perf_counter()
+    fmt = export_format(path, fmt)
+    if fmt != "csv":
+        _arrow() # fail before reading anything
+    name = os.path.abspath(path)
+    conn = storage.connect(final_project.DB_NAME)
+    try:
+        conn.execute(CREATE_SQL)
+        conn.commit()
+        watermark = None
+        if incremental:
+            state = conn.execute('SELECT Watermark FROM Export_state WHERE Name = ?', [name]).fetchone()
+            watermark = state[0] if state is not None else None
+        sql, parameters = _query(countries, since, until, watermark)
+        # one statement reads one snapshot of the database, however long the
+        # export takes and whatever ingestion commits meanwhile
+        cursor = conn.execute(sql, parameters)
+        summary = {'path': path, 'format': fmt, 'rows': 0, 'chunks': 0, 'watermark': watermark}
+        updated_at = len(EXPORT_COLUMNS) - 1
+        chunks = _chunks(cursor, chunk_rows)
+        first = next(chunks, None)
+        if incremental:
+            # a file of its own, and none at all when nothing changed
+            summary['path'] = increment_path(path, time.time()) if first is not None else None
+        if summary['path'] is not None:
+            chunks = itertools.chain([first] if first is not None else [], chunks)
+            with storage.atomic_open(summary['path'], 'w' if fmt == "csv" else 'wb',
+                                     **({'newline': ''} if fmt == "csv" else {})) as file:
+                written = _write_csv(file, chunks) if fmt == "csv" else _write_arrow(file, chunks, fmt)
+                for rows in written:
+                    summary['rows'] += len(rows)
+                    summary['chunks'] += 1
+                    newest = max((row[updated_at] for row in rows if row[updated_at] is not None), default=None)
+                    if newest is not None and (summary['watermark'] is None or newest > summary['watermark']):
+                        summary['watermark'] = newest
+        cursor.close()
+        if incremental and summary['rows']:
+            # saved once the file is in place: after a failed run the next
+            # one writes the same rows again
+            conn.execute('INSERT OR REPLACE INTO Export_state VALUES (?,?,?,?)',
+                         [name, summary['watermark'], time.time(), summary['rows']])
+            conn.commit()
+    finally:
+        conn.close()
+    summary['elapsed'] = time.perf_counter() - start
+    instrumentation.observe("export", summary['elapsed'], format=fmt)
+    instrumentation.count("export_rows", summary['rows'], format=fmt)
+    return summary
@@ -1,17 +1,82 @@
-from bs4 import BeautifulSoup
-import requests
-import json
+import argparse
+import os
 import secrets
-import sqlite3
-import plotly.graph_objects as go 
+import threading
+import time
+from cache_store import CacheStore
+import http_client
+import instrumentation
+import derived
+import storage
+from country_directory import CountryDirectory
+from history_stream import iter_payload_records, last_record_per_day
+from singleflight import SingleFlight
 
 consumer_key = secrets.API_KEY
 CACHE_FILE_NAME = 'cache.json'
+CACHE_DB_NAME = 'cache.sqlite'
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+PAGE_TTL = 24 * 60 * 60 # web pages are revalidated once they are a day old
+STATUS_MAX_AGE = 24 * 60 * 60 # a history fetched this recently answers the current status
 CACHE_DICT = {}
+COUNTRY_DIRECTORY_FILE = 'country_directory.json'
+CHART_DIR = 'charts' # html charts, sharing one copy of plotly.min.js
 DB_NAME = 'COVID-19_507.sqlite'
+API_HOST = "coronavirus-monitor-v2.p.rapidapi.com"
+# point COVID_API_BASE_URL at another server (e.g. a local stub) to test without RapidAPI
+API_BASE_URL = os.environ.get("COVID_API_BASE_URL", "https://" + API_HOST + "/coronavirus/")
+LATEST_STATUS_URL = API_BASE_URL + "latest_stat_by_alpha_2_code.php"
+HISTORY_URL = API_BASE_URL + "history_by_alpha_2.php"
+DB_CONNS = threading.local() # a sqlite connection only serves the thread that opened it
+# memory mapped copies of the series, read by get_series instead of querying
+COLUMN_STORE_DIR = 'series_columns'
+USE_COLUMN_STORE = True
+COLUMN_STORE = None
+# concurrent misses for the same page or API entry share one fetch
+PAGE_FLIGHTS = SingleFlight("page")
+API_FLIGHTS = SingleFlight("api")
+
+# Status_history columns get_series can return, with their numpy dtypes
+SERIES_COLUMNS = {
+    "Total_cases": "i8",
+    "Tot_case_pop_perc": "f8",
+    "Total_deaths": "i8",
+    "Tot_death_pop_perc": "f8",
+    "Active_cases": "i8",
+    "Actv_case_pop_perc": "f8",
+    "Total_recovered": "i8",
+}
+# and the Derived_metrics ones, NaN where a value is not defined
+SERIES_COLUMNS.update((column, "f8") for column in derived.DERIVED_COLUMNS)
+# the counts get_comparison can divide by population, and the people they are per
+PER_CAPITA_METRICS = ["Total_cases", "Total_deaths", "Active_cases", "Total_recovered"] + \
+    [column for column in derived.DERIVED_COLUMNS if column.startswith("New_")]
+PER_CAPITA = 100000
+# how get_comparison fills the dates a country has no row for
+FILL_METHODS = ["none", "previous", "zero"]
+
+# the charts offered in graphic_list, in menu order: (metric, chart title)
+GRAPHICS = [
+    ("Total_cases", "Total cases history of "),
+    ("Tot_case_pop_perc", "Total cases over population (in %) history of "),
+    ("Total_deaths", "Total deaths history of "),
+    ("Tot_death_pop_perc", "Total deaths population (in %) history of "),
+    ("Active_cases", "Active cases history of "),
+    ("Actv_case_pop_perc", "Active cases population (in %) history of "),
+    ("Total_recovered", "Total recovered history of "),
+    ("New_cases", "Daily new cases history of "),
+    ("New_cases_7d", "New cases, 7-day average history of "),
+    ("New_cases_14d", "New cases, 14-day average history of "),
+    ("New_deaths", "Daily new deaths history of "),
+    ("New_deaths_7d", "New deaths, 7-day average history of "),
+    ("New_deaths_14d", "New deaths, 14-day average history of "),
+    ("Growth_rate", "Daily growth rate of cases (over 7 days) history of "),
+    ("Doubling_time", "Doubling time of cases (in days) history of "),
+]
 
 def load_cache(): # called only once, when we run the program
-    ''' load the cache file, open it and read it
+    ''' set up the cache store; nothing is read until the first lookup, when
+    the old single-file JSON cache is also imported if the store is new
 
     Parameters
     ----------
@@ -20,36 +85,11 @@ def load_cache(): # called only once, when we run the program
     Returns
     -------
     content in cache
-        dic
+        CacheStore
     '''   
-    try:
-        cache_file = open(CACHE_FILE_NAME, 'r')
-        cache_file_contents = cache_file.read()
-        cache = json.loads(cache_file_contents)
-        cache_file.close()
-    except:
-        cache = {}
-    return cache
-
-def save_cache(cache): # called whenever the cache is changed
-    ''' write the content to cache file
-
-    Parameters
-    ----------
-    cache
-        dic:the cache content
+    return CacheStore(CACHE_DB_NAME, max_bytes=CACHE_MAX_BYTES, legacy_json=CACHE_FILE_NAME)
 
-    Returns
-    -------
-    None
-    '''  
-    cache_file = open(CACHE_FILE_NAME, 'w')
-    contents_to_write = json.dumps(cache)
-    cache_file.write(contents_to_write)
-    cache_file.close()
-    return None
-
-def make_url_request_using_cache(url, cache):
+def make_url_request_using_cache(url, cache, parse=None):
     ''' read the chache file to find the content or make url request using url form of the website sites and add text of the web page to the cache
 
     Parameters
@@ -57,22 +97,49 @@ def make_url_request_using_cache(url, cache):
     url
         str:the url will be reading content from or use to find the content in cache file
     cache
-        dic:the cache content
+        CacheStore:the cache content
+    parse
+        function: page text -> records; when given, only the records are
+        cached instead of the whole page
 
     Returns
     -------
     cache[url]
-        str:the content of the url
+        str:the content of the url, or the records parse extracted from it
     '''      
-    if (url in cache.keys()): # the url is our unique key
+    text = cache.get(url) # the url is our unique key
+    if text is not None:
         print("Using cache")
-        return cache[url]     # we already have it, so return it
+        instrumentation.count("cache_hits", kind="page")
+        if parse is not None and isinstance(text, str):
+            text = parse(text) # a page cached before records were, keep only the records
+            cache.rewrite(url, text)
+        return text           # we already have it, so return it
     else:
         print("Fetching")
-        response = requests.get(url) # gotta go get it
-        cache[url] = response.text # add the TEXT of the web page to the cache
-        save_cache(cache)          # write the cache to disk
-        return cache[url]          # return the text, which is now in the cache
+        instrumentation.count("cache_misses", kind="page")
+
+        def fetch():
+            if url in cache: # stored by a fetch that ended after our miss
+                return cache.get(url)
+            entry = cache.get_entry(url) # an expired copy can be revalidated
+            if entry is None:
+                response = http_client.request(url)
+            else:
+                response = http_client.request(url, etag=entry['etag'], last_modified=entry['last_modified'])
+            if response.status_code == 304:
+                cache.revalidated(url, ttl=PAGE_TTL) # unchanged, keep the copy we have
+                if parse is not None and isinstance(entry['value'], str):
+                    entry['value'] = parse(entry['value'])
+                    cache.rewrite(url, entry['value'])
+                return entry['value']
+            response.raise_for_status()
+            content = response.text if parse is None else parse(response.text)
+            cache.set(url, content, ttl=PAGE_TTL, # write only this entry to the cache store
+                      etag=response.headers.get('ETag'),
+                      last_modified=response.headers.get('Last-Modified'))
+            return content
+        return PAGE_FLIGHTS.do((cache.path, url), fetch)
 
 def make_url_request_using_cache_json(url, code, cache):
     ''' read the cache file to find the content or make url request using url from API and add json of the web page to the cache
@@ -82,60 +149,139 @@ def make_url_request_using_cache_json(url, code, cache):
     url
         str:the url will be reading content from or use to find the content in cache file
     cache
-        dic:the cache content
+        CacheStore:the cache content
 
     Returns
     -------
     cache[url]
         str:the content of the url
     ''' 
-    if (url+code in cache.keys()): # the url is our unique key
+    records = cache.get(url+code) # the url is our unique key
+    if records is not None:
         print("Using cache")
-        return cache[url+code]     # we already have it, so return it
+        instrumentation.count("cache_hits", kind="api")
+        return records        # we already have it, so return it
     else:
         print("Fetching, this may take a while")
-        querystring = {"alpha2":code}
-        headers = {
-            'x-rapidapi-host': "coronavirus-monitor-v2.p.rapidapi.com",
-            'x-rapidapi-key': consumer_key
-            }
-        response = requests.request("GET", url, headers=headers, params=querystring).json() # gotta go get it
-        #print(response)
-        infos=list(response.values())[1]
-        # print(infos)
-        # print(type(infos))
-        #print(response)
-        # info_list=list(infos.reverse())
-        # print(info_list)
-        # print(type(info_list))
-        # info_list = []
-        # j = 0
-        # print(len(infos))
-        filtered_info=[]
-        date=None
-        for i in range(len(infos) - 1, -1 , -1):
-            info = infos[i]
-            # print(info)
-            new_date=info["record_date"][0:10]
-            # print(new_date)
-            if new_date == date:
-                pass
-            else: 
-                date = new_date
-                # print(date)
-                filtered_info.append(info)
-        
-        # print(filtered_info[::-1])
-                
-        cache[url+code] = filtered_info[::-1] # add the json of the web page to the cache
-        save_cache(cache)          # write the cache to disk
-        return cache[url+code]          # return the text, which is now in the cache
+        instrumentation.count("cache_misses", kind="api")
+
+        def fetch():
+            if url+code in cache: # stored by a fetch that ended after our miss
+                return cache.get(url+code)
+            records = fetch_api_records(url, code) # gotta go get it
+            cache[url+code] = records # write only this entry to the cache store
+            return records
+        return API_FLIGHTS.do((cache.path, url+code), fetch)
+
+def stream_api_records(url, code):
+    ''' request one RapidAPI endpoint for a country and yield the last record of each day as
+    the response is parsed, so the whole payload is never held in memory
+
+    Parameters
+    ----------
+    url
+        str:the API endpoint
+    code
+        str:the 2 letter country code
+
+    Returns
+    -------
+    generator
+        the records of the response, one per day, oldest first
+    '''
+    querystring = {"alpha2":code}
+    headers = {
+        'x-rapidapi-host': API_HOST,
+        'x-rapidapi-key': consumer_key
+        }
+    response = http_client.request(url, params=querystring, headers=headers, stream=True)
+    if not response.ok:
+        response.close()
+        response.raise_for_status()
+    records = iter_payload_records(http_client.iter_chunks(response))
+    return last_record_per_day(records)
+
+def fetch_api_records(url, code):
+    ''' request one RapidAPI endpoint for a country, keeping only the last record of each day
+
+    Parameters
+    ----------
+    url
+        str:the API endpoint
+    code
+        str:the 2 letter country code
+
+    Returns
+    -------
+    list
+        the records of the response, one per day, oldest first
+    '''
+    with instrumentation.timed("parse", source="api"): # reading the streamed body is part of it
+        return list(stream_api_records(url, code))
 
 
 
 CACHE_DICT = load_cache()
+COUNTRY_DIRECTORY = None
+
+
+
+def get_page_rows(url, parse):
+    '''the rows a parse function extracts from a web page; only the rows are
+    cached, so a repeat lookup skips both the download and the parsing
+    Parameters
+    ----------
+    url
+        str: the page
+    parse
+        function: page text -> list of rows
 
+    return
+        list: the rows
+    '''
+    return make_url_request_using_cache(url, CACHE_DICT, parse)
+
+def compact_cache():
+    '''shrink the cache in place: pages cached whole are replaced by the rows
+    extracted from them, large entries are compressed and the file is vacuumed,
+    then the sizes before and after are printed
+
+    return
+        tuple: the CacheStore stats before and after
+    '''
+    from country_directory import page_parsers
+    before = CACHE_DICT.stats()
+    pages = 0
+    for url, parse in page_parsers().items():
+        entry = CACHE_DICT.get_entry(url)
+        if entry is not None and isinstance(entry['value'], str):
+            CACHE_DICT.rewrite(url, parse(entry['value']))
+            pages += 1
+    compressed = CACHE_DICT.compact()
+    after = CACHE_DICT.stats()
+    print("Pages replaced by their records: {}, entries compressed: {}".format(pages, compressed))
+    print("{:8} {:>8} {:>14} {:>14}".format("", "entries", "value bytes", "file bytes"))
+    for label, stats in (("before", before), ("after", after)):
+        print("{:8} {:8} {:14,} {:14,}".format(label, stats['entries'], stats['bytes'], stats['file_bytes']))
+    if os.path.exists(CACHE_FILE_NAME):
+        print("{} (old JSON cache): {:,} bytes".format(CACHE_FILE_NAME, os.path.getsize(CACHE_FILE_NAME)))
+    return before, after
+
+def get_country_directory():
+    '''load the country directory, building it from countrycode.org and the
+    26 worldometers letter pages the first time and saving it for later runs
 
+    return
+        CountryDirectory: countries indexed by code, name and initial letter
+    '''
+    global COUNTRY_DIRECTORY
+    if COUNTRY_DIRECTORY is None:
+        if os.path.exists(COUNTRY_DIRECTORY_FILE):
+            COUNTRY_DIRECTORY = CountryDirectory.load(COUNTRY_DIRECTORY_FILE)
+        else:
+            COUNTRY_DIRECTORY = CountryDirectory.build(get_page_rows)
+            COUNTRY_DIRECTORY.save(COUNTRY_DIRECTORY_FILE)
+    return COUNTRY_DIRECTORY
 
 def get_country_name_list(first_letter):
     '''user input a letter, get a list of countries which starts from that letter
@@ -147,55 +293,20 @@ def get_country_name_list(first_letter):
     return
         list: a list of country number, name, and its population
     '''
-    letter=first_letter.lower()
-    url="https://www.worldometers.info/geography/alphabetical-list-of-countries/countries-that-start-with-"+letter+"/"
-    response = make_url_request_using_cache(url, CACHE_DICT)
-    soup = BeautifulSoup(response, 'html.parser')
-    table=soup.find(class_="table-responsive")
     countries=[]
-    country_list=table.find('tbody').find_all('tr')
-    #print (country_list)
-    for country in country_list:
-        country_infos=country.find_all("td")
-        country_num=country_infos[0].text
-        country_name=country_infos[1].text
-        country_popu_str=country_infos[2].text
-        country_popu = country_popu_str.replace(',', '')
-        country_info=country_num+" "+country_name+" "+country_popu
+    for country in get_country_directory().starting_with(first_letter):
+        country_info=country['number']+" "+country['name']+" "+str(country['population'])
         countries.append(country_info)
     return countries
-    #         country_num=country_info[0].text
-    # country_popu = country_info[2].text
-    # print(country_name)
-    # print(country_popu)
-    
-# return country_names
-#print(get_country_name_list("e"))
 
 def get_country_code(country_name):
     '''
     inpute a name, get the country code 
 
     return
-        num: the 2 letter country code
-    '''
-    name=country_name.lower()
-    url="https://countrycode.org/"
-    response = make_url_request_using_cache(url, CACHE_DICT)
-    soup = BeautifulSoup(response, 'html.parser')
-    table=soup.find(class_="table table-hover table-striped main-table")
-    country_list=table.find('tbody').find_all('tr')
-    #print (country_list)
-    for country in country_list:
-        country_infos=country.find_all("td")
-        if country_infos[0].text.lower() in name:
-            country_code_all=country_infos[2].text
-            country_code=country_code_all[:2]
-            return country_code
-        else:
-            pass
-    
-#print(get_country_code("United States"))
+        num: the 2 letter country code, None for an unknown name
+    '''
+    return get_country_directory().code_for(country_name)
 
 def get_country_latest_status(code):
     '''
@@ -204,8 +315,7 @@ def get_country_latest_status(code):
     return
         dic: info and latest status of COVID-19
     '''
-    url = "https://coronavirus-monitor-v2.p.rapidapi.com/coronavirus/latest_stat_by_alpha_2_code.php"
-    response=make_url_request_using_cache_json(url, code, CACHE_DICT)
+    response=make_url_request_using_cache_json(LATEST_STATUS_URL, code, CACHE_DICT)
 
     #print(response)
     return response
@@ -220,13 +330,12 @@ def get_country_total_case_history(code):
     return
         dic: info and latest status of COVID-19
     '''
-    url = "https://coronavirus-monitor-v2.p.rapidapi.com/coronavirus/history_by_alpha_2.php"
-    response=make_url_request_using_cache_json(url, code, CACHE_DICT)
+    response=make_url_request_using_cache_json(HISTORY_URL, code, CACHE_DICT)
     return response
 #print(get_country_total_case_history("GB"))
 
 def create_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = storage.connect(DB_NAME)
     cur = conn.cursor()
 
     #drop_country_info_sql='DROP TABLE IF EXISTS "Country_info"'
@@ -252,20 +361,72 @@ def create_db():
             "Tot_case_pop_perc"	REAL,
             "Tot_death_pop_perc" REAL,
             "Actv_case_pop_perc" REAL,
+            "Updated_at" REAL,
             PRIMARY KEY("Country_code","Time")
             FOREIGN KEY("Country_code")
                 REFERENCES Country_info("Country_code") 
         )
     '''
+    create_ingestion_state_sql = '''
+        CREATE TABLE IF NOT EXISTS "Ingestion_state" (
+            "Country_code"	TEXT NOT NULL,
+            "Source_version" REAL NOT NULL,
+            "Ingested_at" REAL NOT NULL,
+            PRIMARY KEY("Country_code")
+        )
+    '''
+    # the days of a country in order with their counts, read without
+    # touching the table rows, which daily ingestion interleaves across
+    # countries; serves get_comparison and the reads of add_history_sqlite
+    create_history_index_sql = '''
+        CREATE INDEX IF NOT EXISTS "Status_history_counts"
+        ON "Status_history" ("Country_code", "Time", "Total_cases", "Total_deaths",
+                             "Active_cases", "Total_recovered")
+    '''
+    # the rows written since the last export, see export.py
+    create_history_updated_index_sql = '''
+        CREATE INDEX IF NOT EXISTS "Status_history_updated"
+        ON "Status_history" ("Updated_at")
+    '''
+    # bumped in the transaction that changes a country's history or derived
+    # metrics; names the column store file holding that data
+    create_series_version_sql = '''
+        CREATE TABLE IF NOT EXISTS "Series_version" (
+            "Country_code"	TEXT NOT NULL,
+            "Version" INTEGER NOT NULL,
+            PRIMARY KEY("Country_code")
+        )
+    '''
+    # how often each country was looked up, so refresh.py keeps the
+    # popular ones freshest
+    create_country_views_sql = '''
+        CREATE TABLE IF NOT EXISTS "Country_views" (
+            "Country_code"	TEXT NOT NULL,
+            "Views" INTEGER NOT NULL,
+            "Last_viewed" REAL NOT NULL,
+            PRIMARY KEY("Country_code")
+        )
+    '''
     #cur.execute(drop_country_info_sql)
     #cur.execute(drop_history_sql)
     cur.execute(create_country_info_sql)
     cur.execute(create_history_sql)
+    history_columns = [row[1] for row in cur.execute('PRAGMA table_info("Status_history")')]
+    if "Updated_at" not in history_columns: # created before exports; its rows count as never exported
+        cur.execute('ALTER TABLE "Status_history" ADD COLUMN "Updated_at" REAL')
+    cur.execute(create_history_index_sql)
+    cur.execute(create_history_updated_index_sql)
+    cur.execute(create_ingestion_state_sql)
+    cur.execute(derived.CREATE_SQL)
+    cur.execute(create_series_version_sql)
+    cur.execute(create_country_views_sql)
+    if cur.execute('SELECT COUNT(*) FROM Series_version').fetchone()[0] == 0: # histories ingested before versions
+        cur.execute('INSERT INTO Series_version SELECT DISTINCT Country_code, 0 FROM Status_history')
     conn.commit()
     conn.close()
 
 def add_country_info_sqlite(country_name):
-    conn = sqlite3.connect(DB_NAME)
+    conn = storage.connect(DB_NAME)
     cur = conn.cursor()
 
     insert_country_info_sql = '''
@@ -280,14 +441,8 @@ def add_country_info_sqlite(country_name):
     '''
 
     country_code = get_country_code(country_name)
-    first_letter=country_name[0]
-    country_list=get_country_name_list(first_letter)
-    country_population = None
+    country_population = get_country_directory().population(country_code)
 
-    for item in country_list:
-        if country_name in item:
-            country_population = int(item.split()[-1])
-    
     try:
         cur.execute(insert_country_info_sql, [country_code, country_name, country_population])
     except:
@@ -299,27 +454,52 @@ def add_country_info_sqlite(country_name):
 
 
 
-def add_history_sqlite(country_name):
+def add_history_sqlite(country_name, records=None):
+    '''
+    write the daily history of a country into Status_history in one batched
+    transaction, inserting new days and updating the ones already stored.
+    The records are converted to typed columns in one pass by
+    normalize.normalize_history
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    Parameters
+    ----------
+    country_name
+        str: the country name
+    records
+        iterable: the daily records to write, defaults to the cached history
+        of the country; all of them are collected into a list before they
+        are normalized, so a stream is read to its end first
 
-    insert_history_sql = '''
-        INSERT INTO Status_history 
-        VALUES (?,?,?,?,?,?,?,?,?)
-    '''    
+    return
+        dic: rows inserted, updated and skipped (stored with the same
+        counts), days whose derived metrics were recomputed, and the elapsed
+        seconds
+    '''
+    start = time.perf_counter()
+    conn = storage.connect(DB_NAME)
+    cur = conn.cursor()
 
-    update_sql = '''
-    update Status_history 
-    set Total_cases =?,
-        Total_deaths=?,
-        Active_cases =?,
-        Total_recovered=?,
-        Tot_case_pop_perc=?,
-        Tot_death_pop_perc=?,
-        Actv_case_pop_perc = ?
-    where country_code=? and
-        time = ?'''
+    # Updated_at is when the row was written, kept while its counts are unchanged
+    upsert_history_sql = '''
+        INSERT INTO Status_history (Country_code, Time, Total_cases, Total_deaths, Active_cases,
+                                    Total_recovered, Tot_case_pop_perc, Tot_death_pop_perc,
+                                    Actv_case_pop_perc, Updated_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT("Country_code","Time") DO UPDATE
+        SET Total_cases = excluded.Total_cases,
+            Total_deaths = excluded.Total_deaths,
+            Active_cases = excluded.Active_cases,
+            Total_recovered = excluded.Total_recovered,
+            Tot_case_pop_perc = excluded.Tot_case_pop_perc,
+            Tot_death_pop_perc = excluded.Tot_death_pop_perc,
+            Actv_case_pop_perc = excluded.Actv_case_pop_perc,
+            Updated_at = excluded.Updated_at
+        WHERE (Total_cases, Total_deaths, Active_cases, Total_recovered, Tot_case_pop_perc,
+               Tot_death_pop_perc, Actv_case_pop_perc)
+            IS NOT (excluded.Total_cases, excluded.Total_deaths, excluded.Active_cases,
+                    excluded.Total_recovered, excluded.Tot_case_pop_perc,
+                    excluded.Tot_death_pop_perc, excluded.Actv_case_pop_perc)
+    '''
 
 
     country_code = get_country_code(country_name)
@@ -333,226 +513,502 @@ def add_history_sqlite(country_name):
     result = cur.fetchone()
     population=int(list(result)[0])
 
-    country_records=get_country_total_case_history(country_code)
-    for record in country_records:
-        total_cases=0
-        active_cases=0
-        total_deaths=0
-        total_recovered = 0
-        if str(record.get("total_cases"))=='':
-            total_cases=0
-        else:
-            total_cases=int(str(record.get("total_cases")).replace(',', ''))
-
-        if str(record.get("active_cases"))=='':
-            active_cases=0
-        else:
-            active_cases=int(str(record.get("active_cases")).replace(',', ''))
+    cur.execute('SELECT Time, Total_cases, Total_deaths FROM Status_history WHERE Country_code = ?', [country_code])
+    stored = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    if records is None:
+        records=get_country_total_case_history(country_code)
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+
+    import normalize # numpy is only loaded once something is ingested
+    columns = normalize.normalize_history(list(records), population)
+    times = columns["Time"].tolist()
+    already_stored = sum(1 for record_time in times if record_time in stored)
+    counts['inserted'] = len(times) - already_stored
+    # the derived metrics only change from the first day whose totals did
+    changed = [record_time for record_time, cases, deaths
+               in zip(times, columns["Total_cases"].tolist(), columns["Total_deaths"].tolist())
+               if stored.get(record_time) != (cases, deaths)]
+
+    # the first write takes the write lock, so the Updated_at stamps below
+    # increase in commit order, which incremental exports rely on
+    cur.execute('INSERT OR IGNORE INTO Series_version VALUES (?, 0)', [country_code])
+    last_updated_at = cur.execute('SELECT MAX(Updated_at) FROM Status_history').fetchone()[0]
+    updated_at = max(time.time(), (last_updated_at or 0) + 1e-6)
+    cur.executemany(upsert_history_sql, (row + (updated_at,) for row in normalize.rows(country_code, columns)))
+    written = cur.rowcount # rows inserted or actually changed
+    counts['updated'] = written - counts['inserted']
+    counts['skipped'] = already_stored - counts['updated'] # stored already with the same counts
+    counts['derived'] = derived.refresh(conn, country_code, min(changed) if changed else None)
+    changed_series = bool(written or counts['derived'])
+    if changed_series:
+        cur.execute('UPDATE Series_version SET Version = Version + 1 WHERE Country_code = ?', [country_code])
+    conn.commit()
+    if USE_COLUMN_STORE and changed_series: # otherwise the current file, if any, still holds the data
+        write_series_columns(country_code, conn)
+    conn.close()
+    counts['elapsed'] = time.perf_counter() - start
+    instrumentation.observe("ingest", counts['elapsed'])
+    for action in ('inserted', 'updated', 'skipped', 'derived'):
+        instrumentation.count("ingest_rows", counts[action], action=action)
+    return counts
 
-        if str(record.get("total_deaths"))=='':
-            total_deaths=0
-        else:
-            total_deaths=int(str(record.get("total_deaths")).replace(',', ''))
-        
-        if str(record.get("total_recovered"))=='':
-            total_deaths=0        
-        elif str(record.get("total_recovered")) == "N/A" :
-            total_recovered = total_cases - total_deaths - active_cases
-        else :
-            total_recovered = int(str(record.get("total_recovered")).replace(',', ''))
-        # print(total_recovered)
-        
-        tot_case_pop_perc=(float(total_cases)/population)*100
-        tot_death_pop_perc=(float(total_deaths)/population)*100
-        actv_case_pop_perc=(float(active_cases)/population)*100
-        time=record.get("record_date")[0:10]
-        
-        try:
-            cur.execute(insert_history_sql, [
-            country_code,
-            time,
-            total_cases,
-            total_deaths,
-            active_cases,
-            total_recovered,
-            tot_case_pop_perc,
-            tot_death_pop_perc,
-            actv_case_pop_perc
-            ])
-        except: 
-            cur.execute(update_sql, [
-            total_cases,
-            total_deaths,
-            active_cases,
-            total_recovered,
-            tot_case_pop_perc,
-            tot_death_pop_perc,
-            actv_case_pop_perc,
-            country_code,
-            time
-            ])
+def ingest_country(country_name, records=None):
+    '''
+    make sure Country_info and Status_history hold the history of a country.
+    The fetch time of the cached history payload is its version: when the
+    version already ingested is still the cached one nothing is scraped or
+    rewritten, so only a new payload costs an ingestion
 
-    conn.commit()
-    conn.close()  
+    Parameters
+    ----------
+    country_name
+        str: the country name
+    records
+        list: the cached history when the caller already has it
 
-def get_all_date(country_code):
-    conn = sqlite3.connect(DB_NAME)
+    return
+        str: the 2 letter country code
+    '''
+    country_code = get_country_code(country_name)
+    conn = storage.connect(DB_NAME)
     cur = conn.cursor()
+    cur.execute('SELECT Source_version FROM Ingestion_state WHERE Country_code = ?',
+                [country_code])
+    result = cur.fetchone()
+    conn.close()
 
-    total_case='''
-    SELECT Time
-    FROM Status_history
-    WHERE Country_code = ?
+    source_version = CACHE_DICT.stored_at(HISTORY_URL + country_code)
+    if result is not None and source_version is not None and result[0] == source_version:
+        return country_code
+
+    add_country_info_sqlite(country_name)
+    add_history_sqlite(country_name, records=records)
+    source_version = CACHE_DICT.stored_at(HISTORY_URL + country_code)
+    if source_version is not None:
+        conn = storage.connect(DB_NAME)
+        conn.execute('''
+            INSERT OR REPLACE INTO Ingestion_state
+            VALUES (?,?,?)
+        ''', [country_code, source_version, time.time()])
+        conn.commit()
+        conn.close()
+    return country_code
+
+def parse_count(value):
+    '''a count as the API writes it ("1,234", "", "N/A" or None) as an int,
+    None when there is no number
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0][0:10])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    value = str(value).replace(',', '').strip() if value is not None else ''
+    return int(value) if value.isdigit() else None
 
-def get_total_cases_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def format_count(count):
+    '''a count with thousands separators, N/A when unknown'''
+    return "N/A" if count is None else "{:,}".format(count)
 
-    total_case='''
-    SELECT Total_cases
-    FROM Status_history
-    WHERE Country_code = ?
+def status_from_record(record):
+    '''the current status from a latest_stat_by_country record
+    Parameters
+    ----------
+    record
+        dic: one record of the latest status endpoint
+
+    return
+        dic: total_cases, new_cases, active_cases, total_deaths, new_deaths,
+        total_recovered (ints or None), record_date and source 'live'
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    status = {key: parse_count(record.get(key)) for key in
+              ("total_cases", "new_cases", "active_cases", "total_deaths", "new_deaths", "total_recovered")}
+    if status["total_recovered"] is None and None not in (status["total_cases"], status["total_deaths"], status["active_cases"]):
+        status["total_recovered"] = status["total_cases"] - status["total_deaths"] - status["active_cases"]
+    status["record_date"] = str(record.get("record_date") or "")[0:10]
+    status["source"] = "live"
+    return status
+
+def status_from_history(country_code):
+    '''the current status from the two newest Status_history rows of a
+    country, new cases and new deaths being the change since the day before
 
+    return
+        dic: same keys as status_from_record with source 'history', None
+        when nothing is stored for the country
+    '''
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT Time, Total_cases, Total_deaths, Active_cases, Total_recovered
+        FROM Status_history
+        WHERE Country_code = ?
+        ORDER BY Time DESC
+        LIMIT 2
+    ''', [country_code]).fetchall()
+    if not rows:
+        return None
+    record_date, total_cases, total_deaths, active_cases, total_recovered = rows[0]
+    new_cases = new_deaths = None
+    if len(rows) == 2:
+        new_cases = total_cases - rows[1][1]
+        new_deaths = total_deaths - rows[1][2]
+    return {
+        "total_cases": total_cases,
+        "new_cases": new_cases,
+        "active_cases": active_cases,
+        "total_deaths": total_deaths,
+        "new_deaths": new_deaths,
+        "total_recovered": total_recovered,
+        "record_date": record_date,
+        "source": "history",
+    }
+
+def get_country_current_status(country_name, max_age=STATUS_MAX_AGE):
+    '''
+    the current status of a country, read from the newest stored history day
+    when the history was fetched less than max_age seconds ago, so viewing a
+    country costs no latest status request. A history cached that recently
+    but not ingested yet is ingested first, without fetching anything. Older
+    or missing histories fall back to the latest status endpoint.
 
-def get_totl_case_pop_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    Parameters
+    ----------
+    country_name
+        str: the country name
+    max_age
+        float: seconds a fetched history stays fresh enough, 0 to always ask
+        the latest status endpoint
 
-    total_case='''
-    SELECT Tot_case_pop_perc
-    FROM Status_history
-    WHERE Country_code = ?
+    return
+        dic: see status_from_record
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    country_code = get_country_code(country_name)
+    if max_age:
+        now = time.time()
+        cached_version = CACHE_DICT.stored_at(HISTORY_URL + country_code)
+        if cached_version is not None and now - cached_version <= max_age:
+            ingest_country(country_name) # a no-op when this payload is already ingested
+        row = get_db_connection().execute(
+            'SELECT Source_version FROM Ingestion_state WHERE Country_code = ?',
+            [country_code]).fetchone()
+        if row is not None and now - row[0] <= max_age:
+            status = status_from_history(country_code)
+            if status is not None:
+                instrumentation.count("current_status", source="history")
+                return status
+    instrumentation.count("current_status", source="live")
+    return status_from_record(get_country_latest_status(country_code)[0])
+
+def get_db_connection():
+    '''
+    the connection the series queries of the current thread share, opened
+    on first use, so several threads (e.g. the data threads of the service)
+    can query at once
 
-def get_total_deaths_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    return
+        sqlite3.Connection
+    '''
+    conn = getattr(DB_CONNS, "conn", None)
+    if conn is None:
+        conn = DB_CONNS.conn = storage.connect(DB_NAME)
+    return conn
 
-    total_case='''
-    SELECT Total_deaths
-    FROM Status_history
-    WHERE Country_code = ?
+def record_view(country_code):
+    '''count one lookup of a country by a user, see refresh.RefreshScheduler'''
+    record_views({country_code: 1})
+
+def record_views(views):
+    '''
+    count lookups of countries by users in one transaction
+
+    Parameters
+    ----------
+    views
+        dic: country code -> lookups since the last call
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
+    if not views:
+        return
+    conn = get_db_connection()
+    now = time.time()
+    conn.executemany('''
+        INSERT INTO Country_views VALUES (?, ?, ?)
+        ON CONFLICT("Country_code") DO UPDATE
+        SET Views = Views + excluded.Views, Last_viewed = excluded.Last_viewed
+    ''', [(country_code, count, now) for country_code, count in views.items()])
     conn.commit()
-    conn.close()  
-    return res
 
-def get_totl_deaths_pop_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def country_views(conn=None):
+    '''
+    how many times each country was looked up
 
-    total_case='''
-    SELECT Tot_death_pop_perc
-    FROM Status_history
-    WHERE Country_code = ?
+    Parameters
+    ----------
+    conn
+        sqlite3.Connection: the database, by default the shared connection
+
+    return
+        dic: country code -> views
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    return dict((conn or get_db_connection()).execute('SELECT Country_code, Views FROM Country_views'))
 
-def get_active_cases_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def get_column_store():
+    '''
+    the column store of the series, set up on first use
 
-    total_case='''
-    SELECT Active_cases
-    FROM Status_history
-    WHERE Country_code = ?
+    return
+        columnar.ColumnStore
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    global COLUMN_STORE
+    if COLUMN_STORE is None:
+        import columnar # numpy is only loaded once a series is read
+        COLUMN_STORE = columnar.ColumnStore(COLUMN_STORE_DIR, SERIES_COLUMNS)
+    return COLUMN_STORE
+
+def series_version(conn, country_code):
+    '''the version of the stored series of a country, None before its first ingestion'''
+    result = conn.execute('SELECT Version FROM Series_version WHERE Country_code = ?', [country_code]).fetchone()
+    return None if result is None else result[0]
+
+def write_series_columns(country_code, conn=None):
+    '''
+    copy every series of a country from the database into the column store,
+    under the version it was read at
 
-def get_activ_case_pop_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    Parameters
+    ----------
+    country_code
+        str: the 2 letter country code
+    conn
+        sqlite3.Connection: the database, by default the shared connection
 
-    total_case='''
-    SELECT Actv_case_pop_perc
-    FROM Status_history
-    WHERE Country_code = ?
+    return
+        columnar.Series: the columns written, None when the country has no
+        version yet or another process changed it while it was read
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    conn = conn or get_db_connection()
+    version = series_version(conn, country_code)
+    if version is None:
+        return None
+    series = query_series(country_code, list(SERIES_COLUMNS), conn)
+    if series_version(conn, country_code) != version:
+        return None
+    store = get_column_store()
+    store.write(country_code, version, series)
+    return store.read(country_code, version)
+
+def get_series(country_code, metrics=None):
+    '''
+    any subset of the Status_history and Derived_metrics metrics of a
+    country, as columns rather than rows. With USE_COLUMN_STORE they are
+    views of the memory mapped copy matching the current Series_version,
+    written from the database first when missing; otherwise they are queried
 
-def get_total_recovered_data (country_code):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    Parameters
+    ----------
+    country_code
+        str: the 2 letter country code
+    metrics
+        list: column names from SERIES_COLUMNS, None for all of them
+
+    return
+        dic: "Time" -> numpy datetime64[D] array, and one numpy array per
+        metric; read only when they come from the column store
+    '''
+    if metrics is None:
+        metrics = list(SERIES_COLUMNS)
+    for metric in metrics:
+        if metric not in SERIES_COLUMNS:
+            raise ValueError("Unknown metric: " + metric)
+    if USE_COLUMN_STORE:
+        with instrumentation.timed("query"):
+            version = series_version(get_db_connection(), country_code)
+            columns = None if version is None else get_column_store().read(country_code, version)
+        if columns is None and version is not None:
+            columns = write_series_columns(country_code)
+        if columns is not None:
+            instrumentation.count("series_reads", source="columns")
+            return columns.subset(["Time"] + metrics)
+    instrumentation.count("series_reads", source="sqlite")
+    return query_series(country_code, metrics)
+
+def query_series(country_code, metrics, conn=None):
+    '''
+    fetch metrics of a country from Status_history and Derived_metrics in
+    one query ordered by date
+
+    Parameters
+    ----------
+    country_code
+        str: the 2 letter country code
+    metrics
+        list: column names from SERIES_COLUMNS
+    conn
+        sqlite3.Connection: the database, by default the shared connection
 
-    total_case='''
-    SELECT Total_recovered
-    FROM Status_history
+    return
+        dic: "Time" -> numpy datetime64[D] array, and one numpy array per metric
+    '''
+    tables = "Status_history"
+    if any(metric in derived.DERIVED_COLUMNS for metric in metrics):
+        tables += " LEFT JOIN Derived_metrics USING (Country_code, Time)"
+    series_sql = '''
+    SELECT Time, {}
+    FROM {}
     WHERE Country_code = ?
+    ORDER BY Time
+    '''.format(", ".join(metrics), tables)
+    import numpy as np
+    with instrumentation.timed("query"):
+        rows = (conn or get_db_connection()).execute(series_sql, [country_code]).fetchall()
+        dtype = [("Time", "datetime64[D]")] + [(metric, SERIES_COLUMNS[metric]) for metric in metrics]
+        table = np.array(rows, dtype=dtype)
+    series = {"Time": table["Time"]}
+    for metric in metrics:
+        series[metric] = table[metric]
+    return series
+
+def check_comparison(metric, per_capita=False, fill="none"):
+    ''' raise ValueError unless get_comparison can compare metric this way,
+    so that callers can check before ingesting anything '''
+    if metric not in SERIES_COLUMNS:
+        raise ValueError("Unknown metric: " + metric)
+    if fill not in FILL_METHODS:
+        raise ValueError("Unknown fill method: " + fill)
+    if per_capita and metric not in PER_CAPITA_METRICS:
+        raise ValueError("Not a count, cannot be per capita: " + metric)
+
+
+def get_comparison(country_codes, metric, per_capita=False, fill="none", since=None, until=None):
     '''
-    cur.execute(total_case,[country_code])
-    result = list(cur.fetchall())
-    res = []
-    for item in result:
-        res.append(list(item)[0])
-    #print(res)
-    conn.commit()
-    conn.close()  
-    return res
+    one metric of several countries in one query, aligned on the dates any
+    of them has so that every country is a row of the same 2-D array
 
+    A country without a row on a date has a gap there, filled as asked:
+    "none" leaves NaN, "previous" repeats the last stored value of the
+    country (NaN before its first one), "zero" puts 0. Stored values that
+    are NULL, e.g. derived metrics still inside their window, stay NaN and
+    are not gaps.
 
-if __name__ == "__main__":
-    # state_dic=build_state_url_dict()
-    # state_names=state_dic.keys()
-    graphic_list=["[1] Total case history", "[2] Total case/population history", "[3] Total death history", "[4] Total death/population history", "[5] Total active history", "[6] Total active/population history","[7] Total recovered history"]
+    Parameters
+    ----------
+    country_codes
+        list: 2 letter country codes, one row each in this order
+    metric
+        str: a column name from SERIES_COLUMNS
+    per_capita
+        bool: divide by Country_info.Population and multiply by PER_CAPITA,
+        only for the counts in PER_CAPITA_METRICS
+    fill
+        str: one of FILL_METHODS
+    since, until
+        str: first and last date (YYYY-MM-DD) to load, None for no limit
+
+    return
+        dic: "Time" -> numpy datetime64[D] array of the shared dates,
+        "Country_code" -> list of the codes, "Values" -> float array of
+        shape (countries, dates), "Present" -> bool array of the same shape,
+        False on the gaps
+    '''
+    check_comparison(metric, per_capita, fill)
+    codes = list(dict.fromkeys(code.upper() for code in country_codes))
+    table = "Derived_metrics" if metric in derived.DERIVED_COLUMNS else "Status_history"
+    conditions = ["Country_code IN ({})".format(",".join("?" * len(codes)))]
+    parameters = list(codes)
+    if since is not None:
+        conditions.append("Time >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("Time <= ?")
+        parameters.append(until)
+    comparison_sql = '''
+    SELECT Country_code, Time, {}
+    FROM {}
+    WHERE {}
+    '''.format(metric, table, " AND ".join(conditions))
+    import numpy as np
+    with instrumentation.timed("query"):
+        conn = get_db_connection()
+        rows = conn.execute(comparison_sql, parameters).fetchall() if codes else []
+        populations = dict(conn.execute('''
+            SELECT Country_code, Population FROM Country_info WHERE Country_code IN ({})
+        '''.format(",".join("?" * len(codes))), codes).fetchall()) if per_capita else {}
+        stored = np.array(rows, dtype=[("Country_code", "U2"), ("Time", "datetime64[D]"), ("Value", "f8")])
+    dates, column = np.unique(stored["Time"], return_inverse=True)
+    requested = np.array(codes, dtype="U2")
+    order = np.argsort(requested)
+    row = order[np.searchsorted(requested, stored["Country_code"], sorter=order)]
+    values = np.full((len(codes), len(dates)), np.nan)
+    present = np.zeros((len(codes), len(dates)), dtype=bool)
+    values[row, column] = stored["Value"]
+    present[row, column] = True
+    if fill == "previous" and values.size:
+        # the column of the last stored value at or before every date
+        last = np.maximum.accumulate(np.where(present, np.arange(len(dates)), 0), axis=1)
+        values = np.where(present, values, values[np.arange(len(codes))[:, None], last])
+    elif fill == "zero":
+        values[~present] = 0.0
+    if per_capita:
+        population = np.array([populations.get(code) or np.nan for code in codes], dtype=float)
+        values = values / population[:, None] * PER_CAPITA
+    return {"Time": dates, "Country_code": codes, "Values": values, "Present": present}
+
+def comparison_title(metric, country_codes, per_capita=False):
+    '''the title of a comparison chart, e.g. "Total cases per 100,000 people: US, GB"'''
+    title = dict(GRAPHICS)[metric].replace(" history of ", "").strip()
+    if per_capita:
+        title += " per {:,} people".format(PER_CAPITA)
+    if len(country_codes) > 10:
+        return "{}: {} countries".format(title, len(country_codes))
+    return "{}: {}".format(title, ", ".join(country_codes))
+
+def write_comparison_chart(country_codes, metric, out_dir=CHART_DIR, webgl=False, **options):
+    '''
+    ingest the countries as needed and write the chart comparing them
+
+    Parameters
+    ----------
+    country_codes
+        list: 2 letter country codes
+    metric
+        str: a column name from SERIES_COLUMNS
+    out_dir
+        str: the directory the html file is written to
+    webgl
+        bool: draw with Scattergl (WebGL) instead of SVG
+    options
+        per_capita, fill, since and until, passed to get_comparison
+
+    return
+        str: the html file
+    '''
+    check_comparison(metric, options.get("per_capita", False), options.get("fill", "none"))
+    directory = get_country_directory()
+    codes = [code.upper() for code in country_codes]
+    names = {code: directory.name_for(code) for code in codes}
+    unknown = [code for code, name in names.items() if name is None]
+    if unknown:
+        raise ValueError("unknown country code " + ", ".join(unknown))
+    for code in codes:
+        ingest_country(names[code])
+    comparison = get_comparison(codes, metric, **options)
+    import charts # plotly is only loaded once a chart is asked for
+    with instrumentation.timed("render"):
+        fig = charts.build_comparison(comparison, comparison_title(metric, codes, options.get("per_capita")),
+                                      names=names, webgl=webgl)
+        os.makedirs(out_dir, exist_ok=True)
+        charts.ensure_plotlyjs(out_dir)
+        chart_file = os.path.join(out_dir, "compare_" + metric + ("_per_capita" if options.get("per_capita") else "") + ".html")
+        charts.write_chart(fig, chart_file)
+    return chart_file
+
+
+def run_interactive(status_max_age=STATUS_MAX_AGE):
+    '''
+    the interactive session: pick a letter, a country and then its charts
+
+    Parameters
+    ----------
+    status_max_age
+        float: see get_country_current_status
+    '''
+    graphic_list=["[1] Total case history", "[2] Total case/population history", "[3] Total death history", "[4] Total death/population history", "[5] Total active history", "[6] Total active/population history","[7] Total recovered history", "[8] Daily new cases", "[9] New cases, 7-day average", "[10] New cases, 14-day average", "[11] Daily new deaths", "[12] New deaths, 7-day average", "[13] New deaths, 14-day average", "[14] Growth rate of cases", "[15] Doubling time of cases"]
+    create_db()
     status=True
     while status:
         user_input=input("Enter an initial letter (e.g. A) or 'exit': ")
@@ -603,21 +1059,6 @@ if __name__ == "__main__":
                 else:
                     country=countries[int(new_input)-1]
                     print("-"*20)
-                    country_code=get_country_code(country)
-                    country_latest_status=get_country_latest_status(country_code)
-                    total_cases=country_latest_status[0].get("total_cases")
-                    new_cases=country_latest_status[0].get("new_cases")
-                    active_cases=country_latest_status[0].get("active_cases")
-                    total_deaths=country_latest_status[0].get("total_deaths")
-                    new_deaths=country_latest_status[0].get("new_deaths")
-                    total_recovered=0
-                    if country_latest_status[0].get("total_recovered")=="N/A":
-                        total_recovered = int(total_cases.replace(',', '')) - int(total_deaths.replace(',', '')) - int(active_cases.replace(',', ''))
-                    else :
-                        total_recovered = country_latest_status[0].get("total_recovered")
-                    record_date=country_latest_status[0].get("record_date")[1:10]
-
-                    print()
                     other_info = country.split()[1:-1]
                     country_name = ""
                     for info in other_info:
@@ -625,18 +1066,23 @@ if __name__ == "__main__":
                             country_name += info
                         else:
                             country_name += (" " + info)
+                    country_code=get_country_code(country_name)
+                    record_view(country_code)
+                    current = get_country_current_status(country_name, status_max_age)
+
+                    print()
                     print()
                     print("Current status of " + country_name)
-                    print("Total cases: "+ total_cases)
-                    print("New cases: "+ new_cases)
-                    print("Active cases: "+ active_cases)
+                    print("Total cases: "+ format_count(current["total_cases"]))
+                    print("New cases: "+ format_count(current["new_cases"]))
+                    print("Active cases: "+ format_count(current["active_cases"]))
                     print()
-                    print("Total deaths: "+ total_deaths)
-                    print("New deaths: "+ new_deaths)
+                    print("Total deaths: "+ format_count(current["total_deaths"]))
+                    print("New deaths: "+ format_count(current["new_deaths"]))
                     print()
-                    print("Total recovered: "+ str(total_recovered))
+                    print("Total recovered: "+ format_count(current["total_recovered"]))
                     print()
-                    print("Update time: "+ record_date)
+                    print("Update time: "+ current["record_date"])
 
                     print("-"*20)      
                     print()
@@ -655,48 +1101,200 @@ if __name__ == "__main__":
                             break
                         elif not (graph_input.isnumeric()):
                             print ("[Error] Invalid input, please enter a number")
-                        elif int(graph_input)> len(graphic_list):
+                        elif not 1 <= int(graph_input) <= len(graphic_list):
                             print("[Error] Invalid input, please enter a number between 1-"+str(len(graphic_list)))
                             #new_input=input("Choose the number for detail search or'exit'or'back': ")
                             
                         else:
-                            create_db()
-                            add_country_info_sqlite(country_name)
-                            add_history_sqlite(country_name)
-                            xvals=get_all_date(country_code)
-                            #data_type=[Total_cases,Total_deaths"]
-                            name=str()
-                            if graph_input== "1":
-                                yvals=get_total_cases_data(country_code)
-                                name="Total cases history of "
-                            elif graph_input== "2":
-                                yvals=get_totl_case_pop_data(country_code)
-                                name="Total cases over population (in %) history of "
-                            elif graph_input== "3":
-                                yvals=get_total_deaths_data(country_code)
-                                name="Total deaths history of "
-                            elif graph_input== "4":
-                                yvals=get_totl_deaths_pop_data(country_code)
-                                name="Total deaths population (in %) history of "
-                            elif graph_input== "5":
-                                yvals=get_active_cases_data(country_code)
-                                name="Active cases history of "
-                            elif graph_input== "6":
-                                yvals=get_activ_case_pop_data(country_code)
-                                name="Active cases population (in %) history of "
-                            elif graph_input== "7":
-                                yvals=get_total_recovered_data(country_code)
-                                name="Total recovered history of "
-                                                   
-                            scatter_data = go.Scatter(x=xvals, y=yvals, mode='lines+markers')
-                            basic_layout = go.Layout(title=name + country_name)
-                            fig = go.Figure(data=scatter_data, layout=basic_layout)
-                            fig.write_html("scatter.html", auto_open=True)
-
-
-
-
-
-
+                            ingest_country(country_name)
+                            metric, name = GRAPHICS[int(graph_input)-1]
+                            series = get_series(country_code, [metric])
+                            xvals = series["Time"]
+                            yvals = series[metric]
+
+                            import charts # plotly is only loaded once a chart is asked for
+                            with instrumentation.timed("render"):
+                                fig = charts.build_figure(xvals, yvals, name + country_name)
+                                os.makedirs(CHART_DIR, exist_ok=True)
+                                chart_file = os.path.join(CHART_DIR, country_code + "_" + metric + ".html")
+                                charts.write_chart(fig, chart_file, auto_open=True)
+
+
+def main(argv=None):
+    import refresh
+    parser = argparse.ArgumentParser(
+        description="COVID-19 status and history by country. Without a command, start the interactive session.",
+        allow_abbrev=False) # or --metric(s) of a command would be taken for --metrics-out
+    parser.add_argument("--metrics-out", help="write timings and counters to this file when done")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile and tracemalloc, saving profile.pstats and printing a report")
+    parser.add_argument("--no-column-store", action="store_true",
+                        help="query every series from the database instead of the memory mapped copies in " + COLUMN_STORE_DIR)
+    parser.add_argument("--status-max-age", type=float, default=STATUS_MAX_AGE,
+                        help="seconds a fetched history answers the current status without a latest status request, 0 to always make it")
+    parser.add_argument("--refresh-age", type=float, default=refresh.REFRESH_AGE,
+                        help="seconds after which cached histories and statuses are fetched again in the background "
+                             "of the interactive session and the service, 0 to never")
+    parser.add_argument("--refresh-budget", type=int, default=refresh.REFRESH_BUDGET,
+                        help="requests the refreshes may make per --refresh-window")
+    parser.add_argument("--refresh-window", type=float, default=refresh.REFRESH_WINDOW, help="seconds")
+    commands = parser.add_subparsers(dest="command")
+
+    prefetch_parser = commands.add_parser(
+        "prefetch", help="warm the cache and Status_history for many countries")
+    prefetch_parser.add_argument("--countries", help="comma separated 2 letter codes, default every country in the directory")
+    prefetch_parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    prefetch_parser.add_argument("--rate", type=float, default=5.0, help="requests per second allowed by the API quota")
+    prefetch_parser.add_argument("--burst", type=int, default=None, help="requests allowed back to back, default one second of --rate")
+    prefetch_parser.add_argument("--retries", type=int, default=3, help="retries per request after a failure")
+    prefetch_parser.add_argument("--backoff", type=float, default=1.0, help="seconds before the first retry, doubled on each retry")
+    prefetch_parser.add_argument("--with-latest", action="store_true", help="also fetch the latest status")
+    prefetch_parser.add_argument("--refresh", action="store_true", help="fetch again even when cached")
+
+    batch_parser = commands.add_parser(
+        "batch", help="render charts for many countries without prompting")
+    batch_parser.add_argument("--countries", default="all", help="comma separated 2 letter codes or 'all'")
+    batch_parser.add_argument("--metrics", default="all", help="comma separated chart numbers (1-15) or metric names, or 'all'")
+    batch_parser.add_argument("--out", default="charts", help="directory the html files are written to")
+    batch_parser.add_argument("--workers", type=int, default=None, help="rendering processes, default one per CPU")
+    batch_parser.add_argument("--dashboard", action="store_true", help="one page per country with every metric instead of one file per metric")
+    batch_parser.add_argument("--webgl", action="store_true", help="draw with WebGL (Scattergl)")
+    batch_parser.add_argument("--max-points", type=int, default=None, help="downsample longer series with LTTB (default 2000), 0 to keep every point")
+    batch_parser.add_argument("--plotlyjs", choices=["directory", "inline", "cdn"], default="directory",
+                              help="share one plotly.min.js per output directory, embed it in every file, or load it from the CDN")
+
+    serve_parser = commands.add_parser(
+        "serve", help="serve the country list, status, series and charts over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8507)
+    serve_parser.add_argument("--data-workers", type=int, default=None,
+                              help="threads answering from the cache and the database, fetching what is missing")
+    serve_parser.add_argument("--render-workers", type=int, default=None, help="threads building charts")
+    serve_parser.add_argument("--cache-ttl", type=float, default=300, help="seconds a response is served from memory")
+    serve_parser.add_argument("--cache-size", type=int, default=1024, help="responses kept in memory, 0 for none")
+    serve_parser.add_argument("--webgl", action="store_true", help="draw charts with WebGL (Scattergl)")
+
+    compare_parser = commands.add_parser(
+        "compare", help="chart one metric of several countries on a shared date axis")
+    compare_parser.add_argument("--countries", required=True, help="comma separated 2 letter codes")
+    compare_parser.add_argument("--metric", default="1", help="a chart number (1-15) or metric name")
+    compare_parser.add_argument("--per-capita", action="store_true",
+                                help="per {:,} people, for the counts only".format(PER_CAPITA))
+    compare_parser.add_argument("--fill", choices=FILL_METHODS, default="none",
+                                help="dates a country has no row for: leave a gap, repeat its previous value or put 0")
+    compare_parser.add_argument("--since", help="first date, YYYY-MM-DD")
+    compare_parser.add_argument("--until", help="last date, YYYY-MM-DD")
+    compare_parser.add_argument("--out", default=CHART_DIR, help="directory the html file is written to")
+    compare_parser.add_argument("--webgl", action="store_true", help="draw with WebGL (Scattergl)")
+
+    refresh_parser = commands.add_parser(
+        "refresh", help="fetch again the cached histories and statuses older than --refresh-age (0 for all of them), "
+                        "most viewed countries first, within --refresh-budget")
+    refresh_parser.add_argument("--once", action="store_true", help="one round instead of one every --interval")
+    refresh_parser.add_argument("--interval", type=float, default=refresh.REFRESH_INTERVAL, help="seconds between rounds")
+
+    export_parser = commands.add_parser(
+        "export", help="write Status_history with the country names and populations to a CSV, Parquet or Arrow file")
+    export_parser.add_argument("--out", required=True, help="the file, its suffix (.csv, .parquet, .arrow) telling the format")
+    export_parser.add_argument("--format", choices=["csv", "parquet", "arrow"], default=None,
+                               help="the format when the suffix does not tell it; Parquet and Arrow need pyarrow")
+    export_parser.add_argument("--countries", help="comma separated 2 letter codes, default every country")
+    export_parser.add_argument("--since", help="first date, YYYY-MM-DD")
+    export_parser.add_argument("--until", help="last date, YYYY-MM-DD")
+    export_parser.add_argument("--incremental", action="store_true",
+                               help="only the rows written since the last incremental export to --out, "
+                                    "to a new file named after --out and the time of the export")
+    export_parser.add_argument("--chunk-rows", type=int, default=None, help="rows read and written at a time")
+
+    commands.add_parser(
+        "compact-cache", help="keep only extracted records for cached pages, compress large entries and report the sizes")
+
+    args = parser.parse_args(argv)
+    global USE_COLUMN_STORE
+    USE_COLUMN_STORE = USE_COLUMN_STORE and not args.no_column_store
+    budget = refresh.WindowBudget(args.refresh_budget, args.refresh_window)
+    scheduler = None
+    if args.command in (None, "serve") and args.refresh_age > 0:
+        create_db()
+        scheduler = refresh.RefreshScheduler(args.refresh_age, budget).start()
+    with instrumentation.profiled(args.profile):
+        if args.command == "batch":
+            import batch
+            codes = None if args.countries == "all" else args.countries.upper().split(",")
+            render_options = {"dashboard": args.dashboard, "webgl": args.webgl, "plotlyjs": args.plotlyjs}
+            if args.max_points is not None:
+                render_options["max_points"] = args.max_points or None
+            try:
+                batch.run_batch(codes, batch.parse_metrics(args.metrics), args.out, workers=args.workers,
+                                **render_options)
+            except ValueError as error: # an unknown country code or metric
+                parser.error(str(error))
+        elif args.command == "prefetch":
+            import prefetch
+            codes = args.countries.upper().split(",") if args.countries else None
+            try:
+                prefetch.prefetch(codes, concurrency=args.concurrency, rate=args.rate, burst=args.burst,
+                                  retries=args.retries, backoff=args.backoff,
+                                  with_latest=args.with_latest, refresh=args.refresh)
+            except ValueError as error: # an unknown country code
+                parser.error(str(error))
+        elif args.command == "serve":
+            import service
+            service.serve(args.host, args.port,
+                          ready=lambda port: print("Serving on http://{}:{}/".format(args.host, port)),
+                          data_workers=args.data_workers, render_workers=args.render_workers, cache_ttl=args.cache_ttl,
+                          cache_size=args.cache_size, status_max_age=args.status_max_age, webgl=args.webgl)
+        elif args.command == "compare":
+            import batch
+            create_db()
+            try:
+                graphics = batch.parse_metrics(args.metric)
+                if len(graphics) != 1:
+                    parser.error("--metric takes a single metric")
+                chart_file = write_comparison_chart(args.countries.upper().split(","), graphics[0][0], args.out,
+                                                    webgl=args.webgl, per_capita=args.per_capita,
+                                                    fill=args.fill, since=args.since, until=args.until)
+            except ValueError as error: # an unknown country code or metric, or a metric not per capita
+                parser.error(str(error))
+            print("Wrote " + chart_file)
+        elif args.command == "refresh":
+            create_db()
+            scheduler = refresh.RefreshScheduler(args.refresh_age, budget, interval=args.interval, progress=print)
+            if args.once:
+                scheduler.run_once()
+            else:
+                try:
+                    scheduler.run()
+                except KeyboardInterrupt:
+                    pass
+        elif args.command == "export":
+            import export
+            create_db()
+            export_options = {} if args.chunk_rows is None else {"chunk_rows": args.chunk_rows}
+            try:
+                summary = export.export_history(args.out, args.format,
+                                                countries=args.countries.upper().split(",") if args.countries else None,
+                                                since=args.since, until=args.until, incremental=args.incremental,
+                                                **export_options)
+            except (ValueError, RuntimeError) as error:
+                parser.error(str(error))
+            if summary['path'] is None:
+                print("No rows written since the last incremental export to " + args.out)
+            else:
+                print("Wrote {rows:,} rows to {path} in {elapsed:.1f}s".format(**summary))
+        elif args.command == "compact-cache":
+            compact_cache()
+        else:
+            run_interactive(args.status_max_age)
+    if scheduler is not None:
+        scheduler.stop(timeout=0)
+    if args.metrics_out:
+        instrumentation.dump(args.metrics_out, args.metrics_format)
 
 
+if __name__ == "__main__":
+    # run the imported module, the one batch, service and refresh import,
+    # so the options main sets are seen by them too
+    import final_project
+    final_project.main()
@@ -0,0 +1,129 @@
+import codecs
+import json
+
+# the array of records sits under one of these keys in the API responses
+PAYLOAD_KEYS = ("stat_by_country", "latest_stat_by_country")
+
+# consumed text is dropped from the front of the buffer once it grows past this
+_TRIM_AT = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _Buffer:
+    ''' text decoded so far from a stream of byte chunks, plus a read position '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def more(self):
+        ''' append the next chunk, returning False once the stream is over '''
+        if self.exhausted:
+            return False
+        if self.pos > _TRIM_AT:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.text += self.utf8.decode(chunk)
+                return True
+        self.text += self.utf8.decode(b'', final=True)
+        self.exhausted = True
+        return False
+
+    def peek(self):
+        ''' the next character that is not whitespace, None at the end '''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return None
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Malformed JSON payload: expected " + repr(char))
+        self.pos += 1
+
+    def value(self):
+        ''' decode the next JSON value, reading more chunks until it is complete '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.more():
+                    raise
+                continue
+            # a number cut by a chunk boundary still decodes, so a value that
+            # reaches the end of the buffer is only trusted once the stream is over
+            if end == len(self.text) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_payload_records(chunks, keys=PAYLOAD_KEYS):
+    ''' yield the records of the array stored under the first of `keys` found
+    in a JSON object, parsing the byte stream incrementally so the whole
+    array never has to be held in memory
+
+    Parameters
+    ----------
+    chunks
+        iterable: the response body as byte chunks
+    keys
+        tuple: names the record array may be stored under
+
+    Returns
+    -------
+    generator: one dict per record, in payload order
+    '''
+    buffer = _Buffer(chunks)
+    buffer.expect('{')
+    if buffer.peek() == '}':
+        raise ValueError("No record array in the payload")
+    while True:
+        key = buffer.value()
+        buffer.expect(':')
+        if key in keys and buffer.peek() == '[':
+            buffer.expect('[')
+            if buffer.peek() == ']':
+                return
+            while True:
+                yield buffer.value()
+                if buffer.peek() == ']':
+                    return
+                buffer.expect(',')
+        buffer.value()
+        if buffer.peek() == '}':
+            raise ValueError("No record array in the payload, looked for " + ", ".join(keys))
+        buffer.expect(',')
+
+
+def last_record_per_day(records):
+    ''' keep the last record of each run of records sharing a record_date day,
+    holding only one record back at a time
+
+    Parameters
+    ----------
+    records
+        iterable: API records, oldest first
+
+    Returns
+    -------
+    generator: one record per day, oldest first
+    '''
+    held = None
+    for record in records:
+        if held is not None and held["record_date"][0:10] != record["record_date"][0:10]:
+            yield held
+        held = record
+    if held is not None:
+        yield held
@@ -0,0 +1,136 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import instrumentation
+
+# (connect, read) seconds; the history endpoint can be slow to answer
+TIMEOUT = (5, 60)
+POOL_SIZE = 16
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_session(host):
+    ''' the pooled session for one host, created on first use so that every
+    request to that host reuses its keep-alive connections
+
+    Parameters
+    ----------
+    host
+        str: the host name
+
+    Returns
+    -------
+    requests.Session
+    '''
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            import requests # imported on the first request, not at startup
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _sessions[host] = session
+        return session
+
+
+def request(url, params=None, headers=None, etag=None, last_modified=None, timeout=None,
+            stream=False):
+    ''' GET a url through the session of its host, revalidating when the
+    validators of a cached copy are given
+
+    Parameters
+    ----------
+    url
+        str: the url
+    params
+        dic: query string parameters
+    headers
+        dic: extra request headers
+    etag
+        str: ETag of the cached copy, sent as If-None-Match
+    last_modified
+        str: Last-Modified of the cached copy, sent as If-Modified-Since
+    timeout
+        tuple: (connect, read) seconds, defaults to TIMEOUT
+    stream
+        bool: leave the body unread, to be consumed with iter_chunks()
+
+    Returns
+    -------
+    requests.Response: a 304 response means the cached copy is still current
+    '''
+    host = urlsplit(url).netloc
+    headers = dict(headers or {})
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    start = time.perf_counter()
+    response = get_session(host).get(url, params=params, headers=headers,
+                                     timeout=timeout or TIMEOUT, stream=stream)
+    elapsed = time.perf_counter() - start
+    # Content-Length is what went over the wire, before gzip is undone
+    size = response.headers.get('Content-Length')
+    if size and size.isdigit():
+        size = int(size)
+    elif stream:
+        size = 0 # counted by iter_chunks as the body is read
+    else:
+        size = len(response.content)
+    instrumentation.observe('fetch', elapsed, host=host)
+    instrumentation.count('fetch_bytes', size, host=host)
+    if response.status_code == 304:
+        instrumentation.count('fetch_not_modified', host=host)
+    return response
+
+
+def iter_chunks(response, chunk_size=64 * 1024):
+    ''' the body of a streamed response as decompressed byte chunks
+
+    Parameters
+    ----------
+    response
+        requests.Response: a response from request(..., stream=True)
+    chunk_size
+        int: bytes read at a time
+
+    Returns
+    -------
+    generator: byte chunks
+    '''
+    counted = response.headers.get('Content-Length', '').isdigit()
+    host = urlsplit(response.url).netloc
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if not counted:
+                instrumentation.count('fetch_bytes', len(chunk), host=host)
+            yield chunk
+    finally:
+        response.close()
+
+
+def host_stats():
+    ''' requests, 304 answers, bytes transferred and total latency per host
+
+    Returns
+    -------
+    dic: host -> dic of counters
+    '''
+    stats = {}
+    data = instrumentation.snapshot()
+    for timer in data['timers']:
+        if timer['name'] == 'fetch':
+            host = stats.setdefault(timer['labels']['host'],
+                                    {'requests': 0, 'not_modified': 0, 'bytes': 0, 'seconds': 0.0})
+            host['requests'] = timer['count']
+            host['seconds'] = timer['sum']
+    for counter in data['counters']:
+        if counter['name'] in ('fetch_bytes', 'fetch_not_modified') and counter['labels']['host'] in stats:
+            stats[counter['labels']['host']][counter['name'][6:]] = counter['value']
+    return stats
@@ -0,0 +1,163 @@
+import contextlib
+import json
+import threading
+import time
+
+import storage
+
+PROMETHEUS_PREFIX = "covid507_"
+
+_lock = threading.Lock()
+_counters = {}
+_timers = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def count(name, value=1, **labels):
+    ''' add to a counter, e.g. count("cache_hits", kind="page")
+
+    Parameters
+    ----------
+    name
+        str: the counter name
+    value
+        int: the amount to add
+    labels
+        str values telling apart series of the same counter
+
+    Returns
+    -------
+    None
+    '''
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    ''' record one duration of a timed stage '''
+    key = _key(name, labels)
+    with _lock:
+        timer = _timers.get(key)
+        if timer is None:
+            timer = _timers[key] = {'count': 0, 'sum': 0.0, 'max': 0.0}
+        timer['count'] += 1
+        timer['sum'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    ''' time the body of a with block as one observation of `name` '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    ''' every counter and timer recorded so far
+
+    Returns
+    -------
+    dic: "counters" and "timers", each a list of dics with name, labels and values
+    '''
+    with _lock:
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+        timers = [dict({'name': name, 'labels': dict(labels)}, **timer)
+                  for (name, labels), timer in sorted(_timers.items())]
+    return {'counters': counters, 'timers': timers}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def to_json():
+    return json.dumps(snapshot(), indent=2)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    pairs = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for key, value in sorted(labels.items())]
+    return '{' + ','.join(pairs) + '}'
+
+
+def to_prometheus():
+    ''' the snapshot in the Prometheus text exposition format: counters as
+    <name>_total, timers as <name>_seconds summaries (count and sum) '''
+    data = snapshot()
+    lines = []
+    seen = set()
+    for counter in data['counters']:
+        metric = PROMETHEUS_PREFIX + counter['name'] + '_total'
+        if metric not in seen:
+            seen.add(metric)
+            lines.append('# TYPE {} counter'.format(metric))
+        lines.append('{}{} {}'.format(metric, _prometheus_labels(counter['labels']), counter['value']))
+    for timer in data['timers']:
+        metric = PROMETHEUS_PREFIX + timer['name'] + '_seconds'
+        if metric not in seen:
+            seen.add(metric)
+            lines.append('# TYPE {} summary'.format(metric))
+        labels = _prometheus_labels(timer['labels'])
+        lines.append('{}_count{} {}'.format(metric, labels, timer['count']))
+        lines.append('{}_sum{} {:.6f}'.format(metric, labels, timer['sum']))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path, fmt='json'):
+    ''' write the snapshot to a file as 'json' or 'prometheus' text,
+    replacing it atomically so a collector never reads a partial file '''
+    storage.atomic_write(path, to_prometheus() if fmt == 'prometheus' else to_json())
+
+
+@contextlib.contextmanager
+def profiled(enabled, prefix='profile', top=25):
+    ''' run the body under cProfile and tracemalloc when enabled
+
+    The profile is saved to <prefix>.pstats (open it with pstats or snakeviz),
+    and the top functions by cumulative time, the top allocation sites and
+    the peak traced memory are printed when the block ends.
+
+    Parameters
+    ----------
+    enabled
+        bool: profile, or just run the body
+    prefix
+        str: path prefix of the saved profile
+    top
+        int: lines printed per report
+    '''
+    if not enabled:
+        yield
+        return
+    import cProfile
+    import pstats
+    import tracemalloc
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        memory = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(prefix + '.pstats')
+        print("-" * 20)
+        print("Profile saved to " + prefix + ".pstats")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+        print("Memory: peak {:.1f} MiB, still allocated {:.1f} MiB".format(peak / 2 ** 20, current / 2 ** 20))
+        for stat in memory.statistics('lineno')[:top]:
+            print(stat)
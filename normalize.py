@@ -0,0 +1,94 @@
+import operator
+
+import numpy as np
+
+# the count fields of a history record and the Status_history column each one fills
+COUNT_FIELDS = {
+    "total_cases": "Total_cases",
+    "total_deaths": "Total_deaths",
+    "active_cases": "Active_cases",
+    "total_recovered": "Total_recovered",
+}
+
+# Status_history columns after Country_code, in table order
+HISTORY_COLUMNS = ["Time", "Total_cases", "Total_deaths", "Active_cases", "Total_recovered",
+                   "Tot_case_pop_perc", "Tot_death_pop_perc", "Actv_case_pop_perc"]
+# longer counts are taken as missing; 18 digits always fit in an int64
+MAX_DIGITS = 18
+
+
+def parse_counts(values):
+    ''' turn API count strings ("1,234", "", "N/A", None...) into integers,
+    working on every string at once instead of one string at a time. As in
+    final_project.parse_count, commas are dropped and surrounding spaces
+    stripped, and what is left must be all digits.
+
+    Parameters
+    ----------
+    values
+        sequence: the strings
+
+    Returns
+    -------
+    tuple: int64 array with 0 where there is no number, and a bool array
+    telling which entries had one
+    '''
+    strings = np.array(values, dtype=str)
+    if strings.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    strings = np.char.strip(np.char.replace(strings, ",", ""))
+    present = np.char.isdecimal(strings) & (np.char.str_len(strings) <= MAX_DIGITS)
+    counts = np.zeros(len(strings), dtype=np.int64)
+    counts[present] = strings[present].astype(np.int64)
+    return counts, present
+
+
+def normalize_history(records, population):
+    ''' the Status_history columns of a list of history records
+
+    Missing values follow one rule for every field: an empty string, None,
+    "N/A" or anything else that is not a number counts as missing. Missing
+    cases, deaths and active cases are 0; a missing recovered count is
+    derived as cases - deaths - active. The percentages are of population.
+
+    Parameters
+    ----------
+    records
+        list: the records of a history payload, one per day
+    population
+        int: the population of the country
+
+    Returns
+    -------
+    dic: column name (see HISTORY_COLUMNS) -> numpy array, Time as
+    YYYY-MM-DD strings
+    '''
+    fields = ["record_date"] + list(COUNT_FIELDS)
+    try:
+        values = list(map(operator.itemgetter(*fields), records))
+    except KeyError:
+        values = [tuple(record.get(field) for field in fields) for record in records]
+    by_field = dict(zip(fields, zip(*values))) if values else {field: () for field in fields}
+    columns = {"Time": np.array(by_field["record_date"], dtype="U10")} # the date part of the timestamps
+    present = {}
+    for field, column in COUNT_FIELDS.items():
+        columns[column], present[column] = parse_counts(by_field[field])
+    derived = columns["Total_cases"] - columns["Total_deaths"] - columns["Active_cases"]
+    columns["Total_recovered"] = np.where(present["Total_recovered"], columns["Total_recovered"], derived)
+    columns["Tot_case_pop_perc"] = (columns["Total_cases"] / population) * 100
+    columns["Tot_death_pop_perc"] = (columns["Total_deaths"] / population) * 100
+    columns["Actv_case_pop_perc"] = (columns["Active_cases"] / population) * 100
+    return columns
+
+
+def rows(country_code, columns):
+    ''' the columns as Status_history rows of Python values, ready for
+    executemany
+
+    Returns
+    -------
+    iterator: lists, Country_code first, then HISTORY_COLUMNS
+    '''
+    time_column = columns["Time"].tolist()
+    return zip([country_code] * len(time_column), time_column,
+               *[columns[name].tolist() for name in HISTORY_COLUMNS[1:]])
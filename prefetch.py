@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+import final_project
+
+# statuses worth another try; any other HTTP error fails the country at once
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    ''' a thread-safe token bucket: acquire() blocks until a token is free
+
+    Parameters
+    ----------
+    rate
+        float: tokens added per second
+    capacity
+        int: most tokens the bucket holds, i.e. the longest burst,
+        defaults to one second worth of tokens
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_with_retry(url, code, bucket, retries, backoff):
+    ''' fetch one endpoint for one country, every attempt taking a token from
+    the bucket, retrying connection errors and retryable statuses with
+    exponential backoff (or the server's Retry-After when it is longer)
+
+    Parameters
+    ----------
+    url
+        str: the API endpoint
+    code
+        str: the 2 letter country code
+    bucket
+        TokenBucket: the shared rate limit
+    retries
+        int: retries after the first attempt
+    backoff
+        float: seconds before the first retry
+
+    Returns
+    -------
+    list: the records returned by final_project.fetch_api_records
+    '''
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            return final_project.fetch_api_records(url, code)
+        except requests.RequestException as error:
+            response = error.response
+            if attempt == retries or (response is not None and response.status_code not in RETRY_STATUS):
+                raise
+            delay = backoff * 2 ** attempt
+            retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(delay + random.uniform(0, backoff))
+
+
+def prefetch(codes=None, concurrency=4, rate=5.0, burst=None, retries=3, backoff=1.0,
+             with_latest=False, refresh=False, progress=print):
+    ''' warm the cache and Status_history for many countries at once
+
+    Requests run on a thread pool of `concurrency` workers and all share one
+    token bucket, so the API quota holds however many workers there are.
+    Workers only talk to the network; cache writes and ingestion happen on
+    the calling thread as results come in.
+
+    Parameters
+    ----------
+    codes
+        list: 2 letter country codes, None for every country in the directory
+    concurrency
+        int: requests in flight at once
+    rate
+        float: requests per second
+    burst
+        int: requests allowed back to back
+    retries
+        int: retries per request
+    backoff
+        float: seconds before the first retry
+    with_latest
+        bool: also fetch the latest status of every country
+    refresh
+        bool: fetch again even when the cache already has the entry
+    progress
+        function: called with one line of text per finished country and endpoint
+
+    Returns
+    -------
+    dic: fetched, cached and ingested counts, failures by key, elapsed seconds
+    '''
+    start = time.perf_counter()
+    directory = final_project.get_country_directory()
+    if codes is None:
+        codes = sorted(directory.by_code)
+    unknown = [code for code in codes if directory.name_for(code) is None]
+    if unknown:
+        raise ValueError("unknown country code " + ", ".join(unknown))
+    final_project.create_db()
+    cache = final_project.CACHE_DICT
+
+    urls = [final_project.HISTORY_URL]
+    if with_latest:
+        urls.append(final_project.LATEST_STATUS_URL)
+    jobs = []
+    cached = 0
+    for code in codes:
+        for url in urls:
+            if refresh or cache.stored_at(url + code) is None:
+                jobs.append((url, code))
+            else:
+                cached += 1
+
+    summary = {'fetched': 0, 'cached': cached, 'ingested': 0, 'failed': {}}
+    bucket = TokenBucket(rate, burst)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        for url, code in jobs:
+            futures[pool.submit(fetch_with_retry, url, code, bucket, retries, backoff)] = (url, code)
+        for done, future in enumerate(as_completed(futures), 1):
+            url, code = futures[future]
+            try:
+                cache[url + code] = future.result()
+            except Exception as error:
+                summary['failed'][url + code] = str(error)
+                progress("[{}/{}] {} failed: {}".format(done, len(jobs), code, error))
+                continue
+            summary['fetched'] += 1
+            progress("[{}/{}] {} fetched".format(done, len(jobs), code))
+
+    for code in codes:
+        if final_project.HISTORY_URL + code in summary['failed']:
+            continue
+        try:
+            final_project.ingest_country(directory.name_for(code))
+            summary['ingested'] += 1
+        except Exception as error:
+            summary['failed'][code] = "ingestion: " + str(error)
+            progress("{} not ingested: {}".format(code, error))
+
+    summary['elapsed'] = time.perf_counter() - start
+    progress("fetched {fetched}, already cached {cached}, ingested {ingested}, "
+             "failed {failures} in {elapsed:.1f}s".format(failures=len(summary['failed']), **summary))
+    return summary
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from collections import deque
+
+import final_project
+import instrumentation
+import storage
+
+REFRESH_AGE = 12 * 60 * 60 # API entries older than this are fetched again
+REFRESH_BUDGET = 100 # requests allowed per REFRESH_WINDOW, retries included
+REFRESH_WINDOW = 60 * 60
+REFRESH_INTERVAL = 5 * 60 # seconds between looks for stale entries
+
+
+class BudgetExhausted(Exception):
+    ''' the requests of the current window are used up '''
+
+
+class WindowBudget:
+    ''' at most `limit` requests in any `window` seconds. Unlike
+    prefetch.TokenBucket it never waits: acquire() raises BudgetExhausted,
+    so a refresh round stops and leaves the rest for a later one
+
+    Parameters
+    ----------
+    limit
+        int: requests per window
+    window
+        float: seconds
+    '''
+
+    def __init__(self, limit=REFRESH_BUDGET, window=REFRESH_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.spent = deque() # when each request of the window was made
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        while self.spent and self.spent[0] <= now - self.window:
+            self.spent.popleft()
+
+    def available(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return self.limit - len(self.spent)
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self.spent) >= self.limit:
+                raise BudgetExhausted("{} requests in {:g}s already made".format(self.limit, self.window))
+            self.spent.append(now)
+
+    def renews_in(self):
+        ''' seconds until a request is available again, 0 when one is '''
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self.spent) < self.limit:
+                return 0.0
+            return self.spent[0] + self.window - now
+
+
+class RefreshScheduler:
+    ''' keeps the cached API entries (histories and latest statuses) from
+    going stale: every round fetches again the entries older than max_age,
+    the countries viewed most first (see final_project.record_view), and
+    ingests the new histories. Viewed countries never fetched are fetched
+    too. Lookups keep being answered from the cached copy meanwhile.
+
+    The rounds run on a background thread after start(), or one at a time
+    with run_once(). They only use their own database connections, so they
+    can run next to the interactive session or the service.
+
+    Parameters
+    ----------
+    max_age
+        float: seconds after which an entry is refreshed
+    budget
+        WindowBudget: the requests rounds may make, by default REFRESH_BUDGET
+        per REFRESH_WINDOW
+    interval
+        float: seconds between rounds
+    retries, backoff
+        see prefetch.fetch_with_retry
+    progress
+        function: called with one line of text per refreshed entry and round,
+        None for silence
+    '''
+
+    def __init__(self, max_age=REFRESH_AGE, budget=None, interval=REFRESH_INTERVAL,
+                 retries=1, backoff=1.0, progress=None):
+        self.max_age = max_age
+        self.budget = budget if budget is not None else WindowBudget()
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress or (lambda line: None)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stale_entries(self, conn, now=None):
+        ''' the entries to refresh, in the order they will be
+
+        Returns
+        -------
+        list: (url, country code, stored_at) tuples, stored_at None for a
+        viewed country whose history was never fetched; the most viewed
+        countries first, then the oldest entries
+        '''
+        now = time.time() if now is None else now
+        views = final_project.country_views(conn)
+        stored = {}
+        for url in (final_project.HISTORY_URL, final_project.LATEST_STATUS_URL):
+            for key, stored_at in final_project.CACHE_DICT.stored_times(url).items():
+                stored[(url, key[len(url):])] = stored_at
+        for code in views:
+            stored.setdefault((final_project.HISTORY_URL, code), None)
+        stale = [(url, code, stored_at) for (url, code), stored_at in stored.items()
+                 if stored_at is None or now - stored_at >= self.max_age]
+        stale.sort(key=lambda entry: (-views.get(entry[1], 0), entry[2] or 0))
+        return stale
+
+    def refresh(self, url, code):
+        ''' fetch one entry again, replacing the cached copy, and ingest it
+        when it is a history; the database only changes where the history
+        did (see final_project.add_history_sqlite) '''
+        import prefetch # requests is only loaded once something is refreshed
+        cache = final_project.CACHE_DICT
+        key = url + code
+
+        def fetch():
+            records = prefetch.fetch_with_retry(url, code, self.budget, self.retries, self.backoff)
+            cache[key] = records
+            return records
+        records = final_project.API_FLIGHTS.do((cache.path, key), fetch) # shares a lookup's fetch in flight
+        if url == final_project.HISTORY_URL:
+            final_project.ingest_country(final_project.get_country_directory().name_for(code) or code, records)
+
+    def run_once(self):
+        ''' one round: refresh stale entries until none is left or the
+        budget runs out
+
+        Returns
+        -------
+        dic: refreshed and deferred counts, failures by key, elapsed seconds
+        '''
+        start = time.perf_counter()
+        summary = {'refreshed': 0, 'deferred': 0, 'failed': {}}
+        if final_project.COUNTRY_DIRECTORY is None and not os.path.exists(final_project.COUNTRY_DIRECTORY_FILE):
+            summary['elapsed'] = time.perf_counter() - start # nothing looked up yet, so nothing to keep warm
+            return summary
+        conn = storage.connect(final_project.DB_NAME)
+        try:
+            stale = self.stale_entries(conn)
+        finally:
+            conn.close()
+        for done, (url, code, _) in enumerate(stale):
+            if self._stop.is_set():
+                summary['deferred'] = len(stale) - done
+                break
+            try:
+                self.refresh(url, code)
+            except BudgetExhausted:
+                summary['deferred'] = len(stale) - done
+                break
+            except Exception as error:
+                summary['failed'][url + code] = str(error)
+                self.progress("{} refresh failed: {}".format(code, error))
+                continue
+            summary['refreshed'] += 1
+            self.progress("{} refreshed ({})".format(code, "history" if url == final_project.HISTORY_URL else "latest"))
+        for outcome in ('refreshed', 'deferred'):
+            instrumentation.count("refreshes", summary[outcome], outcome=outcome)
+        instrumentation.count("refreshes", len(summary['failed']), outcome="failed")
+        summary['elapsed'] = time.perf_counter() - start
+        if stale:
+            self.progress("refreshed {refreshed}, deferred {deferred}, failed {failures} in {elapsed:.1f}s".format(
+                failures=len(summary['failed']), **summary))
+        return summary
+
+    def run(self):
+        ''' rounds every interval until stop(); a round that ran out of
+        budget is followed by the next one as soon as the budget renews '''
+        while not self._stop.is_set():
+            delay = self.interval
+            try:
+                if self.run_once()['deferred']:
+                    delay = min(delay, max(1.0, self.budget.renews_in()))
+            except Exception as error: # e.g. the database stayed locked; try again next round
+                self.progress("refresh round failed: {}".format(error))
+            self._stop.wait(delay)
+
+    def start(self):
+        ''' run the rounds on a daemon thread '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="refresh", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        ''' end the rounds, waiting up to timeout for the current one '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,54 @@
+import re
+
+import instrumentation
+
+_parser = None
+
+
+def html_parser():
+    ''' the BeautifulSoup backend to use: lxml when it is installed, the
+    slower pure Python html.parser otherwise '''
+    global _parser
+    if _parser is None:
+        try:
+            import lxml  # noqa: F401
+            _parser = 'lxml'
+        except ImportError:
+            _parser = 'html.parser'
+    return _parser
+
+
+def table_rows(html, class_name, tag=None, source='page'):
+    ''' the cell texts of every body row of the first element with class
+    class_name, building a tree for that element only
+
+    A SoupStrainer drops everything outside the target element while the
+    page is tokenized, so the scripts, ads and navigation around the table
+    never become tree nodes.
+
+    Parameters
+    ----------
+    html
+        str: the page
+    class_name
+        str: one class of the element holding the table
+    tag
+        str: tag name of that element, None for any
+    source
+        str: label of the parse timer
+
+    Returns
+    -------
+    list: one list of cell texts per row, empty when the page has no such table
+    '''
+    from bs4 import BeautifulSoup, SoupStrainer
+    # while the page is parsed the strainer sees the raw class attribute, so
+    # match class_name as one word of it
+    strainer = SoupStrainer(tag, class_=re.compile(r'(^|\s){}(\s|$)'.format(re.escape(class_name))))
+    with instrumentation.timed('parse', source=source):
+        soup = BeautifulSoup(html, html_parser(), parse_only=strainer)
+        table = soup.find(tag, class_=class_name)
+        body = table.find('tbody') if table is not None else None
+        if body is None:
+            return []
+        return [[cell.get_text() for cell in row.find_all('td')] for row in body.find_all('tr')]
@@ -0,0 +1,422 @@
+import asyncio
+import json
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import final_project
+import instrumentation
+
+RESPONSE_TTL = 5 * 60 # seconds a response is served from memory
+RESPONSE_CACHE_SIZE = 1024 # responses kept in memory, least recently used dropped first
+MAX_HEADER_BYTES = 16 * 1024
+DATA_WORKERS = 8 # a request fetching a missing country holds one up to the API timeout
+VIEW_FLUSH_INTERVAL = 30 # seconds between writes of the counted country views
+PLOTLYJS_PATH = "/plotly.min.js"
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    ''' a request that gets an error status instead of a response '''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ResponseCache:
+    ''' the encoded responses of recent GET requests, by path and query
+
+    Parameters
+    ----------
+    ttl
+        float: seconds a response stays valid
+    size
+        int: most responses kept, 0 to keep none
+    '''
+
+    def __init__(self, ttl=RESPONSE_TTL, size=RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        if self.size <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+def _json(data):
+    return 200, "application/json", json.dumps(data).encode("utf-8")
+
+
+def _series_json(series):
+    ''' the columns of get_series as JSON ready lists, dates as YYYY-MM-DD '''
+    columns = {"Time": series["Time"].astype(str).tolist()}
+    for metric, values in series.items():
+        if metric != "Time":
+            columns[metric] = values.tolist()
+    return columns
+
+
+class Service:
+    ''' the HTTP endpoints, answered on an asyncio event loop
+
+    GET /countries?letter=a              countries starting with a letter
+    GET /status/<code>                   current status of a country
+    GET /series/<code>?metrics=a,b       history columns of a country
+    GET /chart/<code>/<metric>           html chart of one metric
+    GET /chart/<code>                    html dashboard of every metric
+    GET /compare?countries=a,b&metric=m  one metric of several countries,
+                                         aligned on shared dates; also
+                                         per_capita=1, fill, since, until
+    GET /compare/chart?...               the same as an html chart
+
+    Everything touching the cache store, the database or the API runs on a
+    pool of data threads, each with its own database connection (see
+    final_project.get_db_connection), so a country being fetched only holds
+    up the requests for it; building charts runs on a separate pool so a
+    slow chart never holds up the data requests. Neither ever runs on the
+    event loop itself. Successful
+    responses are kept in a ResponseCache, and concurrent requests for the
+    same uncached path wait for the first one instead of repeating it.
+
+    The countries every request looks up are counted in memory, cached
+    responses included, and added to Country_views every
+    view_flush_interval seconds in one transaction.
+
+    Parameters
+    ----------
+    data_workers
+        int: data threads, None for DATA_WORKERS
+    render_workers
+        int: threads building charts, None for the executor default
+    cache_ttl, cache_size
+        see ResponseCache
+    status_max_age
+        float: see final_project.get_country_current_status
+    webgl
+        bool: draw charts with Scattergl
+    view_flush_interval
+        float: seconds between writes of the view counts
+    '''
+
+    def __init__(self, data_workers=None, render_workers=None, cache_ttl=RESPONSE_TTL, cache_size=RESPONSE_CACHE_SIZE,
+                 status_max_age=final_project.STATUS_MAX_AGE, webgl=False,
+                 view_flush_interval=VIEW_FLUSH_INTERVAL):
+        self.data_executor = ThreadPoolExecutor(max_workers=data_workers or DATA_WORKERS,
+                                                thread_name_prefix="data")
+        self.render_executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="render")
+        self.cache = ResponseCache(cache_ttl, cache_size)
+        self.status_max_age = status_max_age
+        self.webgl = webgl
+        self._pending = {}
+        self.view_flush_interval = view_flush_interval
+        self._views = Counter() # country code -> lookups not written yet, only used on the event loop
+        self._view_flusher = None
+
+    async def _data(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.data_executor, function, *args)
+
+    async def _render(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.render_executor, function, *args)
+
+    def _country(self, code):
+        code = code.upper()
+        name = final_project.get_country_directory().name_for(code)
+        if name is None:
+            raise HTTPError(404, "unknown country code " + code)
+        return code, name
+
+    def _count_views(self, path, query):
+        ''' count the countries a request looks up, see flush_views '''
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts in (["compare"], ["compare", "chart"]):
+            codes = query.get("countries", [""])[0].split(",")
+        elif len(parts) in (2, 3) and parts[0] in ("status", "series", "chart"):
+            codes = [parts[1]]
+        else:
+            return
+        self._views.update(code.upper() for code in codes if len(code) == 2)
+
+    def _write_views(self, views):
+        directory = final_project.get_country_directory()
+        final_project.record_views({code: count for code, count in views.items()
+                                    if directory.name_for(code) is not None})
+
+    async def flush_views(self):
+        ''' add the views counted since the last flush to Country_views '''
+        views, self._views = self._views, Counter()
+        if not views:
+            return
+        try:
+            await self._data(self._write_views, views)
+        except Exception: # e.g. the database stayed locked; counted again with the next flush
+            self._views.update(views)
+
+    async def _flush_views_every(self):
+        while True:
+            await asyncio.sleep(self.view_flush_interval)
+            await self.flush_views()
+
+    # the handlers run in the data threads, except the chart ones which only
+    # fetch their series there
+
+    def _countries(self, query):
+        letter = query.get("letter", [""])[0]
+        if len(letter) != 1 or not letter.isalpha():
+            raise HTTPError(400, "letter must be a single letter")
+        return _json([{"number": country["number"], "name": country["name"],
+                       "population": country["population"], "code": country.get("code")}
+                      for country in final_project.get_country_directory().starting_with(letter)])
+
+    def _status(self, code):
+        code, name = self._country(code)
+        status = final_project.get_country_current_status(name, self.status_max_age)
+        return _json(dict(status, code=code, name=name))
+
+    def _metrics(self, spec):
+        if not spec:
+            return [metric for metric, _ in final_project.GRAPHICS]
+        metrics = spec.split(",")
+        for metric in metrics:
+            if metric not in final_project.SERIES_COLUMNS:
+                raise HTTPError(400, "unknown metric " + metric)
+        return metrics
+
+    def _load_series(self, code, metrics):
+        code, name = self._country(code)
+        final_project.ingest_country(name)
+        return name, final_project.get_series(code, metrics)
+
+    def _series(self, code, query):
+        metrics = self._metrics(query.get("metrics", [""])[0])
+        name, series = self._load_series(code, metrics)
+        return _json(dict(_series_json(series), code=code.upper(), name=name))
+
+    def _chart_html(self, name, series, graphics):
+        import charts # plotly is only loaded once a chart is asked for
+        with instrumentation.timed("render"):
+            if len(graphics) == 1:
+                metric, title = graphics[0]
+                fig = charts.build_figure(series["Time"], series[metric], title + name, webgl=self.webgl)
+            else:
+                fig = charts.build_dashboard(series, graphics, "COVID-19 history of " + name, webgl=self.webgl)
+            html = fig.to_html(include_plotlyjs=PLOTLYJS_PATH)
+        return 200, "text/html; charset=utf-8", html.encode("utf-8")
+
+    def _load_comparison(self, query):
+        codes = [code for code in query.get("countries", [""])[0].upper().split(",") if code]
+        if not codes:
+            raise HTTPError(400, "countries must list 2 letter codes")
+        names = dict(self._country(code) for code in codes)
+        metric = query.get("metric", ["Total_cases"])[0]
+        options = {"per_capita": query.get("per_capita", ["0"])[0] in ("1", "true"),
+                   "fill": query.get("fill", ["none"])[0],
+                   "since": query.get("since", [None])[0], "until": query.get("until", [None])[0]}
+        try:
+            final_project.check_comparison(metric, options["per_capita"], options["fill"])
+        except ValueError as error:
+            raise HTTPError(400, str(error))
+        for name in names.values():
+            final_project.ingest_country(name)
+        comparison = final_project.get_comparison(codes, metric, **options)
+        return names, metric, options["per_capita"], comparison
+
+    def _comparison(self, query):
+        names, metric, per_capita, comparison = self._load_comparison(query)
+        values = comparison["Values"].tolist()
+        present = comparison["Present"].tolist()
+        return _json({"Time": comparison["Time"].astype(str).tolist(), "metric": metric,
+                      "per_capita": per_capita, "names": names,
+                      # gaps and undefined values as null
+                      "countries": {code: [value if value == value else None for value in row]
+                                    for code, row in zip(comparison["Country_code"], values)},
+                      "present": dict(zip(comparison["Country_code"], present))})
+
+    def _comparison_html(self, names, metric, per_capita, comparison):
+        import charts
+        with instrumentation.timed("render"):
+            title = final_project.comparison_title(metric, comparison["Country_code"], per_capita)
+            fig = charts.build_comparison(comparison, title, names=names, webgl=self.webgl)
+            html = fig.to_html(include_plotlyjs=PLOTLYJS_PATH)
+        return 200, "text/html; charset=utf-8", html.encode("utf-8")
+
+    async def _comparison_chart(self, query):
+        loaded = await self._data(self._load_comparison, query)
+        return await self._render(self._comparison_html, *loaded)
+
+    async def _chart(self, code, metric=None):
+        if metric is None:
+            graphics = list(final_project.GRAPHICS)
+        else:
+            graphics = [graphic for graphic in final_project.GRAPHICS if graphic[0] == metric]
+            if not graphics:
+                raise HTTPError(400, "unknown metric " + metric)
+        name, series = await self._data(self._load_series, code, [metric for metric, _ in graphics])
+        return await self._render(self._chart_html, name, series, graphics)
+
+    @staticmethod
+    def _plotlyjs():
+        from plotly.offline import get_plotlyjs
+        return 200, "application/javascript", get_plotlyjs().encode("utf-8")
+
+    async def _route(self, path, query):
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts == ["countries"]:
+            return "countries", self._data(self._countries, query)
+        if len(parts) == 2 and parts[0] == "status":
+            return "status", self._data(self._status, parts[1])
+        if len(parts) == 2 and parts[0] == "series":
+            return "series", self._data(self._series, parts[1], query)
+        if parts == ["compare"]:
+            return "compare", self._data(self._comparison, query)
+        if parts == ["compare", "chart"]:
+            return "compare_chart", self._comparison_chart(query)
+        if len(parts) in (2, 3) and parts[0] == "chart":
+            return "chart", self._chart(*parts[1:])
+        if path == PLOTLYJS_PATH:
+            return "plotlyjs", self._render(self._plotlyjs)
+        raise HTTPError(404, "no such endpoint " + path)
+
+    async def respond(self, method, target):
+        ''' the response to one request
+
+        Returns
+        -------
+        tuple: status, content type and body (bytes)
+        '''
+        start = time.perf_counter()
+        route = "unknown"
+        try:
+            if method != "GET":
+                raise HTTPError(405, "only GET is supported")
+            url = urlsplit(target)
+            query = parse_qs(url.query)
+            self._count_views(url.path, query)
+            cached = self.cache.get(target)
+            if cached is not None:
+                instrumentation.count("response_cache_hits")
+                route = "cached"
+                return cached
+            pending = self._pending.get(target)
+            if pending is not None:
+                instrumentation.count("response_cache_coalesced")
+                route = "coalesced"
+                return await asyncio.shield(pending)
+            instrumentation.count("response_cache_misses")
+            route, work = await self._route(url.path, query)
+            pending = self._pending[target] = asyncio.ensure_future(work)
+            try:
+                response = await pending
+            finally:
+                del self._pending[target]
+            self.cache.put(target, response)
+            return response
+        except HTTPError as error:
+            return error.status, "application/json", json.dumps({"error": str(error)}).encode("utf-8")
+        except Exception as error:
+            return 500, "application/json", json.dumps({"error": str(error)}).encode("utf-8")
+        finally:
+            instrumentation.observe("request", time.perf_counter() - start, route=route)
+
+    async def handle(self, reader, writer):
+        ''' serve the requests of one connection, keeping it open between
+        requests unless the client asks otherwise '''
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                if headers.get("content-length", "0").isdigit() and int(headers.get("content-length", "0")):
+                    await reader.readexactly(int(headers["content-length"])) # bodies are ignored
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                status, content_type, body = await self.respond(method, target)
+                instrumentation.count("requests", status=status)
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, REASONS.get(status, ""), content_type, len(body),
+                    "keep-alive" if keep_alive else "close").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        ''' listen on host:port, returning the asyncio server '''
+        await self._data(final_project.create_db)
+        self._view_flusher = asyncio.ensure_future(self._flush_views_every())
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+
+    def close(self):
+        if self._views: # the views counted since the last flush
+            self.data_executor.submit(self._write_views, self._views)
+            self._views = Counter()
+        self.data_executor.shutdown(wait=False)
+        self.render_executor.shutdown(wait=False)
+
+
+def serve(host="127.0.0.1", port=8507, ready=None, **options):
+    ''' run the service until interrupted
+
+    Parameters
+    ----------
+    host, port
+        where to listen, port 0 for any free port
+    ready
+        function: called with the port once the service listens
+    options
+        passed to Service
+
+    Returns
+    -------
+    None
+    '''
+    service = Service(**options)
+
+    async def run():
+        server = await service.start(host, port)
+        bound = server.sockets[0].getsockname()[1]
+        if ready is not None:
+            ready(bound)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
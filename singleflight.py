@@ -0,0 +1,67 @@
+import threading
+
+import instrumentation
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    ''' coalesces concurrent calls for the same key: the first caller runs
+    the function, callers arriving while it runs wait for it and get the
+    same result (or exception) instead of running it again
+
+    Parameters
+    ----------
+    kind
+        str: label of the coalesced counter, e.g. 'page' or 'api'
+    '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        ''' run function() unless a call for key is already in flight
+
+        Parameters
+        ----------
+        key
+            hashable: what identifies the work, e.g. the url
+        function
+            function: called without arguments by the first caller only
+
+        Returns
+        -------
+        the result of the call, shared by every caller
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            instrumentation.count("coalesced_waits", kind=self.kind)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
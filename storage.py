@@ -0,0 +1,105 @@
+import contextlib
+import os
+import sqlite3
+import tempfile
+
+# how long a connection waits for another process's lock before failing
+BUSY_TIMEOUT = 30.0
+# WAL lets readers keep reading while a writer commits; 'delete' is SQLite's default
+JOURNAL_MODE = 'wal'
+# NORMAL is durable in WAL mode except for the last commits on a power loss
+SYNCHRONOUS = 'NORMAL'
+# os.umask can only be read by setting it; done once, before any thread starts
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def connect(path, **kwargs):
+    ''' open a sqlite database for use by several processes at once
+
+    The database is switched to JOURNAL_MODE (the mode is stored in the
+    file, so every later connection gets it too), waits up to BUSY_TIMEOUT
+    for locks, and begins its implicit transactions with BEGIN IMMEDIATE:
+    a writer takes the write lock before reading anything, so it waits its
+    turn instead of failing when another process commits first.
+
+    Parameters
+    ----------
+    path
+        str: the database file
+    kwargs
+        passed to sqlite3.connect
+
+    Returns
+    -------
+    sqlite3.Connection
+    '''
+    kwargs.setdefault('timeout', BUSY_TIMEOUT)
+    kwargs.setdefault('isolation_level', 'IMMEDIATE')
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute('PRAGMA journal_mode = ' + JOURNAL_MODE)
+    conn.execute('PRAGMA synchronous = ' + SYNCHRONOUS)
+    return conn
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', encoding='utf-8', **kwargs):
+    ''' a file to write in pieces that replaces path in one step when the
+    with block ends without an error: the pieces go to a temporary file
+    next to it, which is then renamed over the old one, so readers see
+    either the old or the new contents and never a half written file
+
+    Parameters
+    ----------
+    path
+        str: the file
+    mode
+        str: 'w' or 'wb'
+    kwargs
+        passed to open, e.g. newline
+
+    Returns
+    -------
+    context manager giving the open temporary file
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        if 'b' not in mode:
+            kwargs['encoding'] = encoding
+        with os.fdopen(handle, mode, **kwargs) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        # mkstemp makes the file owner only; keep the mode of the file it
+        # replaces, or give a new one the mode open() would have
+        try:
+            file_mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            file_mode = 0o666 & ~UMASK
+        os.chmod(temp_path, file_mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write(path, contents, mode='w', encoding='utf-8'):
+    ''' replace a file in one step with contents, see atomic_open
+
+    Parameters
+    ----------
+    path
+        str: the file
+    contents
+        str (or bytes with mode 'wb'): the new contents
+    mode
+        str: 'w' or 'wb'
+
+    Returns
+    -------
+    None
+    '''
+    with atomic_open(path, mode, encoding) as temp_file:
+        temp_file.write(contents)
@@ -0,0 +1,115 @@
+'''A local stand-in for the RapidAPI endpoints, for tests that fetch without
+the network: point final_project.HISTORY_URL and LATEST_STATUS_URL at
+StubAPI.base_url, or set COVID_API_BASE_URL to it before final_project is
+imported.
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def history_records(code, days=5):
+    ''' two records a day, as the API sends them, the later one with the
+    day's counts '''
+    records = []
+    for day in range(1, days + 1):
+        for hour in (1, 5):
+            records.append({"record_date": "2020-04-{:02d} {:02d}:00:00.000".format(day, hour),
+                            "total_cases": "{:,}".format(day * 1000 + hour), "active_cases": "10",
+                            "total_deaths": "1", "total_recovered": "N/A",
+                            "new_cases": "5", "new_deaths": "0", "country_name": code})
+    return records
+
+
+class StubAPI:
+    ''' an HTTP server answering history_by_alpha_2.php and
+    latest_stat_by_alpha_2_code.php on a free local port
+
+    Parameters
+    ----------
+    delay
+        float: seconds every answer takes
+    failures
+        dic: country code -> statuses to answer with, in order, before the
+        payload
+    days
+        int: days in every history
+
+    Attributes
+    ----------
+    requests
+        list: (code, monotonic time, status) of every request, in arrival order
+    max_in_flight
+        int: most requests being answered at once
+    '''
+
+    def __init__(self, delay=0.0, failures=None, days=5):
+        self.delay = delay
+        self.failures = {code: list(statuses) for code, statuses in (failures or {}).items()}
+        self.days = days
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}/coronavirus/".format(self._server.server_address[1])
+
+    def count(self, code):
+        ''' the requests made for a country '''
+        return sum(1 for requested, _, _ in self.requests if requested == code)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _answer(self, path):
+        url = urlsplit(path)
+        code = parse_qs(url.query).get("alpha2", [""])[0]
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            pending = self.failures.get(code)
+            status = pending.pop(0) if pending else 200
+            self.requests.append((code, time.monotonic(), status))
+        try:
+            time.sleep(self.delay)
+            if status != 200:
+                return status, b""
+            records = history_records(code, self.days)
+            if url.path.endswith("history_by_alpha_2.php"):
+                payload = {"alpha2": code, "stat_by_country": records}
+            else:
+                payload = {"alpha2": code, "latest_stat_by_country": records[-1:]}
+            return 200, json.dumps(payload).encode("utf-8")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body = stub._answer(self.path)
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        return Handler
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from history_stream import iter_payload_records, last_record_per_day  # noqa: E402
+
+RECORDS = [
+    {"record_date": "2020-04-01 01:00:00.000", "total_cases": "1,001", "new_cases": 12345,
+     "country_name": "Côte d'Ivoire", "rate": 0.125, "flags": [1, {"a": None}]},
+    {"record_date": "2020-04-01 05:00:00.000", "total_cases": "1,005", "new_cases": 67890,
+     "country_name": "Curaçao", "rate": -1.5e-3, "flags": []},
+    {"record_date": "2020-04-02 01:00:00.000", "total_cases": "", "new_cases": 0,
+     "country_name": "日本 \"quoted\" \\ \U0001f600", "rate": 10, "flags": True},
+]
+
+
+def payload(**fields):
+    return json.dumps(fields, ensure_ascii=False, indent=1).encode("utf-8")
+
+
+def split_at(data, *positions):
+    bounds = [0] + list(positions) + [len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+class IterPayloadRecordsTest(unittest.TestCase):
+
+    def test_every_split_point(self):
+        # every boundary: inside keys, strings, numbers, multibyte characters
+        data = payload(alpha2="CI", stat_by_country=RECORDS)
+        for position in range(len(data) + 1):
+            with self.subTest(position=position):
+                self.assertEqual(list(iter_payload_records(split_at(data, position))), RECORDS)
+
+    def test_one_byte_chunks(self):
+        data = payload(alpha2="CI", stat_by_country=RECORDS)
+        self.assertEqual(list(iter_payload_records(data[i:i + 1] for i in range(len(data)))), RECORDS)
+
+    def test_number_at_the_end_of_a_chunk(self):
+        data = b'{"stat_by_country": [{"n": 12345}, {"n": 6}]}'
+        cut = data.index(b"345")
+        self.assertEqual(list(iter_payload_records(split_at(data, cut, cut + 1))), [{"n": 12345}, {"n": 6}])
+
+    def test_empty_chunks_are_skipped(self):
+        data = payload(stat_by_country=RECORDS)
+        chunks = [b""] + split_at(data, 10, 10, 50) + [b""]
+        self.assertEqual(list(iter_payload_records(chunks)), RECORDS)
+
+    def test_other_keys_before_and_after(self):
+        data = payload(alpha2="CI", meta={"stat_by_country": "not this one", "list": [1, 2]},
+                       latest_stat_by_country=RECORDS[:1], after=[{"x": 1}])
+        self.assertEqual(list(iter_payload_records(split_at(data, 7, 40))), RECORDS[:1])
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_payload_records([b'{"stat_by_country": [ ]}'])), [])
+
+    def test_missing_array(self):
+        with self.assertRaises(ValueError):
+            list(iter_payload_records([b'{"alpha2": "US", "message": "quota"}']))
+        with self.assertRaises(ValueError):
+            list(iter_payload_records([b'{}']))
+
+    def test_truncated_payload(self):
+        data = payload(stat_by_country=RECORDS)
+        with self.assertRaises(ValueError):
+            list(iter_payload_records([data[:-20]]))
+
+
+class LastRecordPerDayTest(unittest.TestCase):
+
+    def test_keeps_the_last_record_of_each_day(self):
+        self.assertEqual(list(last_record_per_day(iter(RECORDS))), RECORDS[1:])
+
+    def test_empty(self):
+        self.assertEqual(list(last_record_per_day([])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
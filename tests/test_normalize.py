@@ -0,0 +1,66 @@
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import normalize  # noqa: E402
+
+
+class ParseCountsTest(unittest.TestCase):
+
+    def check(self, values, counts, present):
+        parsed, found = normalize.parse_counts(values)
+        self.assertEqual(parsed.tolist(), counts)
+        self.assertEqual(found.tolist(), present)
+        self.assertEqual(str(parsed.dtype), "int64")
+
+    def test_numbers(self):
+        self.check(["0", "7", "1,234", "12,345,678", " 56 ", "007"],
+                   [0, 7, 1234, 12345678, 56, 7], [True] * 6)
+
+    def test_missing(self):
+        self.check(["", None, "N/A", "-3", "12a", "1.5", "1 2", " ", ","],
+                   [0] * 9, [False] * 9)
+
+    def test_longest_count(self):
+        self.check(["9" * normalize.MAX_DIGITS], [int("9" * normalize.MAX_DIGITS)], [True])
+
+    def test_too_long_is_missing(self):
+        # used to raise IndexError (20 digits) or overflow (128 digits)
+        self.check(["9" * 19, "1" * 20, "1" * 128, "5"], [0, 0, 0, 5], [False, False, False, True])
+
+    def test_empty(self):
+        self.check([], [], [])
+
+
+class NormalizeHistoryTest(unittest.TestCase):
+
+    def test_columns(self):
+        records = [
+            {"record_date": "2020-04-01 05:00:00.000", "total_cases": "1,000", "total_deaths": "10",
+             "active_cases": "600", "total_recovered": "N/A"},
+            {"record_date": "2020-04-02 05:00:00.000", "total_cases": "2,000", "total_deaths": "",
+             "active_cases": "900", "total_recovered": "1,050"},
+        ]
+        columns = normalize.normalize_history(records, 100000)
+        self.assertEqual(columns["Time"].tolist(), ["2020-04-01", "2020-04-02"])
+        self.assertEqual(columns["Total_cases"].tolist(), [1000, 2000])
+        self.assertEqual(columns["Total_deaths"].tolist(), [10, 0])
+        self.assertEqual(columns["Total_recovered"].tolist(), [390, 1050]) # derived when missing
+        self.assertEqual(columns["Tot_case_pop_perc"].tolist(), [1.0, 2.0])
+
+    def test_missing_fields(self):
+        columns = normalize.normalize_history([{"record_date": "2020-04-01 05:00:00.000"}], 100)
+        self.assertEqual(columns["Total_cases"].tolist(), [0])
+        self.assertEqual(columns["Total_recovered"].tolist(), [0])
+
+    def test_no_records(self):
+        columns = normalize.normalize_history([], 100)
+        self.assertEqual(set(columns), set(normalize.HISTORY_COLUMNS))
+        self.assertEqual(len(columns["Time"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, TESTS_DIR)
+
+import secrets  # noqa: E402
+
+if not hasattr(secrets, "API_KEY"):
+    # no secrets.py with the RapidAPI key: final_project only needs one to
+    # import, the stub API never checks it
+    stub_secrets = types.ModuleType("secrets")
+    stub_secrets.__dict__.update(vars(secrets))
+    stub_secrets.API_KEY = "stub-api-key"
+    sys.modules["secrets"] = stub_secrets
+
+import final_project  # noqa: E402
+import prefetch  # noqa: E402
+from country_directory import CountryDirectory  # noqa: E402
+from stub_api import StubAPI  # noqa: E402
+
+CODES = ["AA", "BB", "CC", "DD", "EE", "FF", "GG", "HH"]
+
+
+def directory(codes):
+    countries = [{"letter": "x", "number": str(number), "name": "Country " + code,
+                  "population": 1000000, "code": code}
+                 for number, code in enumerate(codes, 1)]
+    return CountryDirectory(countries, {"country " + code.lower(): code for code in codes})
+
+
+class PrefetchTest(unittest.TestCase):
+    ''' prefetch against StubAPI, in a scratch directory with its own cache
+    and database '''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        os.chdir(self.workdir.name)
+        self.saved = {name: getattr(final_project, name) for name in
+                      ("CACHE_DICT", "COUNTRY_DIRECTORY", "HISTORY_URL", "LATEST_STATUS_URL",
+                       "DB_CONNS", "COLUMN_STORE")}
+        final_project.CACHE_DICT = final_project.load_cache()
+        final_project.COUNTRY_DIRECTORY = directory(CODES)
+        final_project.DB_CONNS = threading.local()
+        final_project.COLUMN_STORE = None
+        self.stub = None
+
+    def tearDown(self):
+        if self.stub is not None:
+            self.stub.stop()
+        final_project.CACHE_DICT.close()
+        for name, value in self.saved.items():
+            setattr(final_project, name, value)
+        os.chdir(self.cwd)
+        self.workdir.cleanup()
+
+    def serve(self, **options):
+        self.stub = StubAPI(**options).start()
+        final_project.HISTORY_URL = self.stub.base_url + "history_by_alpha_2.php"
+        final_project.LATEST_STATUS_URL = self.stub.base_url + "latest_stat_by_alpha_2_code.php"
+        return self.stub
+
+    def test_concurrency_limit(self):
+        stub = self.serve(delay=0.05)
+        summary = prefetch.prefetch(CODES, concurrency=3, rate=1000, progress=lambda line: None)
+        self.assertEqual(summary['failed'], {})
+        self.assertEqual(summary['fetched'], len(CODES))
+        self.assertEqual(summary['ingested'], len(CODES))
+        self.assertLessEqual(stub.max_in_flight, 3)
+        self.assertGreater(stub.max_in_flight, 1)
+
+    def test_retries_429_and_503(self):
+        stub = self.serve(failures={"BB": [429, 503]})
+        summary = prefetch.prefetch(["AA", "BB"], retries=2, backoff=0.01, rate=1000, progress=lambda line: None)
+        self.assertEqual(summary['failed'], {})
+        self.assertEqual(stub.count("BB"), 3)
+        self.assertEqual(len(final_project.get_series("BB")["Time"]), stub.days)
+
+    def test_gives_up_after_retries(self):
+        stub = self.serve(failures={"BB": [503, 503, 503], "CC": [404]})
+        summary = prefetch.prefetch(["AA", "BB", "CC"], retries=1, backoff=0.01, rate=1000,
+                                    progress=lambda line: None)
+        self.assertEqual(set(summary['failed']), {final_project.HISTORY_URL + "BB", final_project.HISTORY_URL + "CC"})
+        self.assertEqual(stub.count("BB"), 2)
+        self.assertEqual(stub.count("CC"), 1) # not a status worth another try
+        self.assertEqual(summary['ingested'], 1)
+
+    def test_rate_limit(self):
+        stub = self.serve()
+        prefetch.prefetch(CODES[:6], concurrency=4, rate=20, burst=1, progress=lambda line: None)
+        times = sorted(requested_at for _, requested_at, _ in stub.requests)
+        self.assertGreaterEqual(times[-1] - times[0], 5 / 20 * 0.9)
+
+    def test_cached_entries_are_not_fetched(self):
+        stub = self.serve()
+        prefetch.prefetch(["AA", "BB"], rate=1000, progress=lambda line: None)
+        summary = prefetch.prefetch(["AA", "BB", "CC"], rate=1000, progress=lambda line: None)
+        self.assertEqual((summary['fetched'], summary['cached']), (1, 2))
+        self.assertEqual(len(stub.requests), 3)
+
+    def test_unknown_code(self):
+        self.serve()
+        with self.assertRaisesRegex(ValueError, "unknown country code QQ"):
+            prefetch.prefetch(["AA", "QQ"], progress=lambda line: None)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = prefetch.TokenBucket(rate=50, capacity=2)
+        start = time.monotonic()
+        bucket.acquire()
+        bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.02)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50 * 0.9)
+
+    def test_shared_between_threads(self):
+        bucket = prefetch.TokenBucket(rate=100, capacity=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, 19 / 100 * 0.9)
+
+
+if __name__ == "__main__":
+    unittest.main()